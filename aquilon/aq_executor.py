@@ -0,0 +1,127 @@
+"""
+    Executors used to run aq commands against an Aquilon broker
+"""
+
+import logging
+import subprocess
+import xml.etree.ElementTree as ET
+
+from collections import namedtuple
+
+AqResult = namedtuple('AqResult', ['returncode', 'stdout', 'stderr'])
+
+
+def is_not_found(result):
+    """
+    Whether a failed command failed because what it asked for doesn't exist. aq.py, and the broker executor, exit with
+    4 for any client error, so a missing object is told apart from errors like failed authentication by its message.
+    """
+    return result.returncode == 4 and 'not found' in (result.stderr or '').lower()
+
+
+class SubprocessExecutor():
+    """ Runs every command in a new aq.py process, this is the fallback when no broker session is available """
+    def __init__(self, cli_path):
+        self.name = cli_path
+
+    def run(self, cmd):
+        """ Run a single aq command, returning an AqResult """
+        process = subprocess.run(
+            [self.name] + cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=False,
+        )
+        return AqResult(process.returncode, process.stdout.decode('utf-8'), process.stderr.decode('utf-8'))
+
+    def close(self):
+        """ Nothing is kept open between commands """
+
+
+class BrokerExecutor():
+    """
+        Sends commands directly to the broker over a single long-lived HTTP session,
+        so authentication and TLS setup are only paid once per run rather than once per command.
+
+        Commands are translated to requests using the transport definitions in the broker's input.xml,
+        in the same way as aq.py: options referenced by the transport path are substituted into it,
+        and all options are sent as form data.
+    """
+    def __init__(self, url, input_xml, verify=True, kerberos=False, fallback=None):  # pylint: disable=too-many-arguments
+        self.name = url
+        self.url = url.rstrip('/') + '/'
+        self.transports = self.load_transports(input_xml)
+        self.fallback = fallback
+
+        # Only imported when a broker is used, as it is slow to import
+        import requests  # pylint: disable=import-outside-toplevel
+        self.session = requests.Session()
+        self.session.verify = verify
+        if kerberos:
+            # Optional dependency, only needed when talking to a kerberised broker
+            from requests_kerberos import HTTPKerberosAuth, OPTIONAL  # pylint: disable=import-outside-toplevel,import-error
+            self.session.auth = HTTPKerberosAuth(mutual_authentication=OPTIONAL)
+
+    @classmethod
+    def load_transports(cls, input_xml):
+        """
+        Build a map of command name to (method, path) from an aq input.xml file.
+        Commands with sub-command triggers (e.g. "add" triggered by "host") are stored as "add_host".
+        """
+        transports = {}
+        for command in ET.parse(input_xml).getroot().iter('command'):
+            for transport in command.iter('transport'):
+                name = command.get('name')
+                if transport.get('trigger'):
+                    name = f'{name}_{transport.get("trigger")}'
+                transports[name] = (transport.get('method', 'get').lower(), transport.get('path'))
+        return transports
+
+    @classmethod
+    def parse_options(cls, args):
+        """ Convert a list of command line arguments into a dictionary of options, flags are set to True """
+        options = {}
+        key = None
+        for arg in args:
+            if arg.startswith('--'):
+                key = arg[2:]
+                options[key] = True
+            elif key:
+                options[key] = arg
+                key = None
+        return options
+
+    def run(self, cmd):
+        """ Run a single aq command, returning an AqResult """
+        if cmd[0] not in self.transports:
+            if self.fallback:
+                logging.debug('No transport for command "%s", using %s', cmd[0], self.fallback.name)
+                return self.fallback.run(cmd)
+            return AqResult(2, '', f'Unknown command "{cmd[0]}" for broker {self.name}')
+
+        method, path = self.transports[cmd[0]]
+        options = self.parse_options(cmd[1:])
+        try:
+            path = path % options
+        except KeyError as missing:
+            return AqResult(2, '', f'Missing option --{missing.args[0]} for command "{cmd[0]}"')
+
+        try:
+            response = self.session.request(
+                method,
+                self.url + path.lstrip('/'),
+                data={k: str(v) for k, v in options.items()},
+            )
+        except OSError as error:
+            # requests.exceptions.RequestException is a subclass of OSError
+            logging.debug('Request to broker failed: %s', error)
+            return AqResult(5, '', str(error))
+
+        if response.ok:
+            return AqResult(0, response.text, '')
+        # Mirror the exit codes of aq.py, which uses the class of the HTTP status code
+        return AqResult(response.status_code // 100, '', response.text)
+
+    def close(self):
+        """ Close the session and any connections held open to the broker """
+        self.session.close()
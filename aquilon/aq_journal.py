@@ -0,0 +1,91 @@
+"""
+    Durable journal of the aq commands run for each device, so that a run that fails part way through can be resumed
+    from the first incomplete command, or explicitly rolled back
+"""
+
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+
+from aq_plan import CommandPlan
+
+# Events that end a journal, any other last event means the plan was interrupted
+FINAL_EVENTS = ('finished', 'rolled_back')
+
+
+class Journal():
+    """
+        Stores one JSON lines file per device key under a directory, e.g. device-5249.jsonl.
+        The first line holds the plan being run, and a line is appended and synced to disk as each command completes
+        or fails, so the journal survives crashes of netbox2aquilon itself as well as failed commands.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _filename(self, key):
+        return os.path.join(self.path, f'{key}.jsonl')
+
+    def start(self, key, plan, **details):
+        """ Begin the journal of a new plan for a device, replacing any earlier journal """
+        os.makedirs(self.path, exist_ok=True)
+        entry = dict(details, event='start', time=time.time(), **plan.to_dict())
+        handle, tmp_filename = tempfile.mkstemp(dir=self.path, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'w', encoding='utf-8') as journal_file:
+                journal_file.write(json.dumps(entry) + '\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            os.replace(tmp_filename, self._filename(key))
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
+
+    def record(self, key, event, **fields):
+        """ Durably append an event to the journal of a device, e.g. done or failed with the index of a command """
+        line = json.dumps(dict(fields, event=event, time=time.time())) + '\n'
+        with open(self._filename(key), 'a+', encoding='utf-8') as journal_file:
+            # A crash while appending can leave part of a line at the end, start after it so this line can be read
+            if journal_file.tell() > 0:
+                journal_file.seek(journal_file.tell() - 1)
+                if journal_file.read(1) != '\n':
+                    line = '\n' + line
+            journal_file.write(line)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+    def load(self, key):
+        """
+        Read the journal of a device, returns None if there isn't one. Otherwise returns a dict of the details the
+        plan was started with, along with the plan, the indices of the commands that completed in the order they
+        completed, and whether the journal was finished.
+        """
+        try:
+            with open(self._filename(key), 'r', encoding='utf-8') as journal_file:
+                lines = journal_file.readlines()
+        except FileNotFoundError:
+            return None
+
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # Lines partly written by a crash while appending them are followed by any later events
+                logging.warning('Ignoring incomplete entry in journal %s', self._filename(key))
+
+        state = dict(entries[0], plan=CommandPlan.from_dict(entries[0]), done=[], finished=False)
+        for entry in entries[1:]:
+            if entry['event'] == 'done':
+                state['done'].append(entry['index'])
+            state['finished'] = entry['event'] in FINAL_EVENTS
+        return state
+
+    def incomplete(self, key):
+        """ The journal of a device if its plan was interrupted, otherwise None """
+        state = self.load(key)
+        if state is None or state['finished']:
+            return None
+        return state
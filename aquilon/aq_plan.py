@@ -0,0 +1,167 @@
+"""
+    Dependency graph of aq commands, used to run independent commands at the same time,
+    and storage of plans so that they can be reviewed and replayed later
+"""
+
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+
+from netbox_cache import NetboxCache
+
+# Version of the plan file format, plans written by other versions are not replayed
+PLAN_VERSION = 1
+
+
+def input_hash(cmds):
+    """
+    Hash of the commands that would copy a device from scratch. These are derived only from the NetBox inputs of the
+    device and the copy options, so an unchanged hash means there is nothing new to copy.
+    """
+    encoded = json.dumps([PLAN_VERSION, cmds], separators=(',', ':')).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class CommandPlan():
+    """
+        A list of aq commands along with the set of indices of earlier commands that each one depends on.
+        Any order that runs every command after all of its dependencies gives the same result as running the
+        commands in the order they were planned.
+    """
+    def __init__(self, cmds, deps):
+        self.cmds = cmds
+        self.deps = deps
+
+    def __len__(self):
+        return len(self.cmds)
+
+    def __iter__(self):
+        return iter(self.cmds)
+
+    @classmethod
+    def _get_option(cls, cmd, option):
+        if option in cmd[:-1]:
+            return cmd[cmd.index(option) + 1]
+        return None
+
+    @classmethod
+    def from_cmds(cls, cmds):
+        """
+        Build a plan from an ordered list of commands, as generated by the netbox2aquilon planners.
+        The only orderings kept are the real ones:
+            - add_machine before anything else on that machine
+            - add_interface before any update of that interface, including making it the --master of another
+            - updates of the same interface in their original order
+            - add_host after all the machine, disk and interface commands before it, as it uses the boot interface
+            - add_interface_address after add_host and after adding the interface
+        Any other command is treated as a barrier that runs after all earlier commands and before all later ones.
+        """
+        deps = []
+        machines = {}
+        interfaces = {}
+        hosts = {}
+        barrier = None
+
+        for index, cmd in enumerate(cmds):
+            action = cmd[0]
+            machine = cls._get_option(cmd, '--machine')
+            cmd_deps = set() if barrier is None else {barrier}
+
+            if machine in machines:
+                cmd_deps.add(machines[machine])
+
+            if action == 'add_machine':
+                machines[machine] = index
+            elif action == 'add_disk':
+                pass
+            elif action in ('add_interface', 'update_interface'):
+                interface = (machine, cls._get_option(cmd, '--interface'))
+                if interface in interfaces:
+                    cmd_deps.add(interfaces[interface])
+                master = (machine, cls._get_option(cmd, '--master'))
+                if master in interfaces:
+                    cmd_deps.add(interfaces[master])
+                interfaces[interface] = index
+            elif action == 'add_host':
+                cmd_deps.update(range(index))
+                hosts[machine] = index
+            elif action == 'add_interface_address':
+                interface = (machine, cls._get_option(cmd, '--interface'))
+                if interface in interfaces:
+                    cmd_deps.add(interfaces[interface])
+                if machine in hosts:
+                    cmd_deps.add(hosts[machine])
+            else:
+                cmd_deps.update(range(index))
+                barrier = index
+
+            deps.append(cmd_deps)
+
+        return cls(cmds, deps)
+
+    def is_sequential(self):
+        """
+        Whether no two commands of the plan can run at the same time, as each command depends on the one before it.
+        Dependencies always refer to earlier commands, so the commands in order are the only order they can run in.
+        """
+        levels = []
+        for cmd_deps in self.deps:
+            levels.append(max((levels[dep] + 1 for dep in cmd_deps), default=0))
+        return len(set(levels)) == len(levels)
+
+    def to_dict(self):
+        """ JSON serialisable form of the plan """
+        return {'cmds': self.cmds, 'deps': [sorted(d) for d in self.deps]}
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Rebuild a plan from the output of to_dict """
+        return cls(data['cmds'], [set(d) for d in data['deps']])
+
+
+class PlanStore():
+    """
+        Directory of plans, one file per device named by its key, e.g. device-5249.json, along with the input hash
+        of the last plan successfully applied to each device.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.applied = NetboxCache(path, 0)
+
+    def save(self, key, plan, **details):
+        """ Atomically write a plan for a device, with any details that describe it. Returns the file written. """
+        os.makedirs(self.path, exist_ok=True)
+        filename = os.path.join(self.path, f'{key}.json')
+        data = dict(details, version=PLAN_VERSION, key=key, created=time.time(), **plan.to_dict())
+        handle, tmp_filename = tempfile.mkstemp(dir=self.path, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'w', encoding='utf-8') as plan_file:
+                json.dump(data, plan_file, indent=2)
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
+        logging.debug('Saved plan for %s to %s', key, filename)
+        return filename
+
+    @classmethod
+    def load(cls, filename):
+        """ Read a plan file written by save, returns a tuple of the details of the plan and the plan itself """
+        with open(filename, 'r', encoding='utf-8') as plan_file:
+            data = json.load(plan_file)
+        if data.get('version') != PLAN_VERSION:
+            raise ValueError(f'unsupported plan version {data.get("version")}')
+        return data, CommandPlan.from_dict(data)
+
+    def get_applied(self, key):
+        """ Input hash of the last plan applied to a device, or None if none has been """
+        applied = self.applied.load('applied', key)
+        return applied[0] if applied else None
+
+    def set_applied(self, key, digest):
+        """ Record that a plan with an input hash has been successfully applied to a device """
+        self.applied.store('applied', key, digest)
@@ -0,0 +1,213 @@
+"""
+    Comparison of the state of a machine in Aquilon with the state planned from NetBox, so that only the commands
+    needed to bring Aquilon up to date are run
+"""
+
+import logging
+
+# Options of add_machine that can be changed later with update_machine
+UPDATABLE_MACHINE_OPTIONS = ['--rack', '--cluster', '--cpucount', '--memory']
+
+
+def _get_option(cmd, option):
+    if option in cmd[:-1]:
+        return cmd[cmd.index(option) + 1]
+    return None
+
+
+def _normalise_mac(mac):
+    return mac.lower() if mac else None
+
+
+class MachineState():
+    """
+        The disks, interfaces, addresses and host of a single machine, either as planned by netbox2aquilon or as read
+        from Aquilon. Planned states keep the commands that create each part, so that they can be reused.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.options = {}
+        self.disks = {}
+        self.interfaces = {}
+        self.addresses = {}
+        # Hostname and primary IP address, if the machine has a host
+        self.host = None
+        self.cmds = {}
+
+    @classmethod
+    def from_cmds(cls, cmds):
+        """ Build the planned state of a machine from the commands that would create it from scratch """
+        state = None
+        for cmd in cmds:
+            action = cmd[0]
+            if state is None:
+                state = cls(_get_option(cmd, '--machine'))
+
+            if action == 'add_machine':
+                state.options = {o: _get_option(cmd, o) for o in UPDATABLE_MACHINE_OPTIONS if o in cmd}
+                state.cmds['machine'] = cmd
+            elif action == 'add_disk':
+                disk = _get_option(cmd, '--disk')
+                state.disks[disk] = {'size': int(_get_option(cmd, '--size')), 'boot': '--boot' in cmd}
+                state.cmds[('disk', disk)] = cmd
+            elif action == 'add_interface':
+                interface = _get_option(cmd, '--interface')
+                state.interfaces[interface] = {
+                    'mac': _normalise_mac(_get_option(cmd, '--mac')),
+                    'boot': False,
+                    'master': None,
+                }
+                state.cmds[('interface', interface)] = [cmd]
+            elif action == 'update_interface':
+                interface = _get_option(cmd, '--interface')
+                if '--boot' in cmd:
+                    state.interfaces[interface]['boot'] = True
+                if '--master' in cmd:
+                    state.interfaces[interface]['master'] = _get_option(cmd, '--master')
+                state.cmds[('interface', interface)].append(cmd)
+            elif action == 'add_host':
+                state.host = (_get_option(cmd, '--hostname'), _get_option(cmd, '--ip'))
+                state.cmds['host'] = cmd
+            elif action == 'add_interface_address':
+                ip = _get_option(cmd, '--ip')
+                state.addresses[ip] = (_get_option(cmd, '--interface'), _get_option(cmd, '--fqdn'))
+                state.cmds[('address', ip)] = cmd
+            else:
+                logging.warning('Command "%s" can not be reconciled and was ignored', action)
+        return state
+
+    @classmethod
+    def from_aq(cls, data):
+        """
+        Build the current state of a machine from the output of "aq show_machine --format json", which uses the field
+        names of the machine message of the Aquilon protocol. Fields that are missing are not compared.
+        """
+        if isinstance(data, dict) and 'machines' in data:
+            data = data['machines'][0]
+        state = cls(data['name'])
+
+        for option, key in [('--rack', 'rack'), ('--cluster', 'cluster'), ('--cpucount', 'cpu_count'),
+                            ('--memory', 'memory')]:
+            value = data.get(key)
+            if isinstance(value, dict):
+                value = value.get('name')
+            if value is not None:
+                state.options[option] = str(value)
+
+        host = data.get('host') or {}
+        hostname = host.get('hostname') or host.get('fqdn') or data.get('hostname')
+        if hostname:
+            state.host = (hostname, host.get('ip') or data.get('ip'))
+        host_ip = state.host[1] if state.host else None
+
+        for disk in data.get('disks', []):
+            state.disks[disk['device_name']] = {
+                'size': int(disk['capacity']),
+                'boot': disk.get('bootable'),
+            }
+
+        for interface in data.get('interfaces', []):
+            name = interface['device']
+            state.interfaces[name] = {
+                'mac': _normalise_mac(interface.get('mac')),
+                'boot': interface.get('bootable'),
+                'master': interface.get('master') or None,
+            }
+            addresses = list(interface.get('addresses', []))
+            if interface.get('ip'):
+                addresses.append({'ip': interface['ip'], 'fqdn': interface.get('fqdn')})
+            for address in addresses:
+                # The primary address belongs to the host, not to the interface
+                if address['ip'] != host_ip:
+                    state.addresses[address['ip']] = (name, address.get('fqdn') or None)
+
+        return state
+
+
+def _reconcile_disks(current, planned):
+    deletes = [
+        ['del_disk', '--machine', planned.name, '--disk', disk] for disk in current.disks if disk not in planned.disks
+    ]
+    updates = []
+    adds = []
+    for disk, wanted in planned.disks.items():
+        if disk not in current.disks:
+            adds.append(planned.cmds[('disk', disk)])
+            continue
+        existing = current.disks[disk]
+        boot = wanted['boot'] and existing['boot'] is False
+        if wanted['size'] != existing['size'] or boot:
+            cmd = ['update_disk', '--machine', planned.name, '--disk', disk, '--size', str(wanted['size'])]
+            if boot:
+                cmd.append('--boot')
+            updates.append(cmd)
+    return deletes, updates, adds
+
+
+def _reconcile_interfaces(current, planned):
+    deletes = [
+        ['del_interface', '--machine', planned.name, '--interface', interface]
+        for interface in current.interfaces if interface not in planned.interfaces
+    ]
+    updates = []
+    adds = []
+    for interface, wanted in planned.interfaces.items():
+        if interface not in current.interfaces:
+            adds.extend(planned.cmds[('interface', interface)])
+            continue
+        existing = current.interfaces[interface]
+        update = ['update_interface', '--machine', planned.name, '--interface', interface]
+        if wanted['mac'] and wanted['mac'] != existing['mac']:
+            updates.append(update + ['--mac', wanted['mac']])
+        if wanted['boot'] and existing['boot'] is False:
+            updates.append(update + ['--boot'])
+        if wanted['master'] and wanted['master'] != existing['master']:
+            updates.append(update + ['--master', wanted['master']])
+        elif existing['master'] and not wanted['master']:
+            logging.warning(
+                'Interface %s of %s must be removed from %s by hand', interface, planned.name, existing['master'],
+            )
+    return deletes, updates, adds
+
+
+def _reconcile_addresses(current, planned):
+    deletes = []
+    adds = []
+    for ip, address in current.addresses.items():
+        if planned.addresses.get(ip) != address:
+            deletes.append(['del_interface_address', '--machine', planned.name, '--interface', address[0], '--ip', ip])
+    for ip, address in planned.addresses.items():
+        if current.addresses.get(ip) != address:
+            adds.append(planned.cmds[('address', ip)])
+    return deletes, [], adds
+
+
+def reconcile(current, planned):
+    """
+    Generate the commands that change a machine in Aquilon from its current state to the planned state.
+    Anything being removed or replaced is deleted first, addresses before the interfaces they are on, then everything
+    is updated and added in the order it was planned. Changes that Aquilon can't make in place are only warned about.
+    """
+    deletes = []
+    updates = []
+    adds = []
+
+    options = {o: v for o, v in planned.options.items() if current.options.get(o, v) != v}
+    if options:
+        updates.append(['update_machine', '--machine', planned.name] + [x for item in options.items() for x in item])
+
+    addresses = _reconcile_addresses(current, planned)
+    for part in (_reconcile_disks(current, planned), _reconcile_interfaces(current, planned)):
+        deletes += part[0]
+        updates += part[1]
+        adds += part[2]
+
+    if current.host is None and planned.host is not None:
+        adds.append(planned.cmds['host'])
+    elif planned.host is not None and current.host != planned.host:
+        logging.warning(
+            'Host of %s is %s in Aquilon, but %s in NetBox, it must be copied again to change it',
+            planned.name, current.host, planned.host,
+        )
+
+    return addresses[0] + deletes + updates + adds + addresses[2]
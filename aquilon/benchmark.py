@@ -0,0 +1,559 @@
+#!/usr/bin/env python3
+
+"""
+    Benchmarks of NetBox record construction, lookups, subnetdata dump, aq command planners and startup at fleet scale.
+
+    Synthetic NetBox data is generated at the chosen scale and served by a local fake NetBox, so the number of API
+    calls and bytes transferred by each lookup can be counted as well as timed. Results are saved as JSON, and can be
+    compared with the results of a previous run to spot regressions between versions.
+
+    Usage: ./benchmark.py [--scale quick|full] [--output results.json] [--compare previous.json]
+"""
+
+import argparse
+import ipaddress
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+import pynetbox
+
+from aq_executor import AqResult
+from aq_plan import CommandPlan
+from netbox2aquilon import Netbox2Aquilon
+from netbox_dump_subnetdata import NetboxDumpSubnetdata
+from netbox_records import AddressRecord, InterfaceRecord, PrefixRecord
+from prefix_index import PrefixIndex
+from scd_netbox import DeviceSnapshot
+
+SCALES = {
+    'quick': {
+        'prefixes': 10000,
+        'interfaces': 500,
+        'disks': 100,
+        'hosts': 1000,
+        'repeat': 3,
+    },
+    'full': {
+        'prefixes': 100000,
+        'interfaces': 500,
+        'disks': 500,
+        'hosts': 5000,
+        'repeat': 5,
+    },
+}
+
+TENANTS = ['tier1', 'cloud', 'secops']
+
+# Largest page NetBox returns by default, regardless of the limit requested
+MAX_PAGE_SIZE = 1000
+
+
+def make_prefixes(count):
+    """ Leaf /28 prefixes spread across the configured tenants, with a mix of optional fields set """
+    base = int(ipaddress.IPv4Address('10.0.0.0'))
+    prefixes = []
+    for i in range(count):
+        address = ipaddress.IPv4Address(base + i * 16)
+        prefixes.append({
+            'id': i + 1,
+            'prefix': f'{address}/28',
+            'family': {'value': 4, 'label': 'IPv4'},
+            'vrf': None,
+            'tenant': {'id': i % len(TENANTS), 'slug': TENANTS[i % len(TENANTS)]},
+            'role': {'id': 1, 'slug': 'private'} if i % 2 else None,
+            'site': {'id': 1, 'name': 'R89'} if i % 3 else None,
+            'description': f'subnet-{i}',
+            'custom_fields': {
+                'aq_name': f'aq-subnet-{i}' if i % 10 == 0 else None,
+                'gateway_ip': {'address': f'{address + 1}/28'} if i % 4 else None,
+            },
+            'children': 0,
+            'status': {'value': 'active', 'label': 'Active'},
+            'last_updated': '2024-01-01T00:00:00Z',
+        })
+    return prefixes
+
+
+def make_physical_device(interface_count):
+    """
+    A chassis with interface_count ports, of which one in five has a MAC address.
+    The first two ports are members of a LAG and the first port is bootable, all ports with a MAC have an address.
+    """
+    device = {
+        'id': 1,
+        'name': 'bench-chassis',
+        'tags': [],
+        'custom_fields': {},
+        'site': {'id': 1, 'slug': 'r89'},
+        'rack': {'id': 1, 'name': 'Rack 1'},
+        'device_type': {'id': 1, 'slug': 'bench-chassis'},
+        'device_role': {'id': 1, 'slug': 'hypervisor'},
+        'tenant': {'id': 1, 'slug': 'tier1'},
+        'primary_ip4': {'id': 1, 'address': '172.16.0.1/16', 'dns_name': 'bench-chassis.example.org'},
+    }
+    interfaces = [{
+        'id': 1,
+        'name': 'bond0',
+        'type': {'value': 'lag', 'label': 'Link Aggregation Group (LAG)'},
+        'mac_address': None,
+        'mgmt_only': False,
+        'tags': [],
+        'lag': None,
+        'count_ipaddresses': 0,
+        'device': {'id': 1, 'name': 'bench-chassis'},
+    }]
+    addresses = []
+    for i in range(interface_count):
+        interface_id = i + 2
+        mac_address = None
+        if i % 5 == 0:
+            mac_address = ':'.join(f'{b:02x}' for b in (0x02, 0, 0, (i >> 16) & 255, (i >> 8) & 255, i & 255))
+        interfaces.append({
+            'id': interface_id,
+            'name': f'eth{i}',
+            'type': {'value': '25gbase-x-sfp28', 'label': 'SFP28 (25GE)'},
+            'mac_address': mac_address,
+            'mgmt_only': False,
+            'tags': [{'id': 1, 'slug': 'bootable'}] if i == 0 else [],
+            'lag': {'id': 1, 'name': 'bond0'} if i < 2 else None,
+            'count_ipaddresses': 1 if mac_address else 0,
+            'device': {'id': 1, 'name': 'bench-chassis'},
+        })
+        if mac_address:
+            address = ipaddress.IPv4Address('172.16.0.2') + i
+            addresses.append({
+                'id': len(addresses) + 1,
+                'address': f'{address}/16',
+                'dns_name': f'eth{i}.bench-chassis.example.org',
+                'family': {'value': 4, 'label': 'IPv4'},
+                'vrf': None,
+                'assigned_object_id': interface_id,
+                'assigned_object': {'id': interface_id, 'name': f'eth{i}'},
+            })
+    rack = {'id': 1, 'name': 'Rack 1', 'facility_id': '1', 'tags': []}
+    return device, rack, interfaces, addresses
+
+
+def make_virtual_machine(disk_count):
+    """ A virtual machine with a single interface and disk_count virtual disks """
+    virtual_machine = {
+        'id': 1,
+        'name': 'bench-vm',
+        'tags': [],
+        'custom_fields': {},
+        'cluster': {'id': 1, 'name': 'Bench Cluster'},
+        'role': {'id': 1, 'slug': 'worker'},
+        'tenant': {'id': 2, 'slug': 'cloud'},
+        'primary_ip4': {'id': 2, 'address': '172.17.0.1/16', 'dns_name': 'bench-vm.example.org'},
+        'disk': 100000,
+        'vcpus': 4,
+        'memory': 8192,
+    }
+    cluster = {'id': 1, 'name': 'Bench Cluster', 'type': {'slug': 'vmware'}, 'custom_fields': {}}
+    interfaces = [{
+        'id': 1,
+        'name': 'eth0',
+        'mac_address': '02:00:00:00:00:01',
+        'tags': [{'id': 1, 'slug': 'bootable'}],
+        'count_ipaddresses': 1,
+        'virtual_machine': {'id': 1, 'name': 'bench-vm'},
+    }]
+    disks = [
+        {'id': i + 1, 'name': f'disk{i}', 'size': 20000 + i * 1000, 'description': f'Disk {i}' if i % 2 else ''}
+        for i in range(disk_count)
+    ]
+    return virtual_machine, cluster, interfaces, disks
+
+
+class FakeNetbox(ThreadingMixIn, HTTPServer):
+    """
+        Serves lists of objects from memory, paginated and counted like the NetBox REST API.
+        Only the filters used by the lookups being measured are applied, any others are ignored, so the synthetic
+        data must only contain objects that would match them.
+    """
+    daemon_threads = True
+
+    def __init__(self, objects):
+        super().__init__(('127.0.0.1', 0), FakeNetboxHandler)
+        self.objects = objects
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.bytes = 0
+
+    def reset(self):
+        """ Reset the counters of calls and bytes sent """
+        with self.lock:
+            self.calls = 0
+            self.bytes = 0
+
+    @property
+    def url(self):
+        """ URL of the fake NetBox """
+        return f'http://127.0.0.1:{self.server_port}/'
+
+
+class FakeNetboxHandler(BaseHTTPRequestHandler):
+    """ Handle a GET of a list or a single object from FakeNetbox """
+
+    MATCHERS = {
+        'tenant': lambda obj, values: obj['tenant']['slug'] in values,
+        'family': lambda obj, values: str(obj['family']['value']) in values,
+        'type': lambda obj, values: 'type' in obj and obj['type']['value'] in values,
+        'mac_address__empty': lambda obj, values: (not obj['mac_address']) == (values[0] == 'true'),
+    }
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ Return a page of a list, or a single object if the path ends with an id """
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        if parts[-1].isdigit():
+            objects = self.server.objects.get('/'.join(parts[1:-1]), [])
+            reply = next((o for o in objects if str(o['id']) == parts[-1]), None)
+        else:
+            objects = self.server.objects.get('/'.join(parts[1:]), [])
+            for key, values in query.items():
+                if key in self.MATCHERS:
+                    objects = [o for o in objects if self.MATCHERS[key](o, values)]
+            offset = int(query.get('offset', ['0'])[0])
+            limit = int(query.get('limit', ['0'])[0]) or 50
+            results = objects[offset:offset + min(limit, MAX_PAGE_SIZE)]
+            if 'fields' in query:
+                fields = query['fields'][0].split(',')
+                results = [{k: v for k, v in o.items() if k in fields} for o in results]
+            reply = {'count': len(objects), 'next': None, 'previous': None, 'results': results}
+
+        body = json.dumps(reply).encode('utf-8')
+        with self.server.lock:
+            self.server.calls += 1
+            self.server.bytes += len(body)
+        self.send_response(200 if reply is not None else 404)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class NullExecutor():
+    """ Executor that succeeds at every aq command without running it, counting the commands it is given """
+    name = 'null'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def run(self, _):
+        """ Pretend to run a command """
+        with self.lock:
+            self.calls += 1
+        return AqResult(0, 'ok', '')
+
+    def close(self):
+        """ Nothing to close """
+
+
+def measure(results, name, func, setup=None, repeat=3, **extra):
+    """
+    Time func, called with the value returned by setup if given, keeping the fastest of repeat runs.
+    Any values returned by func in a dict are recorded alongside the time, e.g. API call counts.
+    """
+    times = []
+    recorded = {}
+    for _ in range(repeat):
+        args = setup() if setup else None
+        start = time.perf_counter()
+        recorded = func(args) or {}
+        times.append(time.perf_counter() - start)
+    results[name] = dict(extra, best=min(times), mean=sum(times) / len(times), **recorded)
+    print(f'{name:40s} {min(times) * 1000:10.1f} ms  ' + ' '.join(f'{k}={v}' for k, v in sorted(recorded.items())))
+
+
+def records(endpoint, values_list, api):
+    """ Convert raw values into pynetbox records, as returned by the REST API """
+    return [endpoint.return_obj(values, api, endpoint) for values in values_list]
+
+
+def retained_memory(build):
+    """ Bytes still allocated by build once it returns, while the value it returned is kept """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        value = build()
+        retained = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del value
+    return retained
+
+
+def bench_records(results, scale):
+    """
+    Compare building pynetbox Records with the compact records used on bulk paths, from the fields NetBox returns,
+    by the time taken and the memory held by a whole fleet's worth of objects
+    """
+    api = pynetbox.api('http://netbox.invalid/')
+    interfaces, addresses = make_physical_device(scale['interfaces'])[2:]
+    # The fleet has as many interfaces and addresses as prefixes
+    count = scale['prefixes']
+    data = {
+        'prefixes': (api.ipam.prefixes, PrefixRecord, make_prefixes(count)),
+        'interfaces': (api.dcim.interfaces, InterfaceRecord, (interfaces * (count // len(interfaces) + 1))[:count]),
+        'addresses': (api.ipam.ip_addresses, AddressRecord, (addresses * (count // len(addresses) + 1))[:count]),
+    }
+
+    for name, (endpoint, record_type, values_list) in data.items():
+        values_list = [{k: v for k, v in values.items() if k in record_type.__slots__} for values in values_list]
+        for kind, build in (
+            ('record', lambda endpoint=endpoint, values_list=values_list: records(endpoint, values_list, api)),
+            ('compact', lambda record_type=record_type, values_list=values_list: [
+                record_type.from_json(values) for values in values_list
+            ]),
+        ):
+            memory = retained_memory(build)
+            measure(results, f'records.{name}.{kind}',
+                    lambda _, build=build, memory=memory: {'objects': len(build()), 'memory_bytes': memory},
+                    repeat=scale['repeat'])
+
+
+def bench_subnetdata(results, scale):
+    """ Fetch subnets from the fake NetBox, and write every format """
+    prefixes = make_prefixes(scale['prefixes'])
+    server = FakeNetbox({'ipam/prefixes': prefixes})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        dump = NetboxDumpSubnetdata()
+        dump.netbox = pynetbox.api(server.url, token='TOKEN')
+        dump.netbox.http_session = dump._create_session()  # pylint: disable=protected-access
+
+        def fetch(_):
+            server.reset()
+            count = sum(1 for _ in dump._get_subnet_fields())  # pylint: disable=protected-access
+            return {'subnets': count, 'api_calls': server.calls, 'api_bytes': server.bytes}
+
+        measure(results, 'subnetdata.fetch', fetch, repeat=scale['repeat'], prefixes=len(prefixes))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    api = pynetbox.api('http://netbox.invalid/')
+    subnets = [
+        dump._get_prefix_fields(p)  # pylint: disable=protected-access
+        for p in records(api.ipam.prefixes, prefixes, api)
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        for formats in (['txt'], ['json'], ['txt', 'json']):
+            measure(
+                results, f'subnetdata.write.{"+".join(formats)}',
+                lambda _, formats=formats: dump.write_subnetdata(directory, formats, subnets),
+                repeat=scale['repeat'], subnets=len(subnets),
+            )
+
+    measure(results, 'subnetdata.prefix_index.build',
+            lambda _: {'networks': len(PrefixIndex.from_subnet_fields(subnets))},
+            repeat=scale['repeat'], subnets=len(subnets))
+    index = PrefixIndex.from_subnet_fields(subnets)
+    # Addresses spread over and beyond the subnets, so that some aren't found
+    base = int(ipaddress.IPv4Address('10.0.0.0'))
+    addresses = [str(ipaddress.IPv4Address(base + i * 37)) for i in range(10000)]
+    measure(results, 'subnetdata.prefix_index.lookup',
+            lambda _: {'found': sum(1 for a in addresses if index.lookup(a) is not None)},
+            repeat=scale['repeat'], lookups=len(addresses))
+
+
+def bench_lookups(results, scale):
+    """ Count and time the REST lookups needed to snapshot a large physical device """
+    device, rack, interfaces, addresses = make_physical_device(scale['interfaces'])
+    server = FakeNetbox({
+        'dcim/devices': [device],
+        'dcim/racks': [rack],
+        'dcim/interfaces': interfaces,
+        'ipam/ip-addresses': addresses,
+    })
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        netbox2aquilon = Netbox2Aquilon()
+        netbox2aquilon.netbox = pynetbox.api(server.url, token='TOKEN')
+        netbox2aquilon.netbox.http_session = netbox2aquilon._create_session()  # pylint: disable=protected-access
+        device_record = netbox2aquilon.netbox.dcim.devices.get(1)
+
+        def snapshot(_):
+            server.reset()
+            result = netbox2aquilon.get_device_snapshot(device_record)
+            return {'interfaces': len(result.interfaces), 'api_calls': server.calls, 'api_bytes': server.bytes}
+
+        measure(results, 'lookup.device_snapshot', snapshot, repeat=scale['repeat'], ports=len(interfaces))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def make_snapshots(scale, api):
+    """ Snapshots of a large physical device and a virtual machine with many disks, built without NetBox """
+    device, rack, interfaces, addresses = make_physical_device(scale['interfaces'])
+    physical = DeviceSnapshot(
+        api.dcim.devices.return_obj(device, api, api.dcim.devices),
+        rack=api.dcim.racks.return_obj(rack, api, api.dcim.racks),
+        interfaces=[i for i in records(api.dcim.interfaces, interfaces, api) if i.mac_address or i.type.value == 'lag'],
+    )
+    physical.addresses = {}
+    for address in records(api.ipam.ip_addresses, addresses, api):
+        physical.addresses.setdefault(address.assigned_object_id, []).append(address)
+    physical.device.aq_machine_name = 'netbox-1'
+
+    virtual_machine, cluster, vm_interfaces, disks = make_virtual_machine(scale['disks'])
+    virtual = DeviceSnapshot(
+        api.virtualization.virtual_machines.return_obj(virtual_machine, api, api.virtualization.virtual_machines),
+        cluster=api.virtualization.clusters.return_obj(cluster, api, api.virtualization.clusters),
+        interfaces=records(api.virtualization.interfaces, vm_interfaces, api),
+        addresses={},
+        disks=records(api.virtualization.virtual_disks, disks, api),
+    )
+    virtual.device.aq_machine_name = 'netboxvm-1'
+    return physical, virtual
+
+
+def bench_planners(results, scale):
+    """ Time the planners, dependency planning and undo for a single large device """
+    # pylint: disable=protected-access
+    api = pynetbox.api('http://netbox.invalid/')
+    netbox2aquilon = Netbox2Aquilon()
+    repeat = scale['repeat']
+
+    def setup():
+        return make_snapshots(scale, api)
+
+    def plan_physical(snapshots):
+        cmds = netbox2aquilon._netbox_copy_device(snapshots[0])
+        cmds += netbox2aquilon._netbox_copy_interfaces(snapshots[0])
+        cmds += netbox2aquilon._netbox_copy_addresses(snapshots[0])
+        return {'cmds': len(cmds)}
+
+    def plan_virtual(snapshots):
+        return {'cmds': len(netbox2aquilon._netbox_copy_vm(snapshots[1]))}
+
+    measure(results, 'plan.copy_device', lambda s: {'cmds': len(netbox2aquilon._netbox_copy_device(s[0]))},
+            setup, repeat)
+    measure(results, 'plan.copy_interfaces', lambda s: {'cmds': len(netbox2aquilon._netbox_copy_interfaces(s[0]))},
+            setup, repeat)
+    measure(results, 'plan.copy_addresses', lambda s: {'cmds': len(netbox2aquilon._netbox_copy_addresses(s[0]))},
+            setup, repeat)
+    measure(results, 'plan.copy_vm', plan_virtual, setup, repeat)
+    measure(results, 'plan.physical_total', plan_physical, setup, repeat)
+
+    physical, _ = setup()
+    cmds = netbox2aquilon._netbox_copy_device(physical) + netbox2aquilon._netbox_copy_interfaces(physical)
+    cmds += netbox2aquilon._netbox_copy_addresses(physical)
+    measure(results, 'plan.command_plan', lambda _: {'cmds': len(CommandPlan.from_cmds(cmds))}, repeat=repeat)
+    measure(results, 'plan.undo_cmds', lambda _: {'cmds': len(netbox2aquilon._undo_cmds(cmds))}, repeat=repeat)
+
+
+def bench_batch(results, scale):
+    """ Time copying a batch of hosts with pre-fetched snapshots, without running any aq commands """
+    api = pynetbox.api('http://netbox.invalid/')
+    small_scale = dict(scale, interfaces=4, disks=2)
+    opts = SimpleNamespace(
+        sandbox=None, domain='prod', archetype='ral-tier1', osname='rocky', osversion='8x-x86_64', dryrun=False,
+        reconcile=False, skip_unchanged=False, resume=False, rollback=False,
+    )
+
+    for workers in (1, 8):
+        netbox2aquilon = Netbox2Aquilon()
+        netbox2aquilon.config['aquilon']['workers'] = str(workers)
+        executor = NullExecutor()
+        netbox2aquilon._aq_executor = executor  # pylint: disable=protected-access
+
+        def setup():
+            return [make_snapshots(small_scale, api)[i % 2] for i in range(scale['hosts'])]
+
+        def copy_batch(snapshots, netbox2aquilon=netbox2aquilon, executor=executor):
+            executor.calls = 0
+            copied = sum(1 for s in snapshots if netbox2aquilon.copy_device(s.device, opts, snapshot=s))
+            return {'copied': copied, 'aq_calls': executor.calls}
+
+        measure(results, f'batch.copy_device.workers{workers}', copy_batch, setup, scale['repeat'],
+                hosts=scale['hosts'])
+
+
+def bench_startup(results, scale):
+    """ Time starting each tool in a new interpreter, as scripts that call them thousands of times a day do """
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    def run(args):
+        subprocess.run([sys.executable] + args, cwd=directory, stdout=subprocess.DEVNULL, check=True)
+
+    # The interpreter on its own, to compare the tools against
+    measure(results, 'startup.python', lambda _: run(['-c', 'pass']), repeat=scale['repeat'] * 3)
+    for module in ('scd_netbox', 'netbox2aquilon'):
+        measure(results, f'startup.import.{module}', lambda _, module=module: run(['-c', f'import {module}']),
+                repeat=scale['repeat'] * 3)
+    for script in ('netbox2aquilon', 'netbox_dump_subnetdata', 'netbox2aquilon_daemon'):
+        measure(results, f'startup.help.{script}', lambda _, script=script: run([f'{script}.py', '--help']),
+                repeat=scale['repeat'] * 3)
+    measure(results, 'startup.construct.netbox2aquilon', lambda _: Netbox2Aquilon() and None, repeat=scale['repeat'])
+
+
+def compare(results, previous):
+    """ Print the change in the best time of each benchmark since a previous run """
+    print()
+    print(f'{"benchmark":40s} {"previous":>10s} {"current":>10s} {"change":>8s}')
+    for name, result in sorted(results.items()):
+        if name in previous:
+            before = previous[name]['best']
+            print(f'{name:40s} {before * 1000:8.1f}ms {result["best"] * 1000:8.1f}ms '
+                  f'{(result["best"] - before) / before * 100:+7.1f}%')
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Benchmark NetBox lookups, subnetdata dumps, aq planners and startup.')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='quick', help='Size of the synthetic data.')
+    parser.add_argument('--output', default='benchmark-results.json', help='File to save results to.')
+    parser.add_argument('--compare', help='Results of a previous run to compare against.')
+    opts = parser.parse_args()
+
+    # Planners warn about every unusual device, which would only slow the benchmarks down
+    logging.disable(logging.CRITICAL)
+
+    scale = SCALES[opts.scale]
+    results = {}
+    bench_records(results, scale)
+    bench_subnetdata(results, scale)
+    bench_lookups(results, scale)
+    bench_planners(results, scale)
+    bench_batch(results, scale)
+    bench_startup(results, scale)
+
+    with open(opts.output, 'w', encoding='utf-8') as output:
+        json.dump({
+            'scale': opts.scale,
+            'parameters': scale,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'pynetbox': pynetbox.__version__,
+            'cpus': os.cpu_count(),
+            'results': results,
+        }, output, indent=2, sort_keys=True)
+    print(f'Results saved to {opts.output}')
+
+    if opts.compare:
+        with open(opts.compare, 'r', encoding='utf-8') as previous:
+            compare(results, json.load(previous)['results'])
+
+
+if __name__ == '__main__':
+    _main()
@@ -2,73 +2,196 @@
 
 """ netbox2aquilon - script to extract data out of netbox and use it to create aquilon entities."""
 
+# pylint: disable=too-many-lines
+
 import argparse
+import concurrent.futures
+import functools
+import json
 import logging
 import os.path
-import subprocess
 import sys
-
-import coloredlogs
-import pynetbox
-
-from scd_netbox import SCDNetbox
-
-
-class Netbox2Aquilon(SCDNetbox):
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from aq_executor import BrokerExecutor, SubprocessExecutor, is_not_found
+from aq_journal import Journal
+from aq_plan import CommandPlan, PlanStore, input_hash
+from aq_reconcile import MachineState, reconcile
+from netbox_cache import NetboxCache
+from netbox_dump_subnetdata import NetboxDumpSubnetdata
+from prefix_index import PrefixIndex
+from run_stats import add_stats_arguments, report_stats
+from scd_netbox import SCDNetbox, is_device, is_virtual_machine
+
+
+class Netbox2Aquilon(SCDNetbox):  # pylint: disable=too-many-instance-attributes
     """ Extends base SCDNetbox class with aquilon specific functionality """
+    def __init__(self, additonal_config_name=None):
+        super().__init__(additonal_config_name)
+        for option, default in [
+            ('executor', 'subprocess'),
+            ('broker_url', 'http://aquilon.example.org:6901/'),
+            ('input_xml', '/opt/aquilon/etc/input.xml'),
+            ('broker_cert_path', ''),
+            ('broker_kerberos', 'false'),
+            ('workers', '1'),
+            ('personality_ttl', '0'),
+            ('personality_refresh', '300'),
+            ('plan_dir', ''),
+            ('journal_dir', '~/.cache/scd_netbox/journal'),
+            ('validate_addresses', 'false'),
+        ]:
+            if option not in self.config['aquilon']:
+                self.config['aquilon'][option] = default
+        self._aq_executor = None
+        self._aq_pool = None
+        self._aq_lock = threading.Lock()
+        # Time each archetype was listed, and the names of its personalities or None if they couldn't be listed
+        self._personalities = {}
+        # Whether each (archetype, personality) exists, for archetypes that couldn't be listed
+        self._personality_checks = {}
+        # PlanStore that plans and applied input hashes are kept in, if any
+        self.plans = None
+        # Journal that commands are recorded in as they complete, if any
+        self.journal = None
+        # PrefixIndex of the subnets known to aquilon that addresses are checked against, if any
+        self.prefix_index = None
+
+    @property
+    def aq_executor(self):
+        """
+        Executor used to run aq commands, created on first use and kept for the rest of the run.
+        The broker executor keeps a session open to the broker, the subprocess executor is used if it can't be set up.
+        Commands are run from the threads of aq_pool, so it is only ever set up once.
+        """
+        with self._aq_lock:
+            if self._aq_executor is None:
+                self._aq_executor = self._create_aq_executor()
+        return self._aq_executor
+
+    def _create_aq_executor(self):
+        executor = SubprocessExecutor(self.config['aquilon']['cli_path'])
+        if self.config['aquilon']['executor'] == 'broker':
+            verify = True
+            if self.config['aquilon']['broker_cert_path'].lower() == 'false':
+                verify = False
+            elif self.config['aquilon']['broker_cert_path']:
+                verify = self.config['aquilon']['broker_cert_path']
+            try:
+                executor = BrokerExecutor(
+                    self.config['aquilon']['broker_url'],
+                    self.config['aquilon']['input_xml'],
+                    verify=verify,
+                    kerberos=self.config.getboolean('aquilon', 'broker_kerberos'),
+                    fallback=executor,
+                )
+            except (OSError, ImportError, ET.ParseError) as error:
+                logging.warning('Unable to set up broker session, falling back to %s: %s', executor.name, error)
+        elif self.config['aquilon']['executor'] != 'subprocess':
+            logging.warning('Unknown executor "%s", using subprocess', self.config['aquilon']['executor'])
+        return executor
+
+    @property
+    def aq_pool(self):
+        """
+        Pool of [aquilon] workers threads that the commands of plans are run on, created on first use and shared by
+        every plan for the rest of the run, so that starting threads isn't paid for each device
+        """
+        with self._aq_lock:
+            if self._aq_pool is None:
+                self._aq_pool = concurrent.futures.ThreadPoolExecutor(self.config.getint('aquilon', 'workers'))
+        return self._aq_pool
+
+    def close(self):
+        """ Shut down the pool of workers, and close the executor's session with the broker, if they were set up """
+        with self._aq_lock:
+            pool, self._aq_pool = self._aq_pool, None
+            executor, self._aq_executor = self._aq_executor, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+        if executor is not None:
+            executor.close()
 
     @classmethod
-    def get_current_sandbox(cls):
-        """ Get owner and name of sandbox if command is being run while inside one """
-        sandbox = None
-        git_rev_parse = subprocess.run(
-            ['git', 'rev-parse', '--show-toplevel'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=False,
+    def get_current_sandbox(cls, path=None):
+        """
+        Get owner and name of sandbox if command is being run while inside one.
+        The top level of the git checkout is found by looking for .git in each parent of the current directory,
+        the same as "git rev-parse --show-toplevel" but without starting git.
+        """
+        toplevel = os.getcwd() if path is None else path
+        while not os.path.exists(os.path.join(toplevel, '.git')):
+            parent = os.path.dirname(toplevel)
+            if parent == toplevel:
+                return None
+            toplevel = parent
+
+        owner = os.path.basename(os.path.dirname(toplevel))
+        name = os.path.basename(toplevel)
+        if owner and name:
+            return f'{owner}/{name}'
+        return None
+
+    def _run_aq(self, cmd):
+        """ Run an aq command with the executor, recording how long it took by command name """
+        start = time.monotonic()
+        result = self.aq_executor.run(cmd)
+        self.stats.record(
+            'aq',
+            cmd[0],
+            time.monotonic() - start,
+            len(result.stdout or '') + len(result.stderr or ''),
+            error=result.returncode != 0,
         )
-        if git_rev_parse.returncode == 0:
-            owner = os.path.basename(os.path.dirname(git_rev_parse.stdout))
-            name = os.path.basename(git_rev_parse.stdout.strip())
-            if owner and name:
-                sandbox = (owner + b'/' + name).decode('utf-8')
-        return sandbox
+        return result
 
     def _call_aq(self, cmd):
         logging.info('Calling %s', cmd[0])
         logging.debug(
             'Calling "%s %s"',
-            self.config['aquilon']['cli_path'],
+            self.aq_executor.name,
             ' '.join(cmd),
         )
-        process = subprocess.run(
-            [self.config['aquilon']['cli_path']] + cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=False,
-        )
+        result = self._run_aq(cmd)
         logging.debug(
             'Commmand "%s %s" exited with code %d',
-            self.config['aquilon']['cli_path'],
+            self.aq_executor.name,
             ' '.join(cmd),
-            process.returncode,
+            result.returncode,
         )
-        if process.stdout:
-            logging.info(process.stdout.decode('utf-8').strip())
-        if process.stderr:
-            logging.warning(process.stderr.decode('utf-8').strip())
-        if not process.stdout and not process.stderr:
+        if result.stdout:
+            logging.info(result.stdout.strip())
+        if result.stderr:
+            logging.warning(result.stderr.strip())
+        if not result.stdout and not result.stderr:
             logging.debug(
                 'Commmand "%s %s" returned no data',
-                self.config['aquilon']['cli_path'],
+                self.aq_executor.name,
                 ' '.join(cmd),
             )
             return -1
-        return process.returncode
+        return result.returncode
+
+    def _query_aq(self, cmd):
+        """ Run a read-only aq command and return its output, or None if it failed """
+        logging.debug('Querying "%s %s"', self.aq_executor.name, ' '.join(cmd))
+        result = self._run_aq(cmd)
+        if result.returncode != 0:
+            logging.debug(
+                'Commmand "%s %s" exited with code %d: %s',
+                self.aq_executor.name,
+                ' '.join(cmd),
+                result.returncode,
+                result.stderr.strip(),
+            )
+            return None
+        return result.stdout
 
-    def _call_aq_cmds(self, cmds, dryrun=False):
+    def _call_aq_cmds(self, cmds, dryrun=False, record=None):
         cmds_committed = []
-        for cmd in cmds:
+        for index, cmd in enumerate(cmds):
             if dryrun:
                 print('# aq ' + ' '.join(cmd))
             else:
@@ -76,14 +199,74 @@ class Netbox2Aquilon(SCDNetbox):
                 if retval > 0:
                     logging.error(
                         'Commmand "%s %s" exited with error code %d',
-                        self.config['aquilon']['cli_path'],
+                        self.aq_executor.name,
                         ' '.join(cmd),
                         retval,
                     )
+                    if record:
+                        record('failed', index=index, returncode=retval)
                     return cmds_committed
+                if record:
+                    record('done', index=index)
                 cmds_committed.append(cmd)
         return cmds_committed
 
+    def _call_aq_plan(self, plan, dryrun=False, record=None):
+        """
+        Run a CommandPlan, running commands whose dependencies have completed at the same time on the shared pool of
+        workers. Plans where no commands can run at the same time are run in this thread instead.
+        No new commands are started once one has failed.
+        Returns the list of commands that completed, in the order they completed.
+        If a record function is given, it is called with the index of each command as it completes or fails.
+        """
+        if dryrun or self.config.getint('aquilon', 'workers') <= 1 or plan.is_sequential():
+            return self._call_aq_cmds(plan.cmds, dryrun=dryrun, record=record)
+
+        pool = self.aq_pool
+        cmds_committed = []
+        completed = set()
+        pending = list(range(len(plan)))
+        running = {}
+        failed = False
+
+        def finish(index, retval):
+            nonlocal failed
+            if retval > 0:
+                logging.error(
+                    'Commmand "%s %s" exited with error code %d',
+                    self.aq_executor.name,
+                    ' '.join(plan.cmds[index]),
+                    retval,
+                )
+                if record:
+                    record('failed', index=index, returncode=retval)
+                failed = True
+            else:
+                if record:
+                    record('done', index=index)
+                completed.add(index)
+                cmds_committed.append(plan.cmds[index])
+
+        while True:
+            ready = [] if failed else [i for i in pending if plan.deps[i] <= completed]
+            if len(ready) == 1 and not running:
+                # Nothing to run alongside it, so handing it to the pool would only add a thread switch
+                pending.remove(ready[0])
+                finish(ready[0], self._call_aq(plan.cmds[ready[0]]))
+                continue
+            for index in ready:
+                pending.remove(index)
+                running[pool.submit(self._call_aq, plan.cmds[index])] = index
+
+            if not running:
+                break
+
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                finish(running.pop(future), future.result())
+
+        return cmds_committed
+
     def _netbox_get_device(self, opts):
         if opts.magdb_id:
             device = self.get_device_by_magdb_id(opts.magdb_id)
@@ -95,6 +278,10 @@ class Netbox2Aquilon(SCDNetbox):
             logging.error("No device specification provided")
             sys.exit(2)
 
+        return self._netbox_check_device(device)
+
+    @classmethod
+    def _netbox_check_device(cls, device):
         # check if device has a primary ip
         if device.primary_ip4 is None:
             logging.error("No primary IP defined for host")
@@ -107,11 +294,11 @@ class Netbox2Aquilon(SCDNetbox):
 
         return device
 
-    def _netbox_copy_device(self, device):
+    @classmethod
+    def _netbox_copy_device(cls, snapshot):
         cmds = []
-
-        # check if host is in rack - query netbox for rack
-        rack = self.get_rack_from_device(device)
+        device = snapshot.device
+        rack = snapshot.rack
 
         rack_delimeter = '-'  # Default naming convention for new racks
         if 'magdb2netbox' in [t.slug for t in rack.tags]:
@@ -128,7 +315,8 @@ class Netbox2Aquilon(SCDNetbox):
 
         return cmds
 
-    def _netbox_copy_vm_disks(self, virtual_machine):
+    @classmethod
+    def _netbox_copy_vm_disks(cls, snapshot):
         """
         Check if VM has any new-style virtual disks defined,
         If so, use them and set the first as bootable,
@@ -136,7 +324,8 @@ class Netbox2Aquilon(SCDNetbox):
         """
         cmds = []
 
-        virtual_disks = self.get_disks_from_device(virtual_machine)
+        virtual_machine = snapshot.device
+        virtual_disks = snapshot.disks
         if virtual_disks:
             boot = True
             for disk in virtual_disks:
@@ -170,8 +359,10 @@ class Netbox2Aquilon(SCDNetbox):
 
         return cmds
 
-    def _netbox_copy_vm(self, virtual_machine):
+    def _netbox_copy_vm(self, snapshot):
         cmds = []
+        virtual_machine = snapshot.device
+        cluster = snapshot.cluster
 
         if not virtual_machine.disk:
             logging.error('Cannot continue, virtual disk size not present.')
@@ -179,7 +370,6 @@ class Netbox2Aquilon(SCDNetbox):
 
         # Use name of cluster by default, unless another name has been specified
         cluster_name = virtual_machine.cluster.name.lower().replace(' ', '_')
-        cluster = self.netbox.virtualization.clusters.get(virtual_machine.cluster.id)
         if 'aq_name' in cluster.custom_fields:
             cluster_name = cluster.custom_fields['aq_name']
 
@@ -195,14 +385,15 @@ class Netbox2Aquilon(SCDNetbox):
             '--memory', f'{virtual_machine.memory}',
         ])
 
-        cmds += self._netbox_copy_vm_disks(virtual_machine)
+        cmds += self._netbox_copy_vm_disks(snapshot)
 
         return cmds
 
-    def _netbox_copy_interfaces(self, device):
+    @classmethod
+    def _netbox_copy_interfaces(cls, snapshot):
         cmds = []
-        interfaces = self.get_interfaces_from_device(device)
-        for interface in interfaces:
+        device = snapshot.device
+        for interface in snapshot.interfaces:
             is_boot_interface = False
             for tag in interface.tags:
                 if tag.slug == 'bootable':
@@ -248,12 +439,12 @@ class Netbox2Aquilon(SCDNetbox):
 
         return cmds
 
-    def _netbox_copy_addresses(self, device):
+    @classmethod
+    def _netbox_copy_addresses(cls, snapshot):
         cmds = []
-        interfaces = self.get_interfaces_from_device(device)
-        for interface in interfaces:
-            addresses = self.get_addresses_from_interface(interface)
-            for address in addresses:
+        device = snapshot.device
+        for interface in snapshot.interfaces:
+            for address in snapshot.addresses.get(interface.id, []):
                 # Don't add the primary IP as add_host does this
                 if address.address != device.primary_ip4.address:
                     # Remove prefix length as aquilon gets this from the network definition
@@ -289,52 +480,151 @@ class Netbox2Aquilon(SCDNetbox):
                 logging.debug('Device has no tenant, falling back to "inventory"')
 
         # Fall back to inventory personality if specific personality can't be found
-        cmd_show_personality = ['show_personality', '--archetype', archetype, '--personality', personality]
-        if self._call_aq(cmd_show_personality) != 0:
+        if not self._aq_personality_exists(archetype, personality):
             logging.warning('Personality "%s" not found, falling back to "inventory"', personality)
             personality = 'inventory'
 
         return personality
 
+    def _aq_personality_exists(self, archetype, personality):
+        """
+        Check whether a personality exists in Aquilon, using a single listing of all the personalities of the archetype.
+        If they can't be listed, each personality is checked with the broker once.
+        Listings and checks are kept in memory for [aquilon] personality_refresh seconds, so that long running
+        processes such as the daemon see personalities created after they started.
+        """
+        now = time.monotonic()
+        listed = self._personalities.get(archetype)
+        if listed is None or now - listed[0] > self.config.getint('aquilon', 'personality_refresh'):
+            listed = (now, self._aq_list_personalities(archetype))
+            self._personalities[archetype] = listed
+            for key in [k for k in self._personality_checks if k[0] == archetype]:
+                self._personality_checks.pop(key, None)
+
+        if listed[1] is None:
+            key = (archetype, personality)
+            if key not in self._personality_checks:
+                cmd_show_personality = ['show_personality', '--archetype', archetype, '--personality', personality]
+                self._personality_checks[key] = self._call_aq(cmd_show_personality) == 0
+            return self._personality_checks[key]
+
+        return personality in listed[1]
+
+    def _aq_list_personalities(self, archetype):
+        """
+        Get the set of personality names in an archetype from the broker.
+        If [aquilon] personality_ttl is set, the listing is kept on disk for that many seconds between runs.
+        """
+        cache = None
+        if self.config.getint('aquilon', 'personality_ttl') > 0:
+            cache = NetboxCache(
+                os.path.expanduser(self.config['cache']['path']),
+                self.config.getint('aquilon', 'personality_ttl'),
+            )
+            cached = cache.load('aquilon.personalities', archetype)
+            if cached and not cached[1]:
+                return set(cached[0])
+
+        output = self._query_aq(['search_personality', '--archetype', archetype])
+        if output is None:
+            logging.debug('Unable to list personalities of archetype "%s", checking them individually', archetype)
+            return None
+
+        # Output is one personality per line, qualified by archetype, i.e. "archetype/personality"
+        personalities = {line.strip().split('/')[-1] for line in output.splitlines() if line.strip()}
+        logging.debug('Found %d personalities in archetype "%s"', len(personalities), archetype)
+
+        if cache:
+            cache.store('aquilon.personalities', archetype, sorted(personalities))
+        return personalities
+
     def netbox_copy(self, opts):
         """ Copy a device from NetBox to Aquilon """
         device = self._netbox_get_device(opts)
 
-        aqdesttype = None
-        aqdestval = None
+        if self.copy_device(device, opts):
+            sys.exit(0)
+        sys.exit(1)
+
+    def get_device_snapshots(self, devices):
+        """
+        Fetch snapshots of many devices, running all of the lookups for all of the devices at the same time.
+        Returns a list in the same order as the devices, with None in place of any that could not be fetched.
+        With [netbox] backend = graphql, batches of devices are fetched with a single GraphQL query instead.
+        """
+        # pylint: disable=import-outside-toplevel
+        if self.config['netbox']['backend'] == 'graphql':
+            from scd_netbox_graphql import NetboxGraphQL
+            return NetboxGraphQL(self).get_device_snapshots(devices)
+
+        from scd_netbox_async import AsyncSCDNetbox, run_sync
+
+        return run_sync(AsyncSCDNetbox(self).get_device_snapshots(devices))
 
+    @classmethod
+    def _get_aq_destination(cls, opts):
+        """ Type and name of the sandbox or domain that hosts are copied to """
         if opts.sandbox:
-            aqdesttype = 'sandbox'
-            aqdestval = opts.sandbox
-        elif opts.domain:
-            aqdesttype = 'domain'
-            aqdestval = opts.domain
+            return 'sandbox', opts.sandbox
+        if opts.domain:
+            return 'domain', opts.domain
+        return None, None
 
+    def _name_machine(self, device):
+        """
+        Set the name of the aquilon machine of a device as device.aq_machine_name. Returns a tuple of the key of the
+        device and the planner for its machine, or None if the device can't be copied.
+        """
         # Preserve MagDB style machine naming for migrated hosts
         # Add a property to the object to store the desired aquilon machine name
         device.aq_machine_name = None
         if 'magdb2netbox' in [t.slug for t in device.tags]:
             device.aq_machine_name = f'system{device.custom_fields["magdb_system_id"]}'
 
-        if isinstance(device, pynetbox.models.dcim.Devices):
+        if is_device(device):
             if device.aq_machine_name is None:
                 device.aq_machine_name = f'netbox-{device.id}'
-            cmds = self._netbox_copy_device(device)
-        elif isinstance(device, pynetbox.models.virtualization.VirtualMachines):
+            return f'device-{device.id}', self._netbox_copy_device
+        if is_virtual_machine(device):
             if device.aq_machine_name is None:
                 device.aq_machine_name = f'netboxvm-{device.id}'
-            cmds = self._netbox_copy_vm(device)
-        else:
-            logging.error('Unsupported device type to copy "%s"', type(device))
-            sys.exit(1)
+            return f'virtualmachine-{device.id}', self._netbox_copy_vm
+
+        logging.error('Unsupported device type to copy "%s"', type(device))
+        return None
+
+    def copy_device(self, device, opts, snapshot=None):  # pylint: disable=too-many-return-statements
+        """
+        Copy a single NetBox device object to Aquilon, journaling or undoing any partial changes on failure.
+        A snapshot of the device can be passed if it has already been fetched.
+        Returns True if the device was copied successfully.
+        """
+        aqdesttype, aqdestval = self._get_aq_destination(opts)
+
+        named = self._name_machine(device)
+        if named is None:
+            return False
+        key, copy_machine = named
+
+        # Finish or undo an earlier run that was interrupted, instead of planning again
+        result = self._continue_journal(key, opts)
+        if result is not None:
+            return result
+
+        # Fetch everything the planners need from NetBox in one go
+        if snapshot is None:
+            snapshot = self.get_device_snapshots([device])[0]
+            if snapshot is None:
+                return False
+        cmds = copy_machine(snapshot)
 
         personality = self._netbox_get_personality(device, opts.archetype)
 
         if not personality:
             logging.error('Unable to determine personality of device "%s"', type(device))
-            sys.exit(1)
+            return False
 
-        cmds.extend(self._netbox_copy_interfaces(device))
+        cmds.extend(self._netbox_copy_interfaces(snapshot))
 
         # Finally add the host to the machine
         cmds.append([
@@ -350,16 +640,212 @@ class Netbox2Aquilon(SCDNetbox):
         ])
 
         # Add additional addresses to non-primary interfaces
-        cmds.extend(self._netbox_copy_addresses(device))
+        cmds.extend(self._netbox_copy_addresses(snapshot))
+
+        digest = input_hash(cmds)
+        if opts.skip_unchanged and self.plans and self.plans.get_applied(key) == digest:
+            logging.info('%s is unchanged since it was last copied, skipping', device)
+            return True
+
+        # When reconciling, only run the commands needed to update the existing machine
+        if opts.reconcile:
+            cmds = self._reconcile_cmds(device.aq_machine_name, cmds)
+            if cmds is None:
+                logging.error('Not copying %s, as its current state in aquilon is unknown', device)
+                return False
+
+        plan = CommandPlan.from_cmds(cmds)
+        if self.plans:
+            self.plans.save(
+                key, plan,
+                device=device.name, machine=device.aq_machine_name, input_hash=digest, reconcile=opts.reconcile,
+            )
+        return self._apply_plan(key, digest, plan, dryrun=opts.dryrun)
+
+    def _apply_plan(self, key, digest, plan, dryrun=False):
+        """
+        Run the plan for a device, journaling each command as it completes,
+        and recording its input hash if it was applied successfully.
+        """
+        unknown = self._find_unknown_addresses(plan.cmds)
+        if unknown:
+            logging.error(
+                'Addresses %s of %s are not in any subnet known to aquilon, nothing was run', ', '.join(unknown), key,
+            )
+            return False
+
+        record = None
+        if self.journal and not dryrun:
+            if self.journal.incomplete(key):
+                logging.error(
+                    'An earlier run for %s was interrupted, run again with --resume to continue it or --rollback to '
+                    'undo it', key,
+                )
+                return False
+            self.journal.start(key, plan, input_hash=digest)
+            record = functools.partial(self.journal.record, key)
+
+        success = self._execute_plan(plan, dryrun=dryrun, record=record)
+        if success and not dryrun and self.plans:
+            self.plans.set_applied(key, digest)
+        return success
+
+    def get_prefix_index(self):
+        """
+        Build an index of the subnets that netbox_dump_subnetdata exports to aquilon, sharing its state file so that
+        only prefixes changed since it was last updated are fetched from NetBox.
+        """
+        subnetdata = NetboxDumpSubnetdata()
+        subnetdata.netbox = self.netbox
+        index = PrefixIndex.from_subnet_fields(subnetdata.get_subnet_fields_incremental())
+        logging.debug('Indexed %d subnets', len(index))
+        return index
+
+    def _find_unknown_addresses(self, cmds):
+        """
+        Addresses set by commands that aren't in any indexed subnet, which aquilon would reject.
+        Only subnets of the Global VRF are indexed, so addresses in another network environment aren't checked.
+        """
+        if self.prefix_index is None:
+            return []
+        unknown = []
+        for cmd in cmds:
+            if '--network_environment' in cmd:
+                continue
+            if cmd[0] in ('add_host', 'add_interface_address') and '--ip' in cmd[:-1]:
+                address = cmd[cmd.index('--ip') + 1]
+                if self.prefix_index.lookup(address) is None:
+                    unknown.append(address)
+        return unknown
+
+    def _continue_journal(self, key, opts):
+        """
+        Resume or roll back the plan for a device that was interrupted in an earlier run, as chosen with --resume or
+        --rollback. Returns None if there is nothing to resume, and the device should be planned as normal.
+        Resuming starts from the first command that didn't complete, which is usually the one that failed.
+        """
+        state = self.journal.incomplete(key) if self.journal and (opts.resume or opts.rollback) else None
+        if state is None:
+            if opts.rollback:
+                logging.info('Nothing to roll back for %s', key)
+                return True
+            return None
+
+        if opts.rollback:
+            return self._rollback_journal(key, state, dryrun=opts.dryrun)
+
+        plan = state['plan']
+        remaining = [i for i in range(len(plan)) if i not in state['done']]
+        logging.info('Resuming %s after %d of %d commands completed', key, len(state['done']), len(plan))
+
+        def record(event, **fields):
+            # Journal entries refer to commands by their index in the original plan
+            if 'index' in fields:
+                fields['index'] = remaining[fields['index']]
+            self.journal.record(key, event, **fields)
+
+        success = self._execute_plan(
+            CommandPlan(
+                [plan.cmds[i] for i in remaining],
+                [{remaining.index(d) for d in plan.deps[i] if d in remaining} for i in remaining],
+            ),
+            dryrun=opts.dryrun,
+            record=None if opts.dryrun else record,
+            completed=len(state['done']),
+        )
+        if success and not opts.dryrun and self.plans:
+            self.plans.set_applied(key, state['input_hash'])
+        return success
+
+    def _rollback_journal(self, key, state, dryrun=False):
+        """ Undo the commands of an interrupted plan that completed, in the reverse order to which they completed """
+        cmds_undo = self._undo_cmds([state['plan'].cmds[i] for i in state['done']])
+        logging.info('Rolling back %d commands for %s', len(cmds_undo), key)
+
+        cmds_undone = self._call_aq_cmds(cmds_undo, dryrun=dryrun)
+        if dryrun:
+            return True
+
+        if cmds_undone != cmds_undo:
+            logging.error('Unable to undo all commands for %s, %d of %d were undone', key, len(cmds_undone),
+                          len(cmds_undo))
+            return False
+
+        self.journal.record(key, 'rolled_back')
+        logging.info('All commands undone')
+        return True
 
-        cmds_executed = self._call_aq_cmds(cmds, dryrun=opts.dryrun)
+    def _reconcile_cmds(self, machine, cmds):
+        """
+        Reduce the commands that would copy a machine from scratch to those needed to update it from its current state
+        in Aquilon, or return them all if the machine doesn't exist yet. Returns None if the state can't be read, e.g.
+        because the broker can't be reached.
+        Only the commands that add things can be undone if one of these fails.
+        """
+        result = self._run_aq(['show_machine', '--machine', machine, '--format', 'json'])
+        if result.returncode != 0:
+            if is_not_found(result):
+                logging.info('Machine %s not found in aquilon, copying everything', machine)
+                return cmds
+            logging.error(
+                'Unable to read the state of machine %s from aquilon, exited with code %d: %s',
+                machine, result.returncode, (result.stderr or '').strip(),
+            )
+            return None
+
+        try:
+            current = MachineState.from_aq(json.loads(result.stdout))
+        except (ValueError, KeyError, IndexError, TypeError) as error:
+            logging.error('Unable to read the state of machine %s from aquilon: %s', machine, error)
+            return None
+
+        cmds = reconcile(current, MachineState.from_cmds(cmds))
+        logging.debug('Commands needed to reconcile %s: %s', machine, cmds)
+        return cmds
+
+    def _execute_plan(self, plan, dryrun=False, record=None, completed=0):
+        """
+        Run a CommandPlan, returns True on success. If a command fails, any commands that completed are undone,
+        unless a record function is given to journal them, when they are left to be resumed or rolled back later.
+        completed is the number of commands of the journaled plan that already completed in an earlier run, if none
+        have completed when a command fails the journal is closed, as there is nothing to resume or roll back.
+        """
+        if not plan:
+            logging.info('Nothing to do')
+            if record:
+                record('finished')
+            return True
+
+        cmds_executed = self._call_aq_plan(plan, dryrun=dryrun, record=record)
+
+        if dryrun:
+            return True
+
+        if len(cmds_executed) == len(plan):
+            if record:
+                record('finished')
+            return True
+
+        if record and not cmds_executed and not completed:
+            logging.error('Command failed before any commands completed, nothing was changed')
+            record('rolled_back')
+            return False
+
+        if record:
+            logging.error(
+                'Command failed after %d of %d commands completed, run again with --resume to continue once the '
+                'cause is fixed, or --rollback to undo them', len(cmds_executed), len(plan),
+            )
+            return False
 
+        self._undo_executed(cmds_executed)
+        return False
+
+    def _undo_executed(self, cmds_executed):
+        """ Undo the commands of a plan that completed before one failed """
         if not cmds_executed:
             logging.error('All commands failed, nothing to undo')
-            sys.exit(1)
-
-        if cmds_executed == cmds:
-            sys.exit(0)
+            return
 
         logging.error('Command failed, attempting to undo changes')
         logging.debug('Commands executed: %s', cmds_executed)
@@ -367,16 +853,153 @@ class Netbox2Aquilon(SCDNetbox):
         cmds_undo = self._undo_cmds(cmds_executed)
         logging.debug('Commands to run: %s', cmds_undo)
 
-        cmds_undone = self._call_aq_cmds(cmds_undo, dryrun=opts.dryrun)
+        cmds_undone = self._call_aq_cmds(cmds_undo)
         logging.debug('Commands undone: %s', cmds_undone)
 
         if cmds_undone == cmds_undo:
             logging.info('All commands undone')
-            sys.exit(1)
+        else:
+            logging.error('Unable to undo all commands')
+
+    def _netbox_get_batch(self, opts):
+        """
+        Generate (name, lookup) pairs for every host in a batch run.
+        Lookups are deferred so that a failure to find one host does not prevent the rest from being copied.
+        """
+        if opts.hostlist:
+            if opts.hostlist == '-':
+                lines = sys.stdin.readlines()
+            else:
+                with open(opts.hostlist, 'r', encoding='utf-8') as hostlist:
+                    lines = hostlist.readlines()
+            hostnames = [line.split('#', 1)[0].strip() for line in lines]
+            hostnames = [hostname for hostname in hostnames if hostname]
+            # Look all of the hosts up at once, rather than one at a time
+            devices, _, ambiguous = self.resolve_hostnames(hostnames)
+            for hostname in hostnames:
+                yield hostname, lambda hostname=hostname: self._get_resolved_device(hostname, devices, ambiguous)
+        elif opts.select:
+            filters = self._parse_selector(opts.select)
+            devices = list(self.netbox.dcim.devices.filter(**filters))
+            if 'rack_id' not in filters:
+                # Virtual machines can't be in racks, so only include them when not selecting by rack
+                devices += list(self.netbox.virtualization.virtual_machines.filter(**filters))
+            for device in devices:
+                yield device.name, lambda device=device: device
 
-        logging.error('Unable to undo all commands')
+    @classmethod
+    def _get_resolved_device(cls, hostname, devices, ambiguous):
+        """ Device of a hostname resolved by resolve_hostnames, exiting with an error if it wasn't resolved """
+        if hostname in devices:
+            return devices[hostname]
+        if hostname in ambiguous:
+            logging.error("Got multiple IPs for hostname %s", hostname)
+        else:
+            logging.error("Hostname %s not found in NetBox", hostname)
         sys.exit(1)
 
+    @classmethod
+    def _parse_selector(cls, selector):
+        """ Convert a list of key=value selector terms into NetBox API filters """
+        filter_map = {
+            'tenant': 'tenant',
+            'site': 'site',
+            'tag': 'tag',
+            'rack': 'rack_id',
+        }
+        filters = {}
+        for term in selector:
+            key, _, value = term.partition('=')
+            if key not in filter_map or not value:
+                logging.error('Invalid selector "%s", expected one of %s', term, ', '.join(
+                    k + '=<value>' for k in filter_map
+                ))
+                sys.exit(2)
+            filters.setdefault(filter_map[key], []).append(value)
+        return filters
+
+    def netbox_copy_batch(self, opts):
+        """
+        Copy many devices from NetBox to Aquilon in a single run, sharing the NetBox session between them.
+        Prints a summary of the result for each host and exits with an error if any host failed.
+        """
+        results = []
+        batch = list(self._netbox_get_batch(opts))
+        # Work through the batch in chunks, so that snapshots of the next few devices are fetched together
+        chunk_size = self.config.getint('netbox', 'lookup_workers') * 4
+        for chunk_start in range(0, len(batch), chunk_size):
+            chunk = []
+            for name, lookup in batch[chunk_start:chunk_start + chunk_size]:
+                try:
+                    chunk.append((name, self._netbox_check_device(lookup())))
+                except SystemExit:
+                    # Lookup errors are fatal for a single host, but not for the whole batch
+                    chunk.append((name, None))
+
+            snapshots = iter(self.get_device_snapshots([device for _, device in chunk if device is not None]))
+
+            for name, device in chunk:
+                success = False
+                snapshot = next(snapshots) if device is not None else None
+                if snapshot is not None:
+                    logging.info('Copying %s', name)
+                    try:
+                        success = self.copy_device(device, opts, snapshot=snapshot)
+                    except SystemExit:
+                        # Planning errors are fatal for a single host, but not for the whole batch
+                        success = False
+                if not success:
+                    logging.error('Failed to copy %s', name)
+                results.append((name, success))
+
+        if not results:
+            logging.error('No hosts found to copy')
+            sys.exit(1)
+
+        self._exit_with_summary(results, 'hosts copied')
+
+    def netbox_replay(self, opts):
+        """
+        Run plans saved by an earlier run with --plan-dir, in the order given, without querying NetBox.
+        Prints a summary of the result for each plan and exits with an error if any plan failed.
+        """
+        results = []
+        for filename in opts.replay:
+            try:
+                details, plan = PlanStore.load(filename)
+            except (OSError, ValueError, KeyError, TypeError) as error:
+                logging.error('Unable to read plan %s: %s', filename, error)
+                results.append((filename, False))
+                continue
+
+            name = details.get('device', details['key'])
+            result = self._continue_journal(details['key'], opts)
+            if result is not None:
+                results.append((name, result))
+                continue
+
+            if opts.skip_unchanged and self.plans and self.plans.get_applied(details['key']) == details['input_hash']:
+                logging.info('%s is unchanged since it was last copied, skipping', name)
+                results.append((name, True))
+                continue
+
+            logging.info('Replaying plan for %s from %s', name, time.ctime(details['created']))
+            results.append((name, self._apply_plan(details['key'], details['input_hash'], plan, dryrun=opts.dryrun)))
+
+        self._exit_with_summary(results, 'plans replayed')
+
+    @classmethod
+    def _exit_with_summary(cls, results, description):
+        """ Print the result of each of a list of (name, success) pairs, exiting with an error if any failed """
+        failed = [name for name, success in results if not success]
+        for name, success in results:
+            print(f'{"OK" if success else "FAILED":6s} {name}')
+        print(f'{len(results) - len(failed)} of {len(results)} {description} successfully')
+
+        if failed:
+            sys.exit(1)
+        sys.exit(0)
+
     @classmethod
     def _undo_cmds(cls, cmds_run):
         cmds_undone = []
@@ -405,11 +1028,8 @@ class Netbox2Aquilon(SCDNetbox):
         return cmds_undone
 
 
-def _main():
-    logging.basicConfig(format='%(levelname)s: %(message)s')
-
-    netbox2aquilon = Netbox2Aquilon(additonal_config_name='netbox2aquilon')
-
+def _parse_args(netbox2aquilon):
+    """ Parse the command line, using the config of a Netbox2Aquilon object for defaults """
     parser = argparse.ArgumentParser()
 
     aqdest = parser.add_mutually_exclusive_group()
@@ -435,6 +1055,21 @@ def _main():
         "--magdb_id", "-m",
         help="MagDB system ID of host to copy from Netbox.",
     )
+    hostid.add_argument(
+        "--hostlist", "-l",
+        help="File of fully qualified domain names of hosts to copy from Netbox, one per line. Use - for stdin.",
+    )
+    hostid.add_argument(
+        "--select", nargs='+', metavar='KEY=VALUE',
+        help=(
+            "Copy all devices and virtual machines matching a NetBox selector. "
+            "Valid keys are tenant, site and tag (slugs) and rack (ID), keys may be repeated."
+        ),
+    )
+    hostid.add_argument(
+        "--replay", nargs='+', metavar='PLAN',
+        help="Run plans saved by an earlier run with --plan-dir, without querying NetBox.",
+    )
 
     parser.add_argument(
         "--archetype", "-a", default=netbox2aquilon.config['aquilon']['archetype'],
@@ -457,6 +1092,54 @@ def _main():
             netbox2aquilon.config['aquilon']['osversion']
         ),
     )
+    parser.add_argument(
+        "--workers", "-w", type=int, default=netbox2aquilon.config.getint('aquilon', 'workers'),
+        help=(
+            "Number of independent aq commands to run at the same time. Default: " +
+            netbox2aquilon.config['aquilon']['workers']
+        ),
+    )
+    parser.add_argument(
+        "--reconcile", action='store_true',
+        help=(
+            "Update machines that already exist in aquilon, only running the commands needed to match NetBox. "
+            "Machines that don't exist are copied as normal."
+        ),
+    )
+    parser.add_argument(
+        "--plan-dir", default=netbox2aquilon.config['aquilon']['plan_dir'],
+        help=(
+            "Directory to save the plan for each host to, as JSON that can be replayed later with --replay. "
+            "The NetBox inputs of each host successfully copied are also recorded there for --skip-unchanged."
+        ),
+    )
+    journal = parser.add_mutually_exclusive_group()
+    journal.add_argument(
+        "--resume", action='store_true',
+        help=(
+            "Continue runs for these hosts that failed part way through from the first command that didn't complete, "
+            "instead of planning them again. Hosts without an interrupted run are copied as normal."
+        ),
+    )
+    journal.add_argument(
+        "--rollback", action='store_true',
+        help="Undo the commands that completed in runs for these hosts that failed part way through.",
+    )
+    parser.add_argument(
+        "--skip-unchanged", action='store_true',
+        help=(
+            "Skip hosts whose NetBox inputs haven't changed since they were last copied successfully. "
+            "Requires --plan-dir."
+        ),
+    )
+    parser.add_argument(
+        "--validate-addresses", action='store_true',
+        default=netbox2aquilon.config.getboolean('aquilon', 'validate_addresses'),
+        help=(
+            "Check every address is in a subnet exported to aquilon by netbox_dump_subnetdata before running any "
+            "commands for a host."
+        ),
+    )
     parser.add_argument(
         "--dryrun", action='store_true',
         help="Do not do anything to aquilon, instead print what would be done",
@@ -465,8 +1148,18 @@ def _main():
         "--debug", action='store_true',
         help="Set logging level to debug.",
     )
+    add_stats_arguments(parser)
     opts, _ = parser.parse_known_args()
+    return opts
+
 
+def _main():
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+
+    netbox2aquilon = Netbox2Aquilon(additonal_config_name='netbox2aquilon')
+    opts = _parse_args(netbox2aquilon)
+
+    import coloredlogs  # pylint: disable=import-outside-toplevel
     coloredlogs.install(fmt='%(levelname)7s: %(message)s')
 
     if opts.debug:
@@ -479,7 +1172,32 @@ def _main():
         if not opts.sandbox:
             opts.domain = netbox2aquilon.config['aquilon']['domain']
 
-    netbox2aquilon.netbox_copy(opts)
+    netbox2aquilon.config['aquilon']['workers'] = str(opts.workers)
+
+    if netbox2aquilon.config['aquilon']['journal_dir']:
+        netbox2aquilon.journal = Journal(os.path.expanduser(netbox2aquilon.config['aquilon']['journal_dir']))
+    elif opts.resume or opts.rollback:
+        logging.error('--resume and --rollback require [aquilon] journal_dir to be set')
+        sys.exit(2)
+
+    if opts.plan_dir:
+        netbox2aquilon.plans = PlanStore(os.path.expanduser(opts.plan_dir))
+    elif opts.skip_unchanged:
+        logging.error('--skip-unchanged requires --plan-dir, or [aquilon] plan_dir to be set')
+        sys.exit(2)
+
+    try:
+        if opts.validate_addresses:
+            netbox2aquilon.prefix_index = netbox2aquilon.get_prefix_index()
+        if opts.replay:
+            netbox2aquilon.netbox_replay(opts)
+        elif opts.hostlist or opts.select:
+            netbox2aquilon.netbox_copy_batch(opts)
+        else:
+            netbox2aquilon.netbox_copy(opts)
+    finally:
+        netbox2aquilon.close()
+        report_stats(netbox2aquilon.stats, opts)
 
 
 if __name__ == "__main__":
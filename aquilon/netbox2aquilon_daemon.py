@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+"""
+    netbox2aquilon_daemon - service that keeps aquilon in sync with NetBox as changes are made, using NetBox webhooks.
+
+    Configure a NetBox webhook for devices, virtual machines, interfaces, IP addresses and virtual disks to POST to this
+    service, with the same secret as [webhook] secret. Changes are collected per device for [webhook] debounce seconds,
+    so that a burst of edits to one device results in a single sync, which only runs the aq commands needed to bring
+    the machine up to date.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os.path
+import signal
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from aq_plan import PlanStore
+from netbox2aquilon import Netbox2Aquilon
+from run_stats import add_stats_arguments, report_stats
+
+
+def get_device_key(payload):
+    """
+    Find the device or virtual machine affected by a webhook payload, returns a tuple of the model and id,
+    or None if the change doesn't affect a device that can be synced.
+    """
+    model = payload.get('model')
+    data = payload.get('data') or {}
+
+    if model in ('device', 'virtualmachine'):
+        return model, data.get('id')
+    if model == 'interface' and data.get('device'):
+        return 'device', data['device']['id']
+    if model in ('vminterface', 'virtualdisk') and data.get('virtual_machine'):
+        return 'virtualmachine', data['virtual_machine']['id']
+    if model == 'ipaddress' and data.get('assigned_object'):
+        assigned_object = data['assigned_object']
+        if assigned_object.get('device'):
+            return 'device', assigned_object['device']['id']
+        if assigned_object.get('virtual_machine'):
+            return 'virtualmachine', assigned_object['virtual_machine']['id']
+    return None
+
+
+def verify_signature(secret, body, signature):
+    """ Check the X-Hook-Signature header NetBox sends, the HMAC-SHA512 of the body using the webhook secret """
+    expected = hmac.new(secret.encode('utf-8'), body, hashlib.sha512).hexdigest()
+    return hmac.compare_digest(expected, signature or '')
+
+
+class SyncQueue():
+    """
+        Queue of devices waiting to be synced, a device is only handed out once no more changes to it have been queued
+        for the debounce delay, and never to more than one worker at a time. Changes queued for a device while it is
+        being synced cause it to be synced again afterwards.
+        Deadlines are measured with clock, which can be replaced to control time in tests.
+    """
+    def __init__(self, debounce, clock=time.monotonic):
+        self.debounce = debounce
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.running = set()
+        self.closed = False
+        self.draining = False
+
+    def put(self, key):
+        """ Queue a device to be synced, replacing its deadline if it is already queued """
+        with self.condition:
+            self.pending[key] = self.clock() + self.debounce
+            self.condition.notify_all()
+
+    def get(self, block=True):
+        """
+        Wait for a device that is ready to be synced, returns None once the queue has been closed, or straight away if
+        block is False and no device is ready
+        """
+        with self.condition:
+            while not self.closed or (self.draining and self.pending):
+                now = self.clock()
+                ready = [
+                    k for k, deadline in self.pending.items()
+                    if (deadline <= now or self.draining) and k not in self.running
+                ]
+                if ready:
+                    key = min(ready, key=self.pending.get)
+                    del self.pending[key]
+                    self.running.add(key)
+                    return key
+                if not block:
+                    return None
+                waiting = [deadline for k, deadline in self.pending.items() if k not in self.running]
+                self.condition.wait(max(min(waiting) - now, 0) if waiting else None)
+            return None
+
+    def done(self, key):
+        """ Mark a device as no longer being synced """
+        with self.condition:
+            self.running.discard(key)
+            self.condition.notify_all()
+
+    def close(self, drain=False):
+        """
+        Stop handing out devices, waking any waiting workers. With drain, devices that are already queued are still
+        handed out, without waiting for their debounce delay, and workers are only released once there are none left.
+        """
+        with self.condition:
+            self.closed = True
+            self.draining = drain
+            self.condition.notify_all()
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    """ Receives NetBox webhooks, queueing the devices they affect """
+    daemon_threads = True
+
+    def __init__(self, address, queue, secret=None):
+        super().__init__(address, WebhookHandler)
+        self.queue = queue
+        self.secret = secret
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """ Handle a single webhook request from NetBox """
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """ Queue the device affected by a change, replying before it is synced """
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.server.secret and not verify_signature(
+            self.server.secret, body, self.headers.get('X-Hook-Signature'),
+        ):
+            logging.warning('Rejected webhook from %s with an invalid signature', self.client_address[0])
+            self._reply(403)
+            return
+
+        try:
+            payload = json.loads(body.decode('utf-8'))
+            key = get_device_key(payload)
+        except (ValueError, TypeError, AttributeError, KeyError) as error:
+            logging.warning('Rejected invalid webhook from %s: %s', self.client_address[0], error)
+            self._reply(400)
+            return
+
+        if key is None or key[1] is None:
+            logging.debug('Ignoring %s of %s', payload.get('event'), payload.get('model'))
+            self._reply(204)
+            return
+
+        if payload.get('event') == 'deleted' and payload.get('model') == key[0]:
+            # Removing machines from aquilon is left to people
+            logging.warning('%s %s was deleted from NetBox, it must be removed from aquilon by hand', *key)
+            self._reply(204)
+            return
+
+        logging.debug('Queueing %s %s after %s of %s', *key, payload.get('event'), payload.get('model'))
+        self.server.queue.put(key)
+        self._reply(202)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        logging.debug(*args)
+
+
+class Netbox2AquilonDaemon():
+    """
+        Syncs devices queued by the webhook server with a pool of workers, sharing a single Netbox2Aquilon object so
+        that NetBox and broker connections and caches stay warm between changes.
+    """
+    def __init__(self, netbox2aquilon, opts, workers=4, debounce=5.0):
+        self.netbox2aquilon = netbox2aquilon
+        self.opts = opts
+        self.queue = SyncQueue(debounce)
+        self.workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        # Set up the executors before they can be shared between workers
+        _ = netbox2aquilon.aq_executor
+        _ = netbox2aquilon.lookup_executor
+
+    def sync(self, key):
+        """ Sync a single device or virtual machine to aquilon, returns True on success """
+        model, obj_id = key
+        start = time.monotonic()
+        success = False
+        try:
+            if model == 'device':
+                device = self.netbox2aquilon.netbox.dcim.devices.get(obj_id)
+            else:
+                device = self.netbox2aquilon.netbox.virtualization.virtual_machines.get(obj_id)
+            if device is None:
+                logging.error('%s %s not found in NetBox', model, obj_id)
+            else:
+                logging.info('Syncing %s', device)
+                success = self.netbox2aquilon.copy_device(
+                    self.netbox2aquilon._netbox_check_device(device), self.opts,  # pylint: disable=protected-access
+                )
+        except SystemExit:
+            # Errors that would end a single copy are logged, and only fail this device
+            success = False
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('Unexpected error syncing %s %s', model, obj_id)
+            success = False
+
+        self.netbox2aquilon.stats.record('sync', model, time.monotonic() - start, error=not success)
+        if not success:
+            logging.error('Failed to sync %s %s', model, obj_id)
+        return success
+
+    def _worker(self):
+        while True:
+            key = self.queue.get()
+            if key is None:
+                return
+            try:
+                self.sync(key)
+            finally:
+                self.queue.done(key)
+
+    def serve(self, address, secret=None):
+        """
+        Receive webhooks and sync the devices they affect until interrupted.
+        On SIGTERM no more webhooks are accepted, and the devices already queued are synced before returning.
+        Must be called from the main thread, so that the signal handler can be installed.
+        """
+        server = WebhookServer(address, self.queue, secret)
+        terminated = threading.Event()
+
+        def terminate(signum, _):
+            logging.info('Received signal %d, syncing queued devices before stopping', signum)
+            terminated.set()
+            # shutdown waits for serve_forever to return, which can't happen while this handler is interrupting it
+            threading.Thread(target=server.shutdown).start()
+
+        previous_handler = signal.signal(signal.SIGTERM, terminate)
+        for worker in self.workers:
+            worker.start()
+        logging.info('Listening for webhooks on %s:%d', *server.server_address[:2])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+            server.server_close()
+            self.queue.close(drain=terminated.is_set())
+            for worker in self.workers:
+                worker.join()
+
+
+def _main():
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+
+    netbox2aquilon = Netbox2Aquilon(additonal_config_name='netbox2aquilon')
+    if 'webhook' not in netbox2aquilon.config:
+        netbox2aquilon.config['webhook'] = {}
+    for option, default in [
+        ('listen', '127.0.0.1'),
+        ('port', '8642'),
+        ('secret', ''),
+        ('debounce', '5'),
+        ('workers', '4'),
+    ]:
+        if option not in netbox2aquilon.config['webhook']:
+            netbox2aquilon.config['webhook'][option] = default
+    config = netbox2aquilon.config
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n', 1)[0])
+    parser.add_argument(
+        "--listen", default=config['webhook']['listen'],
+        help="Address to listen for webhooks on. Default: " + config['webhook']['listen'],
+    )
+    parser.add_argument(
+        "--port", type=int, default=config.getint('webhook', 'port'),
+        help="Port to listen for webhooks on. Default: " + config['webhook']['port'],
+    )
+    parser.add_argument(
+        "--workers", "-w", type=int, default=config.getint('webhook', 'workers'),
+        help="Number of devices to sync at the same time. Default: " + config['webhook']['workers'],
+    )
+    parser.add_argument(
+        "--debounce", type=float, default=config.getfloat('webhook', 'debounce'),
+        help="Seconds to wait for further changes to a device before syncing it. Default: " +
+        config['webhook']['debounce'],
+    )
+    parser.add_argument(
+        "--domain", default=config['aquilon']['domain'],
+        help="Aquilon domain to create hosts in. Default: " + config['aquilon']['domain'],
+    )
+    parser.add_argument(
+        "--archetype", default=config['aquilon']['archetype'],
+        help="Archetype of new hosts. Default: " + config['aquilon']['archetype'],
+    )
+    parser.add_argument(
+        "--osname", default=config['aquilon']['osname'],
+        help="Name of the Operating system on new hosts. Default: " + config['aquilon']['osname'],
+    )
+    parser.add_argument(
+        "--osversion", default=config['aquilon']['osversion'],
+        help="Version of the Operating system on new hosts. Default: " + config['aquilon']['osversion'],
+    )
+    parser.add_argument(
+        "--dryrun", action='store_true',
+        help="Do not do anything to aquilon, instead print what would be done",
+    )
+    add_stats_arguments(parser)
+    parser.add_argument(
+        "--debug", action='store_true',
+        help="Set logging level to debug.",
+    )
+    opts = parser.parse_args()
+    opts.sandbox = None
+    opts.reconcile = True
+    opts.skip_unchanged = False
+    opts.resume = False
+    opts.rollback = False
+
+    import coloredlogs  # pylint: disable=import-outside-toplevel
+    coloredlogs.install(fmt='%(asctime)s %(levelname)7s: %(message)s')
+    if opts.debug:
+        coloredlogs.set_level(logging.DEBUG)
+
+    if not config['webhook']['secret']:
+        logging.warning('No [webhook] secret configured, webhook signatures will not be checked')
+
+    if config['aquilon']['plan_dir']:
+        netbox2aquilon.plans = PlanStore(os.path.expanduser(config['aquilon']['plan_dir']))
+
+    daemon = Netbox2AquilonDaemon(netbox2aquilon, opts, workers=opts.workers, debounce=opts.debounce)
+    try:
+        daemon.serve((opts.listen, opts.port), config['webhook']['secret'] or None)
+    finally:
+        netbox2aquilon.close()
+        report_stats(netbox2aquilon.stats, opts)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    _main()
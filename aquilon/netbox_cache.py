@@ -0,0 +1,78 @@
+"""
+    Persistent on-disk cache for slow-changing NetBox objects, shared between concurrently running tools
+"""
+
+import fcntl
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+
+
+class NetboxCache():
+    """
+        Stores JSON documents under a directory, one file per key, grouped by namespace.
+        Readers and writers of a namespace are serialised with a lock file and every write is atomic,
+        so several cron jobs and operators can safely share the same cache directory.
+    """
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+
+    def _namespace_dir(self, namespace):
+        directory = os.path.join(self.path, namespace)
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def _lock(self, namespace, exclusive):
+        # The lock is released when the caller closes the returned file
+        lock_file = open(  # pylint: disable=consider-using-with
+            os.path.join(self._namespace_dir(namespace), '.lock'), 'a', encoding='utf-8',
+        )
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return lock_file
+
+    def load(self, namespace, key):
+        """
+        Return a tuple of (value, expired) for a key, or None if it is not in the cache.
+        Expired values are still returned so that callers can revalidate them instead of fetching them again.
+        """
+        filename = os.path.join(self._namespace_dir(namespace), f'{key}.json')
+        with self._lock(namespace, exclusive=False):
+            try:
+                with open(filename, 'r', encoding='utf-8') as cache_file:
+                    entry = json.load(cache_file)
+            except FileNotFoundError:
+                return None
+            except ValueError:
+                logging.warning('Ignoring corrupt cache entry %s', filename)
+                return None
+
+        expired = time.time() - entry['stored'] > self.ttl
+        logging.debug('Cache hit for %s %s (expired: %s)', namespace, key, expired)
+        return entry['value'], expired
+
+    def store(self, namespace, key, value):
+        """ Atomically write a JSON serialisable value for a key, resetting its age """
+        directory = self._namespace_dir(namespace)
+        with self._lock(namespace, exclusive=True):
+            handle, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'w', encoding='utf-8') as cache_file:
+                    json.dump({'stored': time.time(), 'value': value}, cache_file)
+                    cache_file.flush()
+                    os.fsync(cache_file.fileno())
+                os.replace(tmp_filename, os.path.join(directory, f'{key}.json'))
+            except BaseException:
+                os.unlink(tmp_filename)
+                raise
+
+    def delete(self, namespace, key):
+        """ Remove a key from the cache, if it is there """
+        with self._lock(namespace, exclusive=True):
+            try:
+                os.unlink(os.path.join(self._namespace_dir(namespace), f'{key}.json'))
+            except FileNotFoundError:
+                pass
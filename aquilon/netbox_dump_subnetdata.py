@@ -3,15 +3,34 @@
 """ netboxdump_subnetdata """
 
 import argparse
+import fcntl
+import ipaddress
+import itertools
 import logging
 import os.path
+import time
 
 import json
 
-import coloredlogs
+from contextlib import ExitStack, contextmanager
 
+from netbox_records import PrefixRecord
+from run_stats import add_stats_arguments, report_stats
 from scd_netbox import SCDNetbox
 
+STATE_VERSION = 1
+
+# Fields of prefixes read by _get_prefix_fields, only these are requested from NetBox
+PREFIX_FIELDS = ['id', 'prefix', 'description', 'custom_fields', 'role', 'site']
+
+# Numbers the temporary files written by this process, see _open_dumpfile
+_TMP_IDS = itertools.count()
+
+
+def _prefix_network(prefix):
+    """ Sort key of prefixes, in the order NetBox returns them """
+    return ipaddress.ip_network(prefix.prefix)
+
 
 class NetboxDumpSubnetdata(SCDNetbox):
     """ Extends base SCDNetbox class with functionality to dump subnets to a file """
@@ -19,75 +38,307 @@ class NetboxDumpSubnetdata(SCDNetbox):
         super().__init__()
         if 'dump_subnetdata' not in self.config:
             self.config['dump_subnetdata'] = {}
-        if 'tenants' not in self.config['dump_subnetdata']:
-            self.config['dump_subnetdata']['tenants'] = 'tier1,cloud,secops'
+        for option, value in {
+            'tenants': 'tier1,cloud,secops',
+            'state_file': '~/.cache/scd_netbox/subnetdata_state.json',
+            'state_max_age': '86400',
+            'clock_skew': '60',
+        }.items():
+            if option not in self.config['dump_subnetdata']:
+                self.config['dump_subnetdata'][option] = value
 
-    def _get_subnet_fields(self):
-        results = []
+    def _get_tenants(self):
+        return [t.strip() for t in self.config['dump_subnetdata']['tenants'].split(',')]
+
+    @classmethod
+    def _get_prefix_fields(cls, prefix):
+        """ Convert a NetBox prefix into the fields of a subnet """
+        subnet_name = prefix.description
+        if 'aq_name' in prefix.custom_fields and prefix.custom_fields['aq_name']:
+            subnet_name = prefix.custom_fields['aq_name']
+
+        fields = {
+            'UDF': {}
+        }
+        address, mask = prefix.prefix.split('/', 2)
+        fields['SubnetAddress'] = address
+        fields['SubnetMask'] = mask
+        fields['SubnetName'] = subnet_name
+        if prefix.role:
+            fields['UDF']['TYPE'] = prefix.role.slug
+        if prefix.site:
+            fields['UDF']['LOCATION'] = prefix.site.name
+        if 'gateway_ip' in prefix.custom_fields and prefix.custom_fields['gateway_ip']:
+            gateway_ip = prefix.custom_fields['gateway_ip']['address'].split('/', 2)[0]
+            fields['DefaultRouters'] = gateway_ip
+
+
+        if not fields['UDF']:
+            del fields['UDF']
+
+        return fields
+
+    def _get_subnet_prefixes(self, tenants):
+        """ Generate the prefixes to dump as subnets, as they are received from NetBox """
         # Get all IPv4 prefixes for configured tenants
         # Aquilon doesn't support syncing IPv6 prefixes via this method
         # We only want prefixes without child prefixes
         # Only synchronise the Global VRF which corresponds to the aquilon "internal" network environment
-        tenants = [t.strip() for t in self.config['dump_subnetdata']['tenants'].split(',')]
-        for prefix in self.netbox.ipam.prefixes.filter(tenant=tenants, family=4, children=0, vrf_id=None):
-            subnet_name = prefix.description
-            if 'aq_name' in prefix.custom_fields and prefix.custom_fields['aq_name']:
-                subnet_name = prefix.custom_fields['aq_name']
-
-            fields = {
-                'UDF': {}
-            }
-            address, mask = prefix.prefix.split('/', 2)
-            fields['SubnetAddress'] = address
-            fields['SubnetMask'] = mask
-            fields['SubnetName'] = subnet_name
-            if prefix.role:
-                fields['UDF']['TYPE'] = prefix.role.slug
-            if prefix.site:
-                fields['UDF']['LOCATION'] = prefix.site.name
-            if 'gateway_ip' in prefix.custom_fields and prefix.custom_fields['gateway_ip']:
-                gateway_ip = prefix.custom_fields['gateway_ip']['address'].split('/', 2)[0]
-                fields['DefaultRouters'] = gateway_ip
-
-
-            if not fields['UDF']:
-                del fields['UDF']
-
-            results.append(fields)
-        return results
-
-    def write_subnetdata_txt(self, directory):
+        # Each tenant is fetched by a separate query, all running at the same time, and NetBox returns each of them in
+        # network order, so they are merged into network order to match the incremental dump
+        return self.fetch_all(
+            self.netbox.ipam.prefixes, split_by='tenant', merge_key=_prefix_network,
+            fields=PREFIX_FIELDS, record_type=PrefixRecord, tenant=tenants, family=4, children=0, vrf_id=None,
+        )
+
+    def _get_subnet_fields(self):
+        """ Generate the fields of each subnet as prefixes are received from NetBox, without holding them all """
+        for prefix in self._get_subnet_prefixes(self._get_tenants()):
+            yield self._get_prefix_fields(prefix)
+
+    @classmethod
+    def _is_subnet(cls, prefix, tenants):
+        """ Matches the filters used by _get_subnet_prefixes, for prefixes that have already been fetched """
+        return (
+            prefix.vrf is None
+            and prefix.children == 0
+            and prefix.tenant is not None
+            and prefix.tenant.slug in tenants
+        )
+
+    def _load_state(self, state_file, tenants):
+        """ Load the subnets stored by a previous incremental dump, returns None if they can't be used """
+        try:
+            with open(state_file, 'r', encoding='utf-8') as state_fh:
+                state = json.load(state_fh)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as error:
+            logging.warning('Ignoring unreadable subnetdata state file "%s": %s', state_file, error)
+            return None
+
+        if not isinstance(state, dict) or state.get('version') != STATE_VERSION:
+            logging.warning('Ignoring subnetdata state file "%s" from a different version', state_file)
+            return None
+        if state.get('tenants') != sorted(tenants):
+            logging.info('Configured tenants have changed since the last dump')
+            return None
+        if time.time() - state['timestamp'] > self.config.getint('dump_subnetdata', 'state_max_age'):
+            # Deletions are only found from the change log, which NetBox prunes, so don't rely on it for too long
+            logging.info('Subnetdata state file "%s" is too old to be updated', state_file)
+            return None
+        return state
+
+    @classmethod
+    @contextmanager
+    def _lock_state(cls, state_file):
+        """ Hold an exclusive lock on a state file, using a lock file next to it """
+        directory = os.path.dirname(state_file)
+        os.makedirs(directory or '.', exist_ok=True)
+        with open(state_file + '.lock', 'a', encoding='utf-8') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _save_state(self, state_file, state):
+        directory, filename = os.path.split(state_file)
+        os.makedirs(directory or '.', exist_ok=True)
+        with self._open_dumpfile(directory, filename) as state_fh:
+            json.dump(state, state_fh)
+
+    def _update_subnets(self, subnets, tenants, since):
+        """
+        Apply the changes made in NetBox since a timestamp to a dict of subnet fields keyed by prefix id.
+        Creating, deleting or moving a prefix can also change whether the prefixes containing it are leaves, so they
+        are checked again along with the changed prefix.
+        """
+        since = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(since))
+        recheck = set()
+
+        for prefix in self.netbox.ipam.prefixes.filter(family=4, last_updated__gte=since):
+            previous = subnets.pop(str(prefix.id), None)
+            if previous:
+                # The prefix may have moved, so its old network is checked too
+                recheck.add(f"{previous['SubnetAddress']}/{previous['SubnetMask']}")
+            recheck.add(prefix.prefix)
+
+        # Deleted prefixes, and the old networks of prefixes that moved, including ones that weren't subnets
+        for change in self.netbox.extras.object_changes.filter(
+            changed_object_type='ipam.prefix', action=['update', 'delete'], time_after=since,
+        ):
+            if change.action.value == 'delete':
+                subnets.pop(str(change.changed_object_id), None)
+            if change.prechange_data and change.prechange_data.get('prefix'):
+                recheck.add(change.prechange_data['prefix'])
+
+        logging.debug('Checking %d prefixes changed since %s', len(recheck), since)
+        for network in sorted(recheck):
+            for prefix in self.netbox.ipam.prefixes.filter(family=4, vrf_id=None, contains=network):
+                if self._is_subnet(prefix, tenants):
+                    subnets[str(prefix.id)] = self._get_prefix_fields(prefix)
+                else:
+                    subnets.pop(str(prefix.id), None)
+
+    def get_subnet_fields_incremental(self):
+        """
+        Get the fields of all subnets, only fetching prefixes changed since the previous call from NetBox.
+        Subnets are kept in the state file between calls, if there is no usable state all prefixes are fetched.
+        Returns a list of subnet fields in the same order as _get_subnet_fields.
+        """
+        tenants = self._get_tenants()
+        state_file = os.path.expanduser(self.config['dump_subnetdata']['state_file'])
+        # Cron dumps and netbox2aquilon share the state file, only one of them may update it at a time
+        with self._lock_state(state_file):
+            state = self._load_state(state_file, tenants)
+            # Allow for the clocks of NetBox and this host not agreeing
+            started = time.time() - self.config.getint('dump_subnetdata', 'clock_skew')
+
+            if state is None:
+                logging.info('Fetching all prefixes from NetBox')
+                subnets = {}
+                for prefix in self._get_subnet_prefixes(tenants):
+                    subnets[str(prefix.id)] = self._get_prefix_fields(prefix)
+            else:
+                subnets = state['subnets']
+                self._update_subnets(subnets, tenants, state['timestamp'])
+
+            self._save_state(state_file, {
+                'version': STATE_VERSION,
+                'tenants': sorted(tenants),
+                'timestamp': started,
+                'subnets': subnets,
+            })
+
+        # NetBox orders prefixes by network, keep to the same order so full and incremental dumps are identical
+        return sorted(
+            subnets.values(),
+            key=lambda f: ipaddress.ip_network(f"{f['SubnetAddress']}/{f['SubnetMask']}"),
+        )
+
+    @classmethod
+    @contextmanager
+    def _open_dumpfile(cls, directory, filename):
+        """
+        Open a file to stream output into, which replaces the existing file once it has been completely written.
+        Consumers never see a partial file, even if fetching prefixes fails part way through.
+        Each writer uses its own temporary file, so that processes writing the same file at once can't corrupt it.
         """
+        path = os.path.join(directory, filename)
+        tmp_path = f'{path}.{os.getpid()}.{next(_TMP_IDS)}.tmp'
+        with open(tmp_path, 'x', encoding='utf-8') as dumpfile:
+            try:
+                yield dumpfile
+            except BaseException:
+                dumpfile.close()
+                os.unlink(tmp_path)
+                raise
+        os.replace(tmp_path, path)
+
+    def write_subnetdata(self, directory, formats, subnets=None):
+        """
+        Dump subnetdata in each of a list of formats, from a single pass over the subnets.
+        Subnets are fetched from NetBox unless they are passed in.
+        """
+        if subnets is None:
+            subnets = self._get_subnet_fields()
+        with ExitStack() as stack:
+            writers = []
+            for name in formats:
+                writer_class = SUBNETDATA_WRITERS[name]
+                dumpfile = stack.enter_context(self._open_dumpfile(directory, writer_class.filename))
+                writers.append(writer_class(dumpfile))
+
+            for writer in writers:
+                writer.start()
+            for fields in subnets:
+                for writer in writers:
+                    writer.write(fields)
+            for writer in writers:
+                writer.finish()
+
+    def write_subnetdata_txt(self, directory, subnets=None):
+        """ Dump subnetdata in tab separated text format, one subnet per line """
+        self.write_subnetdata(directory, ['txt'], subnets)
+
+    def write_subnetdata_json(self, directory, subnets=None):
+        """ Dump subnetdata field structure in JSON format """
+        self.write_subnetdata(directory, ['json'], subnets)
+
+
+class SubnetdataWriter():
+    """
+        Base class of the output formats of subnetdata, given one subnet at a time so output can be streamed.
+        To add a format, subclass this and add it to SUBNETDATA_WRITERS.
+    """
+    filename = None
+
+    def __init__(self, dumpfile):
+        self.dumpfile = dumpfile
+
+    def start(self):
+        """ Called before the first subnet """
+
+    def write(self, fields):
+        """ Called with the fields of each subnet, these must not be modified as they are shared between writers """
+        raise NotImplementedError
+
+    def finish(self):
+        """ Called after the last subnet """
+
+
+class SubnetdataTxtWriter(SubnetdataWriter):
+    """
         Format of subnetdata.txt:
             - Fields are separated by tabs
             - A field is a key/value pair, separated by a space
             - The value of the DefaultRouters field is a comma-separated list of IP addresses
             - The value of the UDF field is a list of "<key>=<value>" pairs, separated by ';'
-        """
-        lines = []
-        subnet_fields = self._get_subnet_fields()
-        for fields in subnet_fields:
-            if 'UDF' in fields:
-                fields['UDF'] = ';'.join([k + '=' + v for k, v in fields['UDF'].items()])
-            fields = [' '.join(pair) for pair in fields.items()]
-            fields.sort()
-            lines.append('\t'.join(fields)+'\n')
-
-        with open(os.path.join(directory, 'subnetdata.txt'), 'w', encoding='utf-8') as dumpfile:
-            dumpfile.writelines(lines)
-
-    def write_subnetdata_json(self, directory):
-        """ Dump subnetdata field structure in JSON format """
-        subnet_fields = self._get_subnet_fields()
-        with open(os.path.join(directory, 'subnetdata.json'), 'w', encoding='utf-8') as dumpfile:
-            json.dump(subnet_fields, dumpfile)
+    """
+    filename = 'subnetdata.txt'
+
+    def write(self, fields):
+        fields = dict(fields)
+        if 'UDF' in fields:
+            fields['UDF'] = ';'.join([k + '=' + v for k, v in fields['UDF'].items()])
+        fields = [' '.join(pair) for pair in fields.items()]
+        fields.sort()
+        self.dumpfile.write('\t'.join(fields)+'\n')
+
+
+class SubnetdataJsonWriter(SubnetdataWriter):
+    """
+        Dump subnetdata field structure in JSON format
+        The list is encoded one subnet at a time, giving the same output as json.dump without building the whole list.
+    """
+    filename = 'subnetdata.json'
+
+    def __init__(self, dumpfile):
+        super().__init__(dumpfile)
+        self.encoder = json.JSONEncoder()
+        self.first = True
+
+    def start(self):
+        self.dumpfile.write('[')
+
+    def write(self, fields):
+        if not self.first:
+            self.dumpfile.write(', ')
+        self.first = False
+        for chunk in self.encoder.iterencode(fields):
+            self.dumpfile.write(chunk)
+
+    def finish(self):
+        self.dumpfile.write(']')
+
+
+SUBNETDATA_WRITERS = {
+    'txt': SubnetdataTxtWriter,
+    'json': SubnetdataJsonWriter,
+}
 
 
 def _main():
     logging.basicConfig(format='%(levelname)s: %(message)s')
 
-    netbox_dump_subnetdata = NetboxDumpSubnetdata()
-
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--datarootdir",
@@ -95,28 +346,42 @@ def _main():
         required=True,
     )
     parser.add_argument(
-        "--format", action='store', default='txt', choices=['txt', 'json'],
-        help="Format of output file.",
+        "--format", nargs='+', default=['txt'], choices=sorted(SUBNETDATA_WRITERS),
+        help="Formats of output files, all are written from a single fetch of subnets.",
+    )
+    parser.add_argument(
+        "--incremental", action='store_true',
+        help="Only fetch prefixes changed since the previous incremental dump, as recorded in the state file.",
     )
     parser.add_argument(
         "--audit", action='store_true', default='false',
         help="Does nothing, only present for compatability.",
     )
+    add_stats_arguments(parser)
     parser.add_argument(
         "--debug", action='store_true',
         help="Enable debug logging.",
     )
     opts, _ = parser.parse_known_args()
 
+    import coloredlogs  # pylint: disable=import-outside-toplevel
     coloredlogs.install(fmt='%(levelname)7s: %(message)s')
 
     if opts.debug:
         coloredlogs.set_level(logging.DEBUG)
 
-    if opts.format == 'txt':
-        netbox_dump_subnetdata.write_subnetdata_txt(opts.datarootdir)
-    elif opts.format == 'json':
-        netbox_dump_subnetdata.write_subnetdata_json(opts.datarootdir)
+    netbox_dump_subnetdata = NetboxDumpSubnetdata()
+
+    try:
+        subnets = None
+        if opts.incremental:
+            subnets = netbox_dump_subnetdata.get_subnet_fields_incremental()
+
+        # Don't write the same file twice if a format is repeated
+        formats = list(dict.fromkeys(opts.format))
+        netbox_dump_subnetdata.write_subnetdata(opts.datarootdir, formats, subnets)
+    finally:
+        report_stats(netbox_dump_subnetdata.stats, opts)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,89 @@
+"""
+    Compact records of NetBox objects fetched in bulk, holding only the fields read by the planners and subnet dump.
+
+    pynetbox Records keep references to the API and endpoint, caches of their values and lazily built child records,
+    which adds up when holding every interface and address of a fleet, or every prefix. These are built directly from
+    the JSON returned by NetBox, and support the same attribute access as Records fetched with a list of fields:
+    nested objects become attributes, and reading a field that wasn't returned raises AttributeError.
+"""
+
+
+class CompactRecord():
+    """
+        Base of the compact record types, each subclass lists the fields it can hold in __slots__.
+        Fields listed in RAW_FIELDS are kept as they are in the JSON, as pynetbox does for custom_fields.
+    """
+    __slots__ = ()
+    RAW_FIELDS = ()
+    # The first of these fields that is set and not empty is used as the string form, like pynetbox Records
+    STR_FIELDS = ('name', 'label', 'display')
+
+    @classmethod
+    def from_json(cls, values):
+        """ Build a record from the JSON of an object, ignoring any fields the record type doesn't hold """
+        record = cls()
+        for field in cls.__slots__:
+            if field in values:
+                value = values[field]
+                if field not in cls.RAW_FIELDS:
+                    value = _convert(value)
+                setattr(record, field, value)
+        return record
+
+    def __str__(self):
+        for field in self.STR_FIELDS:
+            value = getattr(self, field, None)
+            if value:
+                return str(value)
+        return ''
+
+    def __repr__(self):
+        return str(self)
+
+    def __iter__(self):
+        """ Pairs of field and value of the fields that are set, so dict(record) works as it does for Records """
+        for field in self.__slots__:
+            if hasattr(self, field):
+                value = getattr(self, field)
+                if isinstance(value, CompactRecord):
+                    value = dict(value)
+                elif isinstance(value, list):
+                    value = [dict(v) if isinstance(v, CompactRecord) else v for v in value]
+                yield field, value
+
+
+class NestedRecord(CompactRecord):  # pylint: disable=too-few-public-methods
+    """ A brief object nested in another, e.g. the device of an interface, a tag, or a choice such as family """
+    __slots__ = ('id', 'name', 'slug', 'display', 'value', 'label', 'address', 'device', 'virtual_machine')
+
+
+class InterfaceRecord(CompactRecord):  # pylint: disable=too-few-public-methods
+    """ An interface of a physical device or virtual machine """
+    __slots__ = (
+        'id', 'name', 'type', 'mac_address', 'mgmt_only', 'tags', 'lag', 'count_ipaddresses', 'device',
+        'virtual_machine',
+    )
+
+
+class AddressRecord(CompactRecord):  # pylint: disable=too-few-public-methods
+    """ An IP address and the interface it is assigned to """
+    __slots__ = (
+        'id', 'address', 'dns_name', 'family', 'vrf', 'assigned_object_type', 'assigned_object_id', 'assigned_object',
+    )
+    STR_FIELDS = ('address',)
+
+
+class PrefixRecord(CompactRecord):  # pylint: disable=too-few-public-methods
+    """ A prefix, as dumped as a subnet """
+    __slots__ = ('id', 'prefix', 'description', 'custom_fields', 'role', 'site', 'vrf', 'tenant', 'children')
+    RAW_FIELDS = ('custom_fields',)
+    STR_FIELDS = ('prefix',)
+
+
+def _convert(value):
+    """ Nested objects in the JSON become NestedRecords, including those in lists such as tags """
+    if isinstance(value, dict):
+        return NestedRecord.from_json(value)
+    if isinstance(value, list):
+        return [NestedRecord.from_json(v) if isinstance(v, dict) else v for v in value]
+    return value
@@ -0,0 +1,17 @@
+"""
+    Transport used for the HTTP session shared by all requests to NetBox, imported only once NetBox is first used
+"""
+
+import requests.adapters
+
+
+class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+    """ HTTPAdapter that applies a default timeout to every request that doesn't set its own """
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
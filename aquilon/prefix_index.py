@@ -0,0 +1,53 @@
+"""
+    Longest prefix match index of the subnets known to aquilon, used to check addresses before running any aq commands
+"""
+
+import ipaddress
+
+
+class PrefixIndex():
+    """
+        Binary radix trie of IPv4 networks, looking up an address walks at most one node per bit of the address.
+        Each node is a list of the child for a 0 bit, the child for a 1 bit, and the value of the network ending there.
+    """
+    def __init__(self):
+        self.root = [None, None, None]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, network, value):
+        """ Add a network to the index, values can be anything other than None """
+        network = ipaddress.IPv4Network(network, strict=False)
+        bits = int(network.network_address)
+        node = self.root
+        for shift in range(31, 31 - network.prefixlen, -1):
+            bit = (bits >> shift) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            self.count += 1
+        node[2] = value
+
+    def lookup(self, address):
+        """ Value of the most specific network containing an address, or None if no network does """
+        bits = int(ipaddress.IPv4Address(address))
+        node = self.root
+        best = node[2]
+        for shift in range(31, -1, -1):
+            node = node[(bits >> shift) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                best = node[2]
+        return best
+
+    @classmethod
+    def from_subnet_fields(cls, subnets):
+        """ Build an index of the fields of subnets, as produced by netbox_dump_subnetdata """
+        index = cls()
+        for fields in subnets:
+            index.add(f"{fields['SubnetAddress']}/{fields['SubnetMask']}", fields)
+        return index
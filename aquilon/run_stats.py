@@ -0,0 +1,127 @@
+"""
+    Instrumentation of the requests made to NetBox and the aq commands run, reported at the end of a run
+"""
+
+import json
+import re
+import sys
+import threading
+
+from urllib.parse import urlparse
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')]
+
+
+class RunStats():
+    """
+        Count, bytes, errors and a latency histogram for each key of each category, e.g. each NetBox endpoint and each
+        aq command. Safe to record from many threads at once.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, category, key, seconds, size=0, error=False):
+        """ Record a single request or command that took a number of seconds """
+        with self.lock:
+            stat = self.stats.setdefault(category, {}).setdefault(key, {
+                'count': 0,
+                'errors': 0,
+                'bytes': 0,
+                'seconds': 0.0,
+                'max_seconds': 0.0,
+                'histogram': [0] * len(BUCKETS),
+            })
+            stat['count'] += 1
+            stat['errors'] += int(error)
+            stat['bytes'] += size
+            stat['seconds'] += seconds
+            stat['max_seconds'] = max(stat['max_seconds'], seconds)
+            stat['histogram'][next(i for i, bound in enumerate(BUCKETS) if seconds <= bound)] += 1
+
+    @classmethod
+    def endpoint_name(cls, url):
+        """ Name of the NetBox endpoint a URL belongs to, with object ids replaced so they are counted together """
+        return re.sub(r'/\d+/', '/{id}/', urlparse(url).path)
+
+    def response_hook(self, response, *_, **__):
+        """ requests response hook recording each response from NetBox, install in session.hooks['response'] """
+        # Count the bytes on the wire, response.content has already been decompressed if NetBox used gzip
+        length = response.headers.get('Content-Length')
+        self.record(
+            'netbox',
+            f'{response.request.method} {self.endpoint_name(response.request.url)}',
+            response.elapsed.total_seconds(),
+            int(length) if length is not None else len(response.content),
+            error=not response.ok,
+        )
+
+    @classmethod
+    def _percentile(cls, histogram, fraction):
+        """ Upper bound of the bucket containing a percentile, as the exact value isn't kept """
+        target = sum(histogram) * fraction
+        seen = 0
+        for bound, count in zip(BUCKETS, histogram):
+            seen += count
+            if seen >= target:
+                return bound
+        return BUCKETS[-1]
+
+    def to_dict(self):
+        """ All stats, with histograms keyed by the upper bound of each bucket in seconds """
+        with self.lock:
+            return {
+                category: {
+                    key: dict(stat, histogram={
+                        ('+Inf' if bound == float('inf') else str(bound)): count
+                        for bound, count in zip(BUCKETS, stat['histogram'])
+                    })
+                    for key, stat in keys.items()
+                }
+                for category, keys in self.stats.items()
+            }
+
+    def summary(self):
+        """ Table of stats, with the keys of each category sorted by the total time spent in them """
+        lines = []
+        with self.lock:
+            for category, keys in sorted(self.stats.items()):
+                lines.append(
+                    f'{category:50s} {"count":>6s} {"errors":>6s} {"KiB":>9s} {"total s":>8s} {"mean ms":>8s} '
+                    f'{"p95 ms":>7s} {"max ms":>8s}'
+                )
+                for key, stat in sorted(keys.items(), key=lambda item: -item[1]['seconds']):
+                    p95 = self._percentile(stat['histogram'], 0.95)
+                    lines.append(
+                        f'  {key:48s} {stat["count"]:6d} {stat["errors"]:6d} {stat["bytes"] / 1024:9.1f} '
+                        f'{stat["seconds"]:8.2f} {stat["seconds"] / stat["count"] * 1000:8.1f} '
+                        f'{"<=" + format(p95 * 1000, ".0f") if p95 != float("inf") else ">10000":>7s} '
+                        f'{stat["max_seconds"] * 1000:8.1f}'
+                    )
+        return '\n'.join(lines)
+
+    def write_json(self, path):
+        """ Write all stats to a file as JSON """
+        with open(path, 'w', encoding='utf-8') as stats_file:
+            json.dump(self.to_dict(), stats_file, indent=2, sort_keys=True)
+
+
+def add_stats_arguments(parser):
+    """ Add the options used by report_stats to an argparse parser """
+    parser.add_argument(
+        "--stats", action='store_true',
+        help="Print a summary of the requests made to NetBox and aq commands run at the end of the run.",
+    )
+    parser.add_argument(
+        "--stats-json", metavar='FILE',
+        help="Write the requests made to NetBox and aq commands run to a file as JSON at the end of the run.",
+    )
+
+
+def report_stats(stats, opts):
+    """ Report stats as requested by the options added by add_stats_arguments """
+    if opts.stats and stats.stats:
+        print(stats.summary(), file=sys.stderr)
+    if opts.stats_json:
+        stats.write_json(opts.stats_json)
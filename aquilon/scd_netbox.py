@@ -2,12 +2,57 @@
     Library of common functionality used for interacting with SCD's NetBox instance
 """
 
+import collections
+import concurrent.futures
 import configparser
+import heapq
+import itertools
 import logging
 import os.path
 import sys
-import requests
-import pynetbox
+import threading
+
+from urllib.parse import urlencode
+
+from netbox_cache import NetboxCache
+from netbox_records import AddressRecord, InterfaceRecord
+from run_stats import RunStats
+
+# Fields of each object type read by the planners, only these are requested from NetBox
+INTERFACE_FIELDS = [
+    'id', 'name', 'type', 'mac_address', 'mgmt_only', 'tags', 'lag', 'count_ipaddresses', 'device', 'virtual_machine',
+]
+ADDRESS_FIELDS = ['id', 'address', 'dns_name', 'family', 'vrf', 'assigned_object_id', 'assigned_object']
+# Fields of addresses needed to find the device or virtual machine a hostname belongs to
+RESOLVE_FIELDS = ['id', 'address', 'dns_name', 'assigned_object_type', 'assigned_object']
+
+
+class DeviceSnapshot():  # pylint: disable=too-few-public-methods
+    """
+        All of the NetBox objects needed to describe a single physical or virtual device, fetched once per device.
+        Addresses are a dictionary of lists keyed by interface id, as returned by get_addresses_from_device.
+    """
+    def __init__(  # pylint: disable=too-many-arguments
+        self, device, *, rack=None, cluster=None, interfaces=None, addresses=None, disks=None,
+    ):
+        self.device = device
+        self.rack = rack
+        self.cluster = cluster
+        self.interfaces = interfaces if interfaces is not None else []
+        self.addresses = addresses if addresses is not None else {}
+        self.disks = disks if disks is not None else []
+
+
+def is_device(obj):
+    """ Whether a NetBox object is a physical device """
+    import pynetbox  # pylint: disable=import-outside-toplevel
+    return isinstance(obj, pynetbox.models.dcim.Devices)
+
+
+def is_virtual_machine(obj):
+    """ Whether a NetBox object is a virtual machine """
+    import pynetbox  # pylint: disable=import-outside-toplevel
+    return isinstance(obj, pynetbox.models.virtualization.VirtualMachines)
 
 
 class SCDNetbox():
@@ -15,14 +60,24 @@ class SCDNetbox():
         This class is intended to either used directly, or subclassed by other tools to add extra functionality.
     """
     def __init__(self, additonal_config_name=None):
-        """ Connect to NetBox and set up session """
-        netbox_session = requests.Session()
-
+        """ Read config, the connection to NetBox is only set up when it is first used """
         self.config = configparser.ConfigParser()
         self.config['netbox'] = {
             'url': 'https://netbox.example.org/',
             'cert_path': '',
             'token': 'TOKEN',
+            'backend': 'rest',
+            'graphql_batch_size': '50',
+            'lookup_workers': '8',
+            'page_size': '1000',
+            'pool_size': '10',
+            'keepalive': 'true',
+            'compression': 'true',
+            'timeout': '60',
+            'retries': '3',
+            'retry_backoff': '0.5',
+            'retry_statuses': '429,502,503,504',
+            'max_url_length': '4000',
         }
         self.config['aquilon'] = {
             'archetype': 'ral-tier1',
@@ -33,6 +88,11 @@ class SCDNetbox():
             'cpuname': 'xeon_e5_2650v4',
             'cpuspeed': '2200',
         }
+        self.config['cache'] = {
+            'enabled': 'false',
+            'path': '~/.cache/scd_netbox',
+            'ttl': '86400',
+        }
         self.config.read([
             '/var/quattor/etc/scd_netbox.cfg',
             os.path.expanduser('~/.scd_netbox.cfg'),
@@ -43,14 +103,253 @@ class SCDNetbox():
                 os.path.expanduser(f'~/.{additonal_config_name}.cfg'),
             ])
 
+        # Requests made to NetBox are recorded here, along with anything else subclasses want to report on
+        self.stats = RunStats()
+
+        self._netbox = None
+        self._lookup_executor = None
+        self._lookup_lock = threading.Lock()
+        # Marks the threads of the lookup pool, so that lookups made from inside one don't wait on the pool
+        self._lookup_worker = threading.local()
+
+        self.cache = None
+        if self.config.getboolean('cache', 'enabled'):
+            self.cache = NetboxCache(
+                os.path.expanduser(self.config['cache']['path']),
+                self.config.getint('cache', 'ttl'),
+            )
+
+    @property
+    def netbox(self):
+        """
+        pynetbox API, created on first use so that tools which never talk to NetBox, or exit early with --help or an
+        argument error, don't pay for importing pynetbox and setting up the session
+        """
+        if self._netbox is None:
+            import pynetbox  # pylint: disable=import-outside-toplevel
+            self._netbox = pynetbox.api(self.config['netbox']['url'], token=self.config['netbox']['token'])
+            self._netbox.http_session = self._create_session()
+        return self._netbox
+
+    @netbox.setter
+    def netbox(self, netbox):
+        self._netbox = netbox
+
+    @property
+    def lookup_executor(self):
+        """
+        Pool of lookup_workers threads shared by every concurrent request to NetBox, created on first use. However
+        lookups are nested, no more than lookup_workers requests are made at the same time.
+        """
+        with self._lookup_lock:
+            if self._lookup_executor is None:
+                workers = self.config.getint('netbox', 'lookup_workers')
+                self._lookup_executor = concurrent.futures.ThreadPoolExecutor(workers)
+        return self._lookup_executor
+
+    def submit_lookup(self, method, *args):
+        """
+        Run method(*args) on the lookup pool, returning a future of its result.
+        When called from one of the pool's own threads the method is run straight away in that thread instead, as
+        waiting on other workers from inside a worker could use up the pool and never finish.
+        """
+        if getattr(self._lookup_worker, 'active', False):
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(method(*args))
+            except Exception as error:  # pylint: disable=broad-except
+                future.set_exception(error)
+            return future
+        return self.lookup_executor.submit(self._run_lookup, method, *args)
+
+    def _run_lookup(self, method, *args):
+        self._lookup_worker.active = True
+        try:
+            return method(*args)
+        finally:
+            self._lookup_worker.active = False
+
+    def _create_session(self):
+        """
+        Set up the HTTP session shared by all requests to NetBox, using the transport settings in the [netbox] section.
+        Idempotent requests that fail with a connection error or one of the retry_statuses are retried with exponential
+        backoff, so that a briefly overloaded NetBox doesn't cause a copy to fail part way through.
+        """
+        # pylint: disable=import-outside-toplevel
+        import requests
+        from urllib3.util.retry import Retry
+        from netbox_session import TimeoutHTTPAdapter
+
+        netbox_session = requests.Session()
+
         if self.config['netbox']['cert_path']:
             if self.config['netbox']['cert_path'].lower() == 'false':
                 netbox_session.verify = False
             else:
                 netbox_session.verify = self.config['netbox']['cert_path']
 
-        self.netbox = pynetbox.api(self.config['netbox']['url'], token=self.config['netbox']['token'])
-        self.netbox.http_session = netbox_session
+        retry_options = {
+            'total': self.config.getint('netbox', 'retries'),
+            'backoff_factor': self.config.getfloat('netbox', 'retry_backoff'),
+            'status_forcelist': [int(s) for s in self.config['netbox']['retry_statuses'].split(',') if s.strip()],
+            'raise_on_status': False,
+        }
+        # Only retry methods that are safe to repeat, the name of this option changed in urllib3 1.26
+        if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS'):
+            retry_options['allowed_methods'] = frozenset(['GET', 'HEAD', 'OPTIONS'])
+        else:
+            retry_options['method_whitelist'] = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+        adapter = TimeoutHTTPAdapter(
+            timeout=self.config.getfloat('netbox', 'timeout'),
+            pool_connections=self.config.getint('netbox', 'pool_size'),
+            pool_maxsize=self.config.getint('netbox', 'pool_size'),
+            max_retries=Retry(**retry_options),
+        )
+        netbox_session.mount('https://', adapter)
+        netbox_session.mount('http://', adapter)
+
+        if self.config.getboolean('netbox', 'keepalive'):
+            netbox_session.headers['Connection'] = 'keep-alive'
+        else:
+            netbox_session.headers['Connection'] = 'close'
+        if self.config.getboolean('netbox', 'compression'):
+            netbox_session.headers['Accept-Encoding'] = 'gzip, deflate'
+        else:
+            netbox_session.headers['Accept-Encoding'] = 'identity'
+
+        netbox_session.hooks['response'].append(self.stats.response_hook)
+
+        return netbox_session
+
+    def _get_page(self, endpoint, filters, offset, limit):
+        # Without the trailing slash NetBox would redirect every request
+        response = self.netbox.http_session.get(
+            endpoint.url.rstrip('/') + '/',
+            params=dict(filters, offset=offset, limit=limit),
+            headers={
+                'Authorization': f'Token {self.netbox.token}',
+                'Accept': 'application/json',
+            },
+        )
+        if not response.ok:
+            import pynetbox  # pylint: disable=import-outside-toplevel
+            raise pynetbox.RequestError(response)
+        return response.json()
+
+    def fetch_all(  # pylint: disable=too-many-arguments
+        self, endpoint, page_size=None, split_by=None, fields=None, record_type=None, *, merge_key=None, **filters,
+    ):
+        """
+        Generate every object from a NetBox list endpoint that matches the filters, in the order NetBox returns them.
+        Unlike endpoint.filter, once the first page has given the total count the following pages are requested at the
+        same time on the lookup pool, with no more pages waiting to be read than there are workers. When called from a
+        lookup worker the pages are requested one at a time in that worker.
+        If split_by names a filter with a list of values, e.g. tenant, a separate query is made for each value and these
+        also run at the same time, the results must not overlap as they are not deduplicated. The results of each query
+        follow the one before, unless a merge_key is given for the order NetBox returns them in, in which case they are
+        merged into that order.
+        If a list of fields is given only those are returned by NetBox, and the objects are marked as having all their
+        details, so that reading any other attribute raises AttributeError instead of fetching the whole object.
+        If a record_type from netbox_records is given, objects are built as that instead of as pynetbox Records.
+        """
+        page_size = page_size or self.config.getint('netbox', 'page_size')
+        # requests drops parameters set to None, but NetBox uses null to filter for unset fields
+        filters = {k: 'null' if v is None else v for k, v in filters.items()}
+        if fields:
+            filters['fields'] = ','.join(fields)
+        if split_by is None:
+            queries = [filters]
+        else:
+            queries = [dict(filters, **{split_by: value}) for value in filters[split_by]]
+
+        workers = 1 if getattr(self._lookup_worker, 'active', False) else self.config.getint('netbox', 'lookup_workers')
+        # The first page of every query is requested straight away, as the count it returns is needed before the rest
+        # of the pages of the query can be requested
+        first_pages = [self.submit_lookup(self._get_page, endpoint, query, 0, page_size) for query in queries]
+        # Every query is read at once when merging, so they share the window
+        window_size = workers if merge_key is None else max(workers // len(queries), 1)
+        streams = [
+            (
+                self._make_object(endpoint, values, fields, record_type)
+                for values in self._fetch_query(endpoint, query, first_page, page_size, window_size=window_size)
+            )
+            for query, first_page in zip(queries, first_pages)
+        ]
+        if merge_key is None:
+            yield from itertools.chain.from_iterable(streams)
+        else:
+            yield from heapq.merge(*streams, key=merge_key)
+
+    def _fetch_query(  # pylint: disable=too-many-arguments
+        self, endpoint, query, first_page, page_size, *, window_size,
+    ):
+        """
+        Generate the values of every object matching a query, given the future of its first page.
+        Only window_size pages are kept in flight, so that memory use doesn't grow with the number of pages, and each
+        page is dropped once its values have been generated.
+        """
+        pages = self._submit_pages(endpoint, query, first_page, page_size)
+        window = collections.deque(itertools.islice(pages, window_size))
+        while window:
+            page = window.popleft().result()
+            window.extend(itertools.islice(pages, 1))
+            yield from page['results']
+
+    def _submit_pages(self, endpoint, query, first_page, page_size):
+        """ Generate futures for the pages of a query in order, as they are needed """
+        yield first_page
+        count = first_page.result()['count']
+        # NetBox caps the page size at MAX_PAGE_SIZE, so step by what it actually returned
+        step = len(first_page.result()['results']) or page_size
+        first_page = None
+        for offset in range(step, count, step):
+            yield self.submit_lookup(self._get_page, endpoint, query, offset, step)
+
+    def _make_object(self, endpoint, values, fields, record_type):
+        """ Build an object returned by fetch_all from its values """
+        if record_type is not None:
+            return record_type.from_json(values)
+        obj = endpoint.return_obj(values, self.netbox, endpoint)
+        if fields:
+            obj.has_details = True
+        return obj
+
+    def get_cached_object(self, endpoint, obj_id):
+        """
+        Get a single slow-changing object (e.g. a rack, cluster, device type, tenant or role) by id,
+        using the persistent cache if it has been enabled in the [cache] section of the config.
+        Expired entries are revalidated by asking NetBox whether the object has changed since its last_updated time,
+        and are only downloaded again if it has. Returns None if the object doesn't exist, or has been deleted.
+        """
+        if self.cache is None:
+            return endpoint.get(obj_id)
+
+        namespace = '.'.join(endpoint.url.rstrip('/').split('/')[-2:])
+        cached = self.cache.load(namespace, obj_id)
+
+        if cached:
+            values, expired = cached
+            if not expired:
+                return endpoint.return_obj(values, self.netbox, endpoint)
+
+            changed = list(endpoint.filter(id=obj_id, last_updated__gt=values['last_updated']))
+            if not changed:
+                # A deleted object isn't returned by the filter either
+                if not endpoint.count(id=obj_id):
+                    logging.debug('Cached %s %s has been deleted', namespace, obj_id)
+                    self.cache.delete(namespace, obj_id)
+                    return None
+                logging.debug('Cached %s %s is unchanged', namespace, obj_id)
+                self.cache.store(namespace, obj_id, values)
+                return endpoint.return_obj(values, self.netbox, endpoint)
+            obj = changed[0]
+        else:
+            obj = endpoint.get(obj_id)
+
+        if obj is not None:
+            self.cache.store(namespace, obj_id, dict(obj))
+        return obj
 
     def get_device_by_magdb_id(self, magdb_id):
         """ Get a single device from NetBox based on MagDB system ID """
@@ -110,9 +409,103 @@ class SCDNetbox():
         logging.debug("Got device %s for hostname %s", device, hostname)
         return device
 
+    def _chunk_values(self, endpoint, name, values, **filters):
+        """
+        Split the values of a multi-value filter into chunks, so that the URL of each query for a chunk, including the
+        other filters and paging, stays under [netbox] max_url_length
+        """
+        filters = dict(filters, offset=0, limit=self.config.getint('netbox', 'page_size'))
+        available = self.config.getint('netbox', 'max_url_length') - len(endpoint.url) - len(urlencode(filters)) - 2
+        chunks = []
+        chunk = []
+        length = 0
+        for value in values:
+            value_length = len(urlencode({name: value})) + 1
+            if chunk and length + value_length > available:
+                chunks.append(chunk)
+                chunk = []
+                length = 0
+            chunk.append(value)
+            length += value_length
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _fetch_by_values(  # pylint: disable=too-many-arguments
+        self, endpoint, name, values, fields=None, record_type=None, **filters,
+    ):
+        """
+        Fetch every object matching any of many values of a filter, with a chunked query for each URL's worth.
+        The chunks are fetched on the lookup pool, each fetching its own pages one at a time.
+        """
+        query = dict(filters, fields=','.join(fields)) if fields else filters
+        chunks = self._chunk_values(endpoint, name, values, **query)
+        results = [
+            self.submit_lookup(lambda chunk: list(self.fetch_all(
+                endpoint, fields=fields, record_type=record_type, **{name: chunk}, **filters,
+            )), chunk)
+            for chunk in chunks
+        ]
+        return [obj for result in results for obj in result.result()]
+
+    def resolve_hostnames(self, hostnames):
+        """
+        Get the devices and virtual machines of many fully qualified domain names at once. Addresses are looked up
+        with chunks of names per query, and then the devices and virtual machines they are assigned to by id.
+        Returns a tuple of a dict of hostname to device, a list of hostnames that were not found, and a list of
+        hostnames that were ambiguous because more than one address has them.
+        """
+        hostnames = list(dict.fromkeys(hostnames))
+        addresses = {}
+        for address in self._fetch_by_values(
+            self.netbox.ipam.ip_addresses, 'dns_name', hostnames, fields=RESOLVE_FIELDS, record_type=AddressRecord,
+            family=4,
+        ):
+            addresses.setdefault(address.dns_name.lower(), []).append(address)
+
+        assigned = {}
+        unresolved = []
+        ambiguous = []
+        for hostname in hostnames:
+            matches = addresses.get(hostname.lower(), [])
+            if len(matches) > 1:
+                logging.debug("Got multiple IPs %s for hostname %s", matches, hostname)
+                ambiguous.append(hostname)
+            elif not matches:
+                unresolved.append(hostname)
+            elif matches[0].assigned_object_type == 'dcim.interface':
+                assigned[hostname] = ('device', matches[0].assigned_object.device.id)
+            elif matches[0].assigned_object_type == 'virtualization.vminterface':
+                assigned[hostname] = ('virtual_machine', matches[0].assigned_object.virtual_machine.id)
+            else:
+                logging.debug("Unknown assigned_object_type %s for IP %s", matches[0].assigned_object_type, matches[0])
+                unresolved.append(hostname)
+
+        found = {}
+        for kind, endpoint in [
+            ('device', self.netbox.dcim.devices),
+            ('virtual_machine', self.netbox.virtualization.virtual_machines),
+        ]:
+            ids = sorted({obj_id for k, obj_id in assigned.values() if k == kind})
+            if ids:
+                found.update({(kind, device.id): device for device in self._fetch_by_values(endpoint, 'id', ids)})
+
+        devices = {}
+        for hostname, obj in assigned.items():
+            if obj in found:
+                devices[hostname] = found[obj]
+            else:
+                unresolved.append(hostname)
+
+        logging.debug(
+            'Resolved %d of %d hostnames, %d not found and %d ambiguous',
+            len(devices), len(hostnames), len(unresolved), len(ambiguous),
+        )
+        return devices, unresolved, ambiguous
+
     def get_rack_from_device(self, device):
         """ check if host is in rack - query netbox for rack """
-        rack = self.netbox.dcim.racks.get(device.rack.id)
+        rack = self.get_cached_object(self.netbox.dcim.racks, device.rack.id)
 
         if rack is None:
             logging.error("host not in rack?")
@@ -125,27 +518,82 @@ class SCDNetbox():
 
         return rack
 
+    def get_cluster_from_device(self, virtual_machine):
+        """ Get the full cluster object a virtual machine belongs to """
+        cluster = self.get_cached_object(self.netbox.virtualization.clusters, virtual_machine.cluster.id)
+
+        if cluster is None:
+            logging.error("virtual machine not in cluster?")
+            sys.exit(1)
+
+        return cluster
+
+    def get_device_snapshot(self, device):
+        """ Fetch everything needed to describe a physical or virtual device into a DeviceSnapshot """
+        if is_device(device):
+            return DeviceSnapshot(
+                device,
+                rack=self.get_rack_from_device(device),
+                interfaces=self.get_interfaces_from_device(device),
+                addresses=self.get_addresses_from_device(device),
+            )
+        if is_virtual_machine(device):
+            return DeviceSnapshot(
+                device,
+                cluster=self.get_cluster_from_device(device),
+                interfaces=self.get_interfaces_from_device(device),
+                addresses=self.get_addresses_from_device(device),
+                disks=list(self.get_disks_from_device(device)),
+            )
+
+        logging.error('Unsupported device type for snapshot "%s"', type(device))
+        sys.exit(1)
+
     def get_interfaces_from_device(self, device):
         """
         The next step is to add interfaces to the machine in Aquilon
         We need to use 'filter' to retrieve the interface id for all interfaces
         This will assume that the device name IS UNIQUE
         """
-        if isinstance(device, pynetbox.models.dcim.Devices):
-            filter_interfaces = self.netbox.dcim.interfaces.filter(device=device.name)
-        elif isinstance(device, pynetbox.models.virtualization.VirtualMachines):
-            filter_interfaces = self.netbox.virtualization.interfaces.filter(virtual_machine=device.name)
+        if is_device(device):
+            endpoint = self.netbox.dcim.interfaces
+            parent = {'device': device.name}
+            # Only LAGs and interfaces with a MAC address can be added to Aquilon, LAGs are listed first so that they
+            # are added before their members
+            queries = [{'type': 'lag'}, {'mac_address__empty': 'false'}]
+        elif is_virtual_machine(device):
+            endpoint = self.netbox.virtualization.interfaces
+            parent = {'virtual_machine': device.name}
+            queries = [{'mac_address__empty': 'false'}]
         else:
             logging.error('Unsupported device type for interfaces "%s"', type(device))
             sys.exit(1)
 
-        if len(filter_interfaces) == 0:
+        total = endpoint.count(**parent)
+        if total == 0:
             logging.error("No interfaces found")
             sys.exit(1)
 
+        filter_interfaces = {}
+        for query in queries:
+            for interface in self.fetch_all(
+                endpoint, fields=INTERFACE_FIELDS, record_type=InterfaceRecord, **parent, **query,
+            ):
+                filter_interfaces.setdefault(interface.id, interface)
+
+        unusedintf = total - len(filter_interfaces)
+        if unusedintf > 0:
+            logging.warning("%s non-lag interfaces without mac address were not included", unusedintf)
+
+        # Also check on the client, in case the server doesn't support a filter
+        return self._select_interfaces(filter_interfaces.values())
+
+    @classmethod
+    def _select_interfaces(cls, all_interfaces):
+        """ Only interfaces with a MAC address, or LAGs, can be added to Aquilon """
         interfaces = []
         unusedintf = 0
-        for interface in filter_interfaces:
+        for interface in all_interfaces:
             if interface.mac_address:
                 interfaces.append(interface)
             elif hasattr(interface, 'type') and interface.type.value == 'lag':
@@ -158,39 +606,69 @@ class SCDNetbox():
 
         return interfaces
 
-    def get_addresses_from_interface(self, interface):
-        """ Get all address objects associated with a physical or virtual interface """
-        if interface.count_ipaddresses == 0:
-            return []
-
-        if hasattr(interface, 'device'):
-            all_addresses = self.netbox.ipam.ip_addresses.filter(interface_id=interface.id)
-        elif hasattr(interface, 'virtual_machine'):
-            all_addresses = self.netbox.ipam.ip_addresses.filter(vminterface_id=interface.id)
-        else:
-            logging.warning('Unsupported interface type for interface "%s"', interface)
-            return []
-
-        ipv4_addresses = []
+    def get_addresses_from_device(self, device):
+        """
+        Get all IPv4 address objects associated with a physical or virtual device in a single query,
+        grouped into a dictionary of lists keyed by the id of the interface each address is assigned to
+        """
+        if is_device(device):
+            return self._get_addresses_by_interface(device_id=device.id)
+        if is_virtual_machine(device):
+            return self._get_addresses_by_interface(virtual_machine_id=device.id)
+
+        logging.error('Unsupported device type for addresses "%s"', type(device))
+        sys.exit(1)
+
+    def _get_addresses_by_interface(self, **filters):
+        # Every family is fetched, so that _group_addresses can warn about the ones that are ignored without another
+        # query to count them
+        return self._group_addresses(
+            self.fetch_all(self.netbox.ipam.ip_addresses, fields=ADDRESS_FIELDS, record_type=AddressRecord, **filters)
+        )
+
+    @classmethod
+    def _group_addresses(cls, all_addresses):
+        """ Group IPv4 addresses by the id of the interface they are assigned to, ignoring any other families """
+        addresses = {}
         for address in all_addresses:
             # We currently only support IPv4 addresses via broker assignment
             if address.family.value == 4:
-                ipv4_addresses.append(address)
+                addresses.setdefault(address.assigned_object_id, []).append(address)
             else:
                 logging.warning(
                     "Interface %s has an address (%s) in NetBox with an unsupported family (%s) which was ignored",
-                    interface.name,
+                    address.assigned_object.name,
                     address.address,
                     address.family.label,
                 )
 
-        return ipv4_addresses
+        return addresses
+
+    def get_addresses_from_interface(self, interface, addresses=None):
+        """
+        Get all address objects associated with a physical or virtual interface
+        To loop over the interfaces of a device with a single query, pass in the addresses of the whole device from
+        get_addresses_from_device, otherwise they are loaded for the device of this interface in the same way.
+        """
+        if interface.count_ipaddresses == 0:
+            return []
+
+        if addresses is None:
+            if hasattr(interface, 'device'):
+                addresses = self._get_addresses_by_interface(device_id=interface.device.id)
+            elif hasattr(interface, 'virtual_machine'):
+                addresses = self._get_addresses_by_interface(virtual_machine_id=interface.virtual_machine.id)
+            else:
+                logging.warning('Unsupported interface type for interface "%s"', interface)
+                return []
+
+        return list(addresses.get(interface.id, []))
 
     def get_disks_from_device(self, device):
         """
         Get all virtual disks associated with a virtual machine
         """
-        if isinstance(device, pynetbox.models.virtualization.VirtualMachines):
+        if is_virtual_machine(device):
             filtered_disks = self.netbox.virtualization.virtual_disks.filter(virtual_machine_id=device.id)
         else:
             logging.error('Unsupported device type for disks "%s"', type(device))
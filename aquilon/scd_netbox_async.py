@@ -0,0 +1,120 @@
+"""
+    Asyncio interface to the lookups provided by SCDNetbox, allowing independent lookups to run at the same time
+"""
+
+import asyncio
+import logging
+
+from scd_netbox import DeviceSnapshot, SCDNetbox, is_device, is_virtual_machine
+
+
+class NetboxLookupError(Exception):
+    """ Raised in place of the SystemExit used by SCDNetbox when a lookup fails """
+
+
+def _lookup(method, *args):
+    try:
+        return method(*args)
+    except SystemExit as error:
+        raise NetboxLookupError(f'{method.__name__}{args} failed') from error
+
+
+def _list_disks(scd_netbox, device):
+    return list(scd_netbox.get_disks_from_device(device))
+
+
+def run_sync(coroutine):
+    """ Run a coroutine to completion from synchronous code, using a new event loop """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class AsyncSCDNetbox():
+    """
+        Provides the same lookups as SCDNetbox as coroutines.
+        pynetbox is synchronous, so lookups are run on the lookup pool of the wrapped SCDNetbox object, which is also
+        used for the pages and chunks they fetch, so [netbox] lookup_workers limits how many requests are made at the
+        same time.
+        Failed lookups raise NetboxLookupError rather than exiting.
+    """
+    def __init__(self, scd_netbox=None):
+        self.scd_netbox = scd_netbox if scd_netbox is not None else SCDNetbox()
+
+    async def _run(self, method, *args):
+        return await asyncio.wrap_future(self.scd_netbox.submit_lookup(_lookup, method, *args))
+
+    async def get_device_by_magdb_id(self, magdb_id):
+        """ Get a single device from NetBox based on MagDB system ID """
+        return await self._run(self.scd_netbox.get_device_by_magdb_id, magdb_id)
+
+    async def get_device_by_name(self, name):
+        """ Get a single device from NetBox based on device name """
+        return await self._run(self.scd_netbox.get_device_by_name, name)
+
+    async def get_device_by_hostname(self, hostname):
+        """ Get a single device from NetBox based on fully qualified domain name """
+        return await self._run(self.scd_netbox.get_device_by_hostname, hostname)
+
+    async def get_rack_from_device(self, device):
+        """ Get the rack a physical device is in """
+        return await self._run(self.scd_netbox.get_rack_from_device, device)
+
+    async def get_cluster_from_device(self, virtual_machine):
+        """ Get the cluster a virtual machine belongs to """
+        return await self._run(self.scd_netbox.get_cluster_from_device, virtual_machine)
+
+    async def get_interfaces_from_device(self, device):
+        """ Get the interfaces of a physical or virtual device """
+        return await self._run(self.scd_netbox.get_interfaces_from_device, device)
+
+    async def get_addresses_from_device(self, device):
+        """ Get the IPv4 addresses of a physical or virtual device, grouped by interface id """
+        return await self._run(self.scd_netbox.get_addresses_from_device, device)
+
+    async def get_addresses_from_interface(self, interface, addresses=None):
+        """ Get the IPv4 addresses of a physical or virtual interface """
+        return await self._run(self.scd_netbox.get_addresses_from_interface, interface, addresses)
+
+    async def get_disks_from_device(self, device):
+        """ Get the virtual disks of a virtual machine """
+        return await self._run(_list_disks, self.scd_netbox, device)
+
+    async def get_device_snapshot(self, device):
+        """ Fetch everything needed to describe a device into a DeviceSnapshot, with all lookups running together """
+        if is_device(device):
+            rack, interfaces, addresses = await asyncio.gather(
+                self.get_rack_from_device(device),
+                self.get_interfaces_from_device(device),
+                self.get_addresses_from_device(device),
+            )
+            return DeviceSnapshot(device, rack=rack, interfaces=interfaces, addresses=addresses)
+        if is_virtual_machine(device):
+            cluster, interfaces, addresses, disks = await asyncio.gather(
+                self.get_cluster_from_device(device),
+                self.get_interfaces_from_device(device),
+                self.get_addresses_from_device(device),
+                self.get_disks_from_device(device),
+            )
+            return DeviceSnapshot(device, cluster=cluster, interfaces=interfaces, addresses=addresses, disks=disks)
+
+        raise NetboxLookupError(f'Unsupported device type for snapshot "{type(device)}"')
+
+    async def get_device_snapshots(self, devices):
+        """
+        Fetch snapshots of many devices at the same time.
+        Returns a list in the same order as the devices, with None in place of any snapshot that could not be fetched.
+        """
+        results = await asyncio.gather(
+            *[self.get_device_snapshot(device) for device in devices],
+            return_exceptions=True,
+        )
+        snapshots = []
+        for device, result in zip(devices, results):
+            if isinstance(result, Exception):
+                logging.error('Unable to fetch %s from NetBox: %s', device, result)
+                result = None
+            snapshots.append(result)
+        return snapshots
@@ -0,0 +1,176 @@
+"""
+    GraphQL backend for fetching DeviceSnapshots, returning everything about a batch of devices in a single request
+"""
+
+import logging
+
+import requests
+
+from scd_netbox import DeviceSnapshot, is_device, is_virtual_machine
+
+ADDRESS_FIELDS = 'id address dns_name family { value label } vrf { id name }'
+
+DEVICE_FRAGMENT = '''
+fragment DeviceFields on DeviceType {
+    rack { id name facility_id tags { slug } }
+    interfaces {
+        id name type mac_address mgmt_only
+        tags { slug }
+        lag { id name }
+        ip_addresses { %s }
+    }
+}
+''' % ADDRESS_FIELDS
+
+VIRTUAL_MACHINE_FRAGMENT = '''
+fragment VirtualMachineFields on VirtualMachineType {
+    cluster { id name type { slug } custom_fields }
+    interfaces {
+        id name mac_address
+        tags { slug }
+        ip_addresses { %s }
+    }
+    virtualdisks { id name size description }
+}
+''' % ADDRESS_FIELDS
+
+
+class NetboxGraphQLError(Exception):
+    """ Raised when NetBox rejects a GraphQL query """
+
+
+class NetboxGraphQL():
+    """
+        Alternative to the REST lookups used to fill a DeviceSnapshot, selected with [netbox] backend = graphql.
+        The rack or cluster, interfaces, addresses and disks of up to graphql_batch_size devices are fetched with one
+        query, and converted into the same pynetbox objects that the REST API returns, so the planners can't tell the
+        difference.
+    """
+    def __init__(self, scd_netbox):
+        self.scd_netbox = scd_netbox
+        self.netbox = scd_netbox.netbox
+        self.url = self.netbox.base_url.rsplit('/api', 1)[0] + '/graphql/'
+
+    @classmethod
+    def _choice(cls, value):
+        """ Convert a GraphQL enum (e.g. "TYPE_LAG" or "lag") into the value/label structure used by the REST API """
+        if isinstance(value, dict) or value is None:
+            return value
+        value = str(value).lower()
+        if value.startswith('type_'):
+            value = value[len('type_'):]
+        return {'value': value, 'label': value}
+
+    def build_query(self, devices):
+        """ Build a query for a list of devices, each device is returned under an alias of its index in the list """
+        selections = []
+        fragments = set()
+        for index, device in enumerate(devices):
+            if is_device(device):
+                selections.append(f'd{index}: device(id: {device.id}) {{ ...DeviceFields }}')
+                fragments.add(DEVICE_FRAGMENT)
+            elif is_virtual_machine(device):
+                selections.append(f'd{index}: virtual_machine(id: {device.id}) {{ ...VirtualMachineFields }}')
+                fragments.add(VIRTUAL_MACHINE_FRAGMENT)
+            else:
+                logging.error('Unsupported device type for snapshot "%s"', type(device))
+        if not selections:
+            return None
+        return 'query {\n    ' + '\n    '.join(selections) + '\n}\n' + ''.join(sorted(fragments))
+
+    def query(self, query):
+        """ Send a query to NetBox, returning the data from the response """
+        response = self.netbox.http_session.post(
+            self.url,
+            json={'query': query},
+            headers={
+                'Authorization': f'Token {self.netbox.token}',
+                'Accept': 'application/json',
+            },
+        )
+        if not response.ok:
+            raise NetboxGraphQLError(f'GraphQL query failed with status {response.status_code}: {response.text}')
+        result = response.json()
+        if result.get('errors'):
+            raise NetboxGraphQLError('; '.join(e.get('message', str(e)) for e in result['errors']))
+        return result['data']
+
+    def _make_snapshot(self, device, data):
+        """ Convert the GraphQL result for a single device into a DeviceSnapshot """
+        if is_device(device):
+            interface_endpoint = self.netbox.dcim.interfaces
+        else:
+            interface_endpoint = self.netbox.virtualization.interfaces
+        address_endpoint = self.netbox.ipam.ip_addresses
+
+        interfaces = []
+        all_addresses = []
+        for values in data['interfaces']:
+            values = dict(values)
+            ip_addresses = values.pop('ip_addresses')
+            values['count_ipaddresses'] = len(ip_addresses)
+            if 'type' in values:
+                values['type'] = self._choice(values['type'])
+            interfaces.append(interface_endpoint.return_obj(values, self.netbox, interface_endpoint))
+            for address in ip_addresses:
+                address = dict(address)
+                address['family'] = self._choice(address['family'])
+                address['assigned_object_id'] = values['id']
+                address['assigned_object'] = {'id': values['id'], 'name': values['name']}
+                all_addresses.append(address_endpoint.return_obj(address, self.netbox, address_endpoint))
+
+        if not interfaces:
+            logging.error('No interfaces found for %s', device)
+            return None
+
+        # The REST API fetches LAGs first, keep the same order so their members are only added afterwards
+        interfaces.sort(key=lambda i: not (getattr(i, 'type', None) and i.type.value == 'lag'))
+
+        snapshot = DeviceSnapshot(
+            device,
+            interfaces=self.scd_netbox._select_interfaces(interfaces),  # pylint: disable=protected-access
+            addresses=self.scd_netbox._group_addresses(all_addresses),  # pylint: disable=protected-access
+        )
+        if data.get('rack'):
+            snapshot.rack = self.netbox.dcim.racks.return_obj(data['rack'], self.netbox, self.netbox.dcim.racks)
+        if data.get('cluster'):
+            clusters = self.netbox.virtualization.clusters
+            snapshot.cluster = clusters.return_obj(data['cluster'], self.netbox, clusters)
+        if 'virtualdisks' in data:
+            disks = self.netbox.virtualization.virtual_disks
+            snapshot.disks = [disks.return_obj(values, self.netbox, disks) for values in data['virtualdisks']]
+
+        if is_device(device):
+            if snapshot.rack is None or not snapshot.rack.facility_id:
+                logging.error('No rack with a facility ID found for %s', device)
+                return None
+        elif snapshot.cluster is None:
+            logging.error('No cluster found for %s', device)
+            return None
+
+        return snapshot
+
+    def get_device_snapshots(self, devices):
+        """
+        Fetch snapshots of many devices, with one query per batch of devices.
+        Returns a list in the same order as the devices, with None in place of any that could not be fetched.
+        """
+        batch_size = self.scd_netbox.config.getint('netbox', 'graphql_batch_size')
+        snapshots = []
+        for batch_start in range(0, len(devices), batch_size):
+            batch = devices[batch_start:batch_start + batch_size]
+            query = self.build_query(batch)
+            try:
+                data = self.query(query) if query else {}
+            except (NetboxGraphQLError, requests.exceptions.RequestException, ValueError) as error:
+                logging.error('Unable to fetch devices from NetBox: %s', error)
+                snapshots += [None] * len(batch)
+                continue
+
+            for index, device in enumerate(batch):
+                if data.get(f'd{index}') is None:
+                    logging.error('Unable to fetch %s from NetBox', device)
+                    snapshots.append(None)
+                else:
+                    snapshots.append(self._make_snapshot(device, data[f'd{index}']))
+        return snapshots
@@ -0,0 +1,99 @@
+"""
+Test cases for aq command executors
+"""
+
+# pylint: disable=missing-function-docstring
+
+import subprocess
+
+from http.server import BaseHTTPRequestHandler
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+import pytest
+
+from aq_executor import AqResult, BrokerExecutor, SubprocessExecutor
+
+import testdata
+
+
+class FakeBrokerHandler(BaseHTTPRequestHandler):
+    """ Records requests and the number of connections made, returns 404 for hosts named missing* """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def _respond(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        self.server.requests.append((self.command, self.path, parse_qs(body)))
+        status, reply = (404, b'Not Found: host missing') if 'missing' in self.path else (200, b'')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    do_GET = do_PUT = _respond
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+@pytest.fixture(name='fake_broker')
+def fixture_fake_broker():
+    with testdata.fake_server(FakeBrokerHandler) as server:
+        server.connections = 0
+        yield server
+
+
+def test_subprocess_executor(mocker):
+    mocked_run = mocker.patch.object(subprocess, 'run', return_value=SimpleNamespace(
+        returncode=4,
+        stdout=b'',
+        stderr=b'Not Found: host missing',
+    ))
+    executor = SubprocessExecutor('/opt/aquilon/bin/aq.py')
+    assert executor.run(['del_host', '--hostname', 'missing']) == AqResult(4, '', 'Not Found: host missing')
+    assert mocked_run.call_args[0][0] == ['/opt/aquilon/bin/aq.py', 'del_host', '--hostname', 'missing']
+
+
+def test_load_transports():
+    assert BrokerExecutor.load_transports('testdata/aq_input.xml') == {
+        'add_machine': ('put', 'machine/%(machine)s'),
+        'add_interface': ('put', 'machine/%(machine)s/interface/%(interface)s'),
+        'add_host': ('put', 'host/%(hostname)s'),
+        'show_personality': ('get', 'archetype/%(archetype)s/personality/%(personality)s'),
+    }
+
+
+def test_broker_executor(fake_broker, mocker):
+    url = f'http://127.0.0.1:{fake_broker.server_port}/'
+    fallback = SimpleNamespace(name='aq.py', run=mocker.MagicMock(return_value=AqResult(0, 'ok', '')))
+    executor = BrokerExecutor(url, 'testdata/aq_input.xml', fallback=fallback)
+
+    assert executor.run(['add_machine', '--machine', 'system7592', '--model', 'r430']).returncode == 0
+    assert executor.run(['add_interface', '--machine', 'system7592', '--interface', 'eth0', '--boot']).returncode == 0
+    assert executor.run(['add_host', '--hostname', 'missing.example.org']) == AqResult(
+        4, '', 'Not Found: host missing',
+    )
+
+    # All commands should have been sent over a single connection
+    assert fake_broker.connections == 1
+    assert fake_broker.requests == [
+        ('PUT', '/machine/system7592', {'machine': ['system7592'], 'model': ['r430']}),
+        ('PUT', '/machine/system7592/interface/eth0', {
+            'machine': ['system7592'], 'interface': ['eth0'], 'boot': ['True'],
+        }),
+        ('PUT', '/host/missing.example.org', {'hostname': ['missing.example.org']}),
+    ]
+
+    # Commands the broker doesn't know how to route are passed to the fallback executor
+    assert executor.run(['reconfigure', '--hostname', 'foo.example.org']) == AqResult(0, 'ok', '')
+    fallback.run.assert_called_once_with(['reconfigure', '--hostname', 'foo.example.org'])
+
+    # Missing path options should be an error rather than a malformed request
+    assert executor.run(['add_machine', '--model', 'r430']).returncode == 2
+    assert len(fake_broker.requests) == 3
+
+    executor.close()
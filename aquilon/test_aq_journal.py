@@ -0,0 +1,57 @@
+"""
+Test cases for the aq command journal
+"""
+
+# pylint: disable=missing-function-docstring
+
+from aq_journal import Journal
+from aq_plan import CommandPlan
+
+CMDS = [
+    ['add_machine', '--machine', 'system6690'],
+    ['add_disk', '--machine', 'system6690', '--disk', 'sda'],
+    ['add_interface', '--machine', 'system6690', '--interface', 'eth0'],
+]
+
+
+def test_journal(tmp_path):
+    journal = Journal(str(tmp_path))
+    assert journal.load('device-5249') is None
+
+    journal.start('device-5249', CommandPlan.from_cmds(CMDS), input_hash='abc')
+    journal.record('device-5249', 'done', index=0)
+    journal.record('device-5249', 'done', index=2)
+    journal.record('device-5249', 'failed', index=1, returncode=4)
+
+    state = journal.incomplete('device-5249')
+    assert state['input_hash'] == 'abc'
+    assert state['plan'].cmds == CMDS
+    assert state['done'] == [0, 2]
+    assert not state['finished']
+
+    journal.record('device-5249', 'finished')
+    assert journal.load('device-5249')['finished']
+    assert journal.incomplete('device-5249') is None
+
+    # Starting a new plan replaces the old journal
+    journal.start('device-5249', CommandPlan.from_cmds(CMDS[:1]))
+    assert journal.incomplete('device-5249')['done'] == []
+
+
+def test_journal_partial_write(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.start('device-5249', CommandPlan.from_cmds(CMDS))
+    journal.record('device-5249', 'done', index=0)
+
+    # A crash while appending can leave part of a line at the end
+    with open(tmp_path / 'device-5249.jsonl', 'a', encoding='utf-8') as journal_file:
+        journal_file.write('{"event": "do')
+
+    assert journal.incomplete('device-5249')['done'] == [0]
+
+    # Later events are still read, so the journal can be finished
+    journal.record('device-5249', 'done', index=1)
+    journal.record('device-5249', 'finished')
+    state = journal.load('device-5249')
+    assert state['done'] == [0, 1]
+    assert state['finished']
@@ -0,0 +1,73 @@
+"""
+Test cases for aq command plans
+"""
+
+# pylint: disable=missing-function-docstring
+
+from aq_plan import CommandPlan, PlanStore, input_hash
+
+CMDS = [
+    ['add_machine', '--machine', 'system8211', '--model', 'r430', '--rack', 'b42-152'],
+    ['add_interface', '--machine', 'system8211', '--interface', 'bond0', '--iftype', 'bonding'],
+    ['update_interface', '--machine', 'system8211', '--interface', 'bond0', '--boot'],
+    ['add_interface', '--machine', 'system8211', '--interface', 'eth0', '--mac', 'A1:B2:C3:69:2A:A1'],
+    ['update_interface', '--machine', 'system8211', '--interface', 'eth0', '--master', 'bond0'],
+    ['add_interface', '--machine', 'system8211', '--interface', 'eth1', '--mac', 'A1:B2:C3:69:2A:A2'],
+    ['add_host', '--hostname', 'foo.example.org', '--machine', 'system8211', '--ip', '192.168.180.11'],
+    ['add_interface_address', '--machine', 'system8211', '--interface', 'eth1', '--ip', '192.168.180.13'],
+]
+
+
+def test_from_cmds():
+    plan = CommandPlan.from_cmds(CMDS)
+
+    assert len(plan) == len(CMDS)
+    assert list(plan) == CMDS
+    assert plan.deps == [
+        set(),
+        {0},
+        {0, 1},
+        {0},
+        {0, 2, 3},
+        {0},
+        {0, 1, 2, 3, 4, 5},
+        {0, 5, 6},
+    ]
+
+
+def test_from_cmds_barrier():
+    # Unknown commands must run after everything before them and before everything after them
+    cmds = CMDS[:2] + [['reconfigure', '--hostname', 'foo.example.org']] + CMDS[3:4]
+    assert CommandPlan.from_cmds(cmds).deps == [set(), {0}, {0, 1}, {0, 2}]
+    assert CommandPlan.from_cmds(cmds).is_sequential()
+
+
+def test_is_sequential():
+    assert not CommandPlan.from_cmds(CMDS).is_sequential()
+    assert CommandPlan.from_cmds(CMDS[:2]).is_sequential()
+    assert CommandPlan.from_cmds([]).is_sequential()
+    # Commands that only depend on the same earlier command can run at the same time
+    assert not CommandPlan([['a'], ['b'], ['c']], [set(), {0}, {0}]).is_sequential()
+
+
+def test_input_hash():
+    assert input_hash(CMDS) == input_hash([list(cmd) for cmd in CMDS])
+    assert input_hash(CMDS) != input_hash(CMDS[:-1])
+
+
+def test_plan_store(tmp_path):
+    store = PlanStore(str(tmp_path))
+    plan = CommandPlan.from_cmds(CMDS)
+
+    filename = store.save('device-5249', plan, device='foo', input_hash='abc')
+    details, loaded = PlanStore.load(filename)
+    assert details['key'] == 'device-5249'
+    assert details['device'] == 'foo'
+    assert details['input_hash'] == 'abc'
+    assert loaded.cmds == plan.cmds
+    assert loaded.deps == plan.deps
+
+    assert store.get_applied('device-5249') is None
+    store.set_applied('device-5249', 'abc')
+    assert store.get_applied('device-5249') == 'abc'
+    assert PlanStore(str(tmp_path)).get_applied('device-5249') == 'abc'
@@ -0,0 +1,113 @@
+"""
+Test cases for aq_reconcile
+"""
+
+# pylint: disable=missing-function-docstring
+
+from aq_reconcile import MachineState, reconcile
+
+MACHINE = 'netbox-5249'
+
+PLANNED_CMDS = [
+    ['add_machine', '--machine', MACHINE, '--model', 'poweredge_r640', '--rack', 'r89-42'],
+    ['add_interface', '--machine', MACHINE, '--interface', 'bond0', '--iftype', 'bonding'],
+    ['add_interface', '--machine', MACHINE, '--interface', 'eth0', '--mac', 'A1:B2:C3:D4:E5:DA'],
+    ['update_interface', '--machine', MACHINE, '--interface', 'eth0', '--boot'],
+    ['update_interface', '--machine', MACHINE, '--interface', 'eth0', '--master', 'bond0'],
+    ['add_interface', '--machine', MACHINE, '--interface', 'eth1', '--mac', 'A1:B2:C3:D4:E5:DB'],
+    ['add_host', '--hostname', 'foo.example.org', '--machine', MACHINE, '--ip', '192.168.1.10'],
+    ['add_interface_address', '--machine', MACHINE, '--interface', 'eth1', '--ip', '10.0.0.5', '--fqdn',
+     'foo-data.example.org'],
+]
+
+
+def current_machine(**changes):
+    """ Aquilon's view of the machine created by PLANNED_CMDS, with any changes applied """
+    machine = {
+        'name': MACHINE,
+        'rack': {'name': 'r89-42'},
+        'host': {'hostname': 'foo.example.org', 'ip': '192.168.1.10'},
+        'interfaces': [
+            {'device': 'bond0', 'bootable': False},
+            {'device': 'eth0', 'mac': 'a1:b2:c3:d4:e5:da', 'bootable': True, 'master': 'bond0',
+             'ip': '192.168.1.10', 'fqdn': 'foo.example.org'},
+            {'device': 'eth1', 'mac': 'a1:b2:c3:d4:e5:db', 'bootable': False,
+             'addresses': [{'ip': '10.0.0.5', 'fqdn': 'foo-data.example.org'}]},
+        ],
+        'disks': [],
+    }
+    machine.update(changes)
+    return {'machines': [machine]}
+
+
+def test_from_cmds():
+    state = MachineState.from_cmds(PLANNED_CMDS)
+    assert state.name == MACHINE
+    assert state.options == {'--rack': 'r89-42'}
+    assert state.interfaces['eth0'] == {'mac': 'a1:b2:c3:d4:e5:da', 'boot': True, 'master': 'bond0'}
+    assert state.interfaces['bond0'] == {'mac': None, 'boot': False, 'master': None}
+    assert state.addresses == {'10.0.0.5': ('eth1', 'foo-data.example.org')}
+    assert state.host == ('foo.example.org', '192.168.1.10')
+    assert len(state.cmds[('interface', 'eth0')]) == 3
+
+
+def test_from_aq():
+    state = MachineState.from_aq(current_machine())
+    assert state.options == {'--rack': 'r89-42'}
+    assert state.interfaces['eth0'] == {'mac': 'a1:b2:c3:d4:e5:da', 'boot': True, 'master': 'bond0'}
+    # The primary address belongs to the host
+    assert state.addresses == {'10.0.0.5': ('eth1', 'foo-data.example.org')}
+
+
+def test_reconcile():
+    planned = MachineState.from_cmds(PLANNED_CMDS)
+
+    # Nothing to do if Aquilon already matches
+    assert not reconcile(MachineState.from_aq(current_machine()), planned)
+
+    # A machine without anything on it gets everything but the machine itself
+    assert reconcile(MachineState.from_aq(current_machine(interfaces=[], host=None)), planned) == PLANNED_CMDS[1:]
+
+    # Changes are applied in place, removals before additions
+    current = current_machine(rack={'name': 'r89-43'}, disks=[{'device_name': 'sda', 'capacity': 100}])
+    interfaces = current['machines'][0]['interfaces']
+    interfaces[1]['mac'] = 'a1:b2:c3:d4:e5:ff'
+    interfaces[2] = {'device': 'eth2', 'addresses': [{'ip': '10.0.0.5', 'fqdn': 'foo-data.example.org'}]}
+    assert reconcile(MachineState.from_aq(current), planned) == [
+        ['del_interface_address', '--machine', MACHINE, '--interface', 'eth2', '--ip', '10.0.0.5'],
+        ['del_disk', '--machine', MACHINE, '--disk', 'sda'],
+        ['del_interface', '--machine', MACHINE, '--interface', 'eth2'],
+        ['update_machine', '--machine', MACHINE, '--rack', 'r89-42'],
+        ['update_interface', '--machine', MACHINE, '--interface', 'eth0', '--mac', 'a1:b2:c3:d4:e5:da'],
+        PLANNED_CMDS[5],
+        PLANNED_CMDS[7],
+    ]
+
+
+def test_reconcile_disks():
+    planned = MachineState.from_cmds([
+        ['add_machine', '--machine', 'netboxvm-763', '--cluster', 'tier1_cluster', '--memory', '8192'],
+        ['add_disk', '--machine', 'netboxvm-763', '--disk', 'sda', '--size', '100', '--boot'],
+        ['add_disk', '--machine', 'netboxvm-763', '--disk', 'sdb', '--size', '50'],
+    ])
+
+    current = MachineState.from_aq({
+        'name': 'netboxvm-763',
+        'cluster': 'tier1_cluster',
+        'memory': 4096,
+        'disks': [{'device_name': 'sda', 'capacity': 80, 'bootable': True}],
+    })
+    assert reconcile(current, planned) == [
+        ['update_machine', '--machine', 'netboxvm-763', '--memory', '8192'],
+        ['update_disk', '--machine', 'netboxvm-763', '--disk', 'sda', '--size', '100'],
+        ['add_disk', '--machine', 'netboxvm-763', '--disk', 'sdb', '--size', '50'],
+    ]
+
+    # Boot flags are only changed if Aquilon says they are unset
+    current = MachineState.from_aq({'name': 'netboxvm-763', 'disks': [
+        {'device_name': 'sda', 'capacity': 100, 'bootable': False},
+        {'device_name': 'sdb', 'capacity': 50},
+    ]})
+    assert reconcile(current, planned) == [
+        ['update_disk', '--machine', 'netboxvm-763', '--disk', 'sda', '--size', '100', '--boot'],
+    ]
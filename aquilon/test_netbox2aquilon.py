@@ -4,54 +4,98 @@ Test cases for netbox2aquilon
 
 # pylint: disable=protected-access,missing-function-docstring
 
-import subprocess
+import concurrent.futures
+import os.path
+import time
 
 from copy import deepcopy
 from types import SimpleNamespace
 
+import pytest
+
+from aq_executor import AqResult, BrokerExecutor, SubprocessExecutor
+from aq_journal import Journal
+from aq_plan import CommandPlan, PlanStore
 from netbox2aquilon import Netbox2Aquilon
+from netbox_dump_subnetdata import NetboxDumpSubnetdata
+from prefix_index import PrefixIndex
+from scd_netbox import DeviceSnapshot
 
 import testdata
 
 FAKE = testdata.load_data()
 
 
-def test_get_current_sandbox(mocker):
+def test_get_current_sandbox(mocker, tmp_path):
     test_obj = Netbox2Aquilon()
 
-    # git rev-parse succeeds
-    mocker.patch.object(subprocess, 'run', return_value=SimpleNamespace(
-        returncode=0,
-        stdout=b'/var/quattor/templates/abc12345/my_sandbox',
-        stderr=b'',
-    ))
-    assert test_obj.get_current_sandbox() == 'abc12345/my_sandbox'
+    # Inside a sandbox, at any depth
+    sandbox = tmp_path / 'abc12345' / 'my_sandbox'
+    (sandbox / '.git').mkdir(parents=True)
+    (sandbox / 'site' / 'ral').mkdir(parents=True)
+    assert test_obj.get_current_sandbox(str(sandbox)) == 'abc12345/my_sandbox'
+    assert test_obj.get_current_sandbox(str(sandbox / 'site' / 'ral')) == 'abc12345/my_sandbox'
 
-    # git rev-parse succeeds, but the path returned isn't deep enough to be a sandbox
-    mocker.patch.object(subprocess, 'run', return_value=SimpleNamespace(
-        returncode=0,
-        stdout=b'/opt',
-        stderr=b'',
-    ))
-    assert test_obj.get_current_sandbox() is None
+    # Not in a git checkout
+    assert test_obj.get_current_sandbox(str(tmp_path / 'abc12345')) is None
 
-    # git rev-parse fails
-    mocker.patch.object(subprocess, 'run', return_value=SimpleNamespace(
-        returncode=128,
-        stdout=b'',
-        stderr=b'fatal: Not a git repository (or any parent up to mount point /var/quattor)',
-    ))
-    assert test_obj.get_current_sandbox() is None
+    # In a git checkout, but the path isn't deep enough to be a sandbox
+    mocker.patch.object(os.path, 'exists', side_effect=lambda path: path == '/.git')
+    assert test_obj.get_current_sandbox('/opt') is None
+
+
+def test_aq_executor():
+    test_obj = Netbox2Aquilon()
+    executor = test_obj.aq_executor
+    assert isinstance(executor, SubprocessExecutor)
+    assert test_obj.aq_executor is executor
+
+    # A persistent broker session should be used when configured
+    test_obj = Netbox2Aquilon()
+    test_obj.config['aquilon']['executor'] = 'broker'
+    test_obj.config['aquilon']['input_xml'] = 'testdata/aq_input.xml'
+    assert isinstance(test_obj.aq_executor, BrokerExecutor)
+    assert isinstance(test_obj.aq_executor.fallback, SubprocessExecutor)
+
+    # Falling back to subprocesses if the broker session can't be set up
+    test_obj = Netbox2Aquilon()
+    test_obj.config['aquilon']['executor'] = 'broker'
+    test_obj.config['aquilon']['input_xml'] = 'testdata/does_not_exist.xml'
+    assert isinstance(test_obj.aq_executor, SubprocessExecutor)
 
 
-def test__netbox_copy_interfaces(mocker):
+def test_aq_executor_shared(mocker):
+    test_obj = Netbox2Aquilon()
+    test_obj.config['aquilon']['executor'] = 'broker'
+    test_obj.config['aquilon']['input_xml'] = 'testdata/aq_input.xml'
+
+    # Threads asking for the executor at the same time should share a single broker session
+    create_aq_executor = test_obj._create_aq_executor
+    test_obj._create_aq_executor = mocker.MagicMock(side_effect=lambda: time.sleep(0.05) or create_aq_executor())
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        executors = list(pool.map(lambda _: test_obj.aq_executor, range(8)))
+    test_obj._create_aq_executor.assert_called_once()
+    assert all(executor is executors[0] for executor in executors)
+    assert isinstance(executors[0], BrokerExecutor)
+
+    # Closing shuts down the pool and the session, so they are set up again if needed
+    pool = test_obj.aq_pool
+    executors[0].session.close = mocker.MagicMock()
+    test_obj.close()
+    executors[0].session.close.assert_called_once()
+    assert test_obj.aq_executor is not executors[0]
+    assert test_obj.aq_pool is not pool
+    test_obj.close()
+
+
+def test__netbox_copy_interfaces():
     test_obj = Netbox2Aquilon()
 
     # Physical devices with a management interface
     fake_device = SimpleNamespace(
         aq_machine_name='system7592',
     )
-    test_obj.get_interfaces_from_device = mocker.MagicMock(return_value=deepcopy(FAKE.INTERFACES_PHYSICAL[:-1]))
+    fake_interfaces = deepcopy(FAKE.INTERFACES_PHYSICAL[:-1])
 
     add_interface_base_cmd = ['add_interface', '--machine', 'system7592']
 
@@ -61,7 +105,7 @@ def test__netbox_copy_interfaces(mocker):
 
     update_eth0 = ['update_interface', '--machine', 'system7592', '--interface', 'eth0', '--boot']
 
-    cmds = test_obj._netbox_copy_interfaces(fake_device)
+    cmds = test_obj._netbox_copy_interfaces(DeviceSnapshot(fake_device, interfaces=fake_interfaces))
 
     assert len(cmds) == 4
     assert add_bmc0 in cmds
@@ -76,12 +120,12 @@ def test__netbox_copy_interfaces(mocker):
     fake_device = SimpleNamespace(
         aq_machine_name='system6690',
     )
-    test_obj.get_interfaces_from_device = mocker.MagicMock(return_value=deepcopy(FAKE.INTERFACES_VIRTUAL))
+    fake_interfaces = deepcopy(FAKE.INTERFACES_VIRTUAL)
     add_eth0 = ['add_interface', '--machine', 'system6690', '--interface', 'eth0', '--mac', 'A1:B2:C3:D4:E5:1B']
     add_eth1 = ['add_interface', '--machine', 'system6690', '--interface', 'eth1', '--mac', 'A1:B2:C3:D4:E5:99']
     update_eth0 = ['update_interface', '--machine', 'system6690', '--interface', 'eth0', '--boot']
 
-    cmds = test_obj._netbox_copy_interfaces(fake_device)
+    cmds = test_obj._netbox_copy_interfaces(DeviceSnapshot(fake_device, interfaces=fake_interfaces))
 
     assert len(cmds) == 3
     assert add_eth0 in cmds
@@ -95,12 +139,12 @@ def test__netbox_copy_interfaces(mocker):
     fake_device = SimpleNamespace(
         aq_machine_name='system8211',
     )
-    test_obj.get_interfaces_from_device = mocker.MagicMock(return_value=deepcopy(FAKE.INTERFACES_PHYSICAL_LAGS))
+    fake_interfaces = deepcopy(FAKE.INTERFACES_PHYSICAL_LAGS)
 
     add_interface_base_cmd = ['add_interface', '--machine', 'system8211']
     update_interface_base_cmd = ['update_interface', '--machine', 'system8211']
 
-    cmds = test_obj._netbox_copy_interfaces(fake_device)
+    cmds = test_obj._netbox_copy_interfaces(DeviceSnapshot(fake_device, interfaces=fake_interfaces))
 
     assert len(cmds) == 12
 
@@ -121,21 +165,23 @@ def test__netbox_copy_interfaces(mocker):
     #assert cmds.index(add_eth0) < cmds.index(update_eth0)
 
 
-def test__netbox_copy_addresses(mocker):
+def test__netbox_copy_addresses():
     test_obj = Netbox2Aquilon()
 
     fake_device = FAKE.DEVICE_PHYSICAL
     fake_device.aq_machine_name = 'system7592'
 
     # No addresses on an interface
-    test_obj.get_interfaces_from_device = mocker.MagicMock(return_value=[deepcopy(FAKE.INTERFACES_PHYSICAL)[1]])
-    test_obj.get_addresses_from_interface = mocker.MagicMock(return_value=[])
-    assert not test_obj._netbox_copy_addresses(fake_device)
+    snapshot = DeviceSnapshot(fake_device, interfaces=[deepcopy(FAKE.INTERFACES_PHYSICAL)[1]], addresses={})
+    assert not test_obj._netbox_copy_addresses(snapshot)
 
     # Addresses on an interface
-    test_obj.get_interfaces_from_device = mocker.MagicMock(return_value=[deepcopy(FAKE.INTERFACES_PHYSICAL[1])])
-    test_obj.get_addresses_from_interface = mocker.MagicMock(return_value=deepcopy(FAKE.ADDRESSES_IPV4))
-    assert test_obj._netbox_copy_addresses(fake_device) == [
+    snapshot = DeviceSnapshot(
+        fake_device,
+        interfaces=[deepcopy(FAKE.INTERFACES_PHYSICAL[1])],
+        addresses={34624: deepcopy(FAKE.ADDRESSES_IPV4)},
+    )
+    assert test_obj._netbox_copy_addresses(snapshot) == [
         [
             'add_interface_address', '--machine',
             'system7592', '--interface',
@@ -148,6 +194,9 @@ def test__netbox_copy_addresses(mocker):
 def test__netbox_get_personality(mocker):
     test_obj = Netbox2Aquilon()
 
+    # Pretend personalities can't be listed, so that each one is checked individually
+    test_obj._query_aq = mocker.MagicMock(return_value=None)
+
     fake_devices = [
         # Tuple containing the device object and the name of role attribute in this device type
         (deepcopy(FAKE.DEVICE_PHYSICAL), 'device_role'),
@@ -168,6 +217,8 @@ def test__netbox_get_personality(mocker):
             # All combinations of role and tenant, pretending that aquilon will accept any personality
             # Should return 'inventory' unless both role and tenant are set
             test_obj._call_aq = mocker.MagicMock(return_value=0)
+            # Checks are remembered, forget them as the broker's answer changes
+            test_obj._personality_checks.clear()
 
             setattr(dev, role_attr, None)
             dev.tenant = None
@@ -189,6 +240,7 @@ def test__netbox_get_personality(mocker):
             # All combinations of role and tenant, pretending that aquilon will not accept anything
             # Should always return 'inventory'
             test_obj._call_aq = mocker.MagicMock(return_value=1)
+            test_obj._personality_checks.clear()
 
             setattr(dev, role_attr, None)
             dev.tenant = None
@@ -207,6 +259,58 @@ def test__netbox_get_personality(mocker):
             assert test_obj._netbox_get_personality(dev, 'fake_archetype', opt) == 'inventory'
 
 
+def test__aq_personality_exists(mocker, tmp_path):
+    test_obj = Netbox2Aquilon()
+    test_obj._call_aq = mocker.MagicMock(return_value=0)
+    test_obj._query_aq = mocker.MagicMock(return_value='ral-tier1/inventory\nral-tier1/server-tier1\n')
+
+    # Personalities should be listed once per archetype, without checking each one
+    assert test_obj._aq_personality_exists('ral-tier1', 'server-tier1')
+    assert test_obj._aq_personality_exists('ral-tier1', 'inventory')
+    assert not test_obj._aq_personality_exists('ral-tier1', 'server-cloud')
+    test_obj._query_aq.assert_called_once_with(['search_personality', '--archetype', 'ral-tier1'])
+    test_obj._call_aq.assert_not_called()
+
+    # The listing is refreshed once it is older than personality_refresh
+    clock = mocker.patch.object(time, 'monotonic', return_value=1000.0)
+    test_obj = Netbox2Aquilon()
+    test_obj._query_aq = mocker.MagicMock(return_value='ral-tier1/inventory\n')
+    assert not test_obj._aq_personality_exists('ral-tier1', 'server-tier1')
+    clock.return_value = 1200.0
+    assert not test_obj._aq_personality_exists('ral-tier1', 'server-tier1')
+    assert test_obj._query_aq.call_count == 1
+    clock.return_value = 1400.0
+    test_obj._query_aq.return_value = 'ral-tier1/inventory\nral-tier1/server-tier1\n'
+    assert test_obj._aq_personality_exists('ral-tier1', 'server-tier1')
+    assert test_obj._query_aq.call_count == 2
+
+    # If the archetype can't be listed, each personality is only checked once until the next refresh
+    test_obj = Netbox2Aquilon()
+    test_obj._query_aq = mocker.MagicMock(return_value=None)
+    test_obj._call_aq = mocker.MagicMock(return_value=0)
+    for _ in range(3):
+        assert test_obj._aq_personality_exists('ral-tier1', 'inventory')
+    test_obj._call_aq.assert_called_once()
+    clock.return_value = 1800.0
+    assert test_obj._aq_personality_exists('ral-tier1', 'inventory')
+    assert test_obj._call_aq.call_count == 2
+    assert test_obj._query_aq.call_count == 2
+
+    # With an on-disk TTL, the listing should be reused by the next run
+    test_obj = Netbox2Aquilon()
+    test_obj.config['cache']['path'] = str(tmp_path)
+    test_obj.config['aquilon']['personality_ttl'] = '3600'
+    test_obj._query_aq = mocker.MagicMock(return_value='ral-tier1/inventory\n')
+    assert test_obj._aq_personality_exists('ral-tier1', 'inventory')
+
+    test_obj = Netbox2Aquilon()
+    test_obj.config['cache']['path'] = str(tmp_path)
+    test_obj.config['aquilon']['personality_ttl'] = '3600'
+    test_obj._query_aq = mocker.MagicMock()
+    assert test_obj._aq_personality_exists('ral-tier1', 'inventory')
+    test_obj._query_aq.assert_not_called()
+
+
 def test__undo_cmds():
     test_obj = Netbox2Aquilon()
 
@@ -303,15 +407,13 @@ def test__undo_cmds():
     assert test_obj._undo_cmds(cmds_forward) == cmds_reverse
 
 
-def test__netbox_copy_vm_disks(mocker):
+def test__netbox_copy_vm_disks():
     test_obj = Netbox2Aquilon()
 
-    test_obj.get_disks_from_device = mocker.MagicMock(return_value=deepcopy(FAKE.DISKS_VIRTUAL))
-
     fake_device = FAKE.DEVICE_VIRTUAL
     fake_device.aq_machine_name = 'netboxvm-243'
 
-    cmds = test_obj._netbox_copy_vm_disks(fake_device)
+    cmds = test_obj._netbox_copy_vm_disks(DeviceSnapshot(fake_device, disks=deepcopy(FAKE.DISKS_VIRTUAL)))
 
     assert cmds == [
         [
@@ -338,3 +440,325 @@ def test__netbox_copy_vm_disks(mocker):
             '--comments', '"/opt"',
         ],
     ]
+
+
+def test__parse_selector():
+    test_obj = Netbox2Aquilon()
+
+    assert test_obj._parse_selector(['tenant=tier1', 'rack=368', 'tag=foo', 'tag=bar']) == {
+        'tenant': ['tier1'],
+        'rack_id': ['368'],
+        'tag': ['foo', 'bar'],
+    }
+
+    # Unknown keys and missing values should exit with a usage error
+    for selector in (['colour=blue'], ['site'], ['site=']):
+        with pytest.raises(SystemExit):
+            test_obj._parse_selector(selector)
+
+
+def test_netbox_copy_batch(mocker, tmp_path, capsys):
+    test_obj = Netbox2Aquilon()
+
+    hostlist = tmp_path / 'hostlist'
+    hostlist.write_text('# Rack 152\nfoo.example.org\n\nbar.example.org  # awaiting repair\nbaz.example.org\n')
+
+    test_obj.resolve_hostnames = mocker.MagicMock(return_value=(
+        {'foo.example.org': deepcopy(FAKE.DEVICE_PHYSICAL), 'bar.example.org': deepcopy(FAKE.DEVICE_PHYSICAL)},
+        ['baz.example.org'],
+        [],
+    ))
+    test_obj.get_device_snapshots = mocker.MagicMock(side_effect=lambda devices: [
+        DeviceSnapshot(device) for device in devices
+    ])
+    test_obj.copy_device = mocker.MagicMock(side_effect=[True, False])
+
+    opts = SimpleNamespace(hostlist=str(hostlist), select=None)
+    with pytest.raises(SystemExit) as exit_info:
+        test_obj.netbox_copy_batch(opts)
+
+    # A single failed host must not stop the rest of the batch, but should fail the run
+    assert exit_info.value.code == 1
+    # Every host is looked up at once
+    test_obj.resolve_hostnames.assert_called_once_with(['foo.example.org', 'bar.example.org', 'baz.example.org'])
+    test_obj.get_device_snapshots.assert_called_once()
+    assert test_obj.copy_device.call_count == 2
+
+    summary = capsys.readouterr().out.splitlines()
+    assert summary == [
+        'OK     foo.example.org',
+        'FAILED bar.example.org',
+        'FAILED baz.example.org',
+        '1 of 3 hosts copied successfully',
+    ]
+
+
+def test_copy_device_skip_unchanged(mocker, tmp_path):
+    test_obj = Netbox2Aquilon()
+    test_obj.plans = PlanStore(str(tmp_path))
+    device = deepcopy(FAKE.DEVICE_PHYSICAL)
+    device.primary_ip4 = SimpleNamespace(dns_name='foo.example.org', address='192.168.180.11/24')
+    opts = SimpleNamespace(
+        sandbox=None, domain='prod', archetype='ral-tier1', osname='rocky', osversion='8x-x86_64', dryrun=False,
+        reconcile=False, skip_unchanged=True, resume=False, rollback=False,
+    )
+
+    machine_cmd = ['add_machine', '--machine', 'netbox-5249']
+    test_obj._netbox_copy_device = mocker.MagicMock(side_effect=lambda _: [list(machine_cmd)])
+    test_obj._netbox_copy_interfaces = mocker.MagicMock(return_value=[])
+    test_obj._netbox_copy_addresses = mocker.MagicMock(return_value=[])
+    test_obj._netbox_get_personality = mocker.MagicMock(return_value='ral-tier1-default')
+    test_obj._execute_plan = mocker.MagicMock(return_value=True)
+
+    # The plan is saved and applied the first time
+    assert test_obj.copy_device(device, opts, snapshot=DeviceSnapshot(device))
+    test_obj._execute_plan.assert_called_once()
+    details, plan = PlanStore.load(str(tmp_path / 'device-5249.json'))
+    assert details['machine'] == 'system7592'
+    assert plan.cmds[0] == ['add_machine', '--machine', 'netbox-5249']
+    assert plan.cmds[-1][0] == 'add_host'
+    assert test_obj.plans.get_applied('device-5249') == details['input_hash']
+
+    # Then skipped while nothing changes in NetBox
+    assert test_obj.copy_device(device, opts, snapshot=DeviceSnapshot(device))
+    test_obj._execute_plan.assert_called_once()
+
+    machine_cmd += ['--memory', '1024']
+    assert test_obj.copy_device(device, opts, snapshot=DeviceSnapshot(device))
+    assert test_obj._execute_plan.call_count == 2
+
+    # Reconciling a machine whose state can't be read fails the device without running anything
+    machine_cmd += ['--cpucount', '2']
+    opts.reconcile = True
+    test_obj._reconcile_cmds = mocker.MagicMock(return_value=None)
+    assert not test_obj.copy_device(device, opts, snapshot=DeviceSnapshot(device))
+    assert test_obj._execute_plan.call_count == 2
+
+
+def test_netbox_replay(mocker, tmp_path, capsys):
+    test_obj = Netbox2Aquilon()
+    test_obj.plans = PlanStore(str(tmp_path))
+    filename = test_obj.plans.save(
+        'device-5249', CommandPlan.from_cmds([['add_machine', '--machine', 'netbox-5249']]),
+        device='foo', input_hash='abc',
+    )
+    (tmp_path / 'old.json').write_text('{"version": 0}')
+    test_obj._execute_plan = mocker.MagicMock(return_value=True)
+
+    opts = SimpleNamespace(
+        replay=[filename, str(tmp_path / 'old.json')], skip_unchanged=True, dryrun=False, resume=False, rollback=False,
+    )
+    with pytest.raises(SystemExit) as exit_info:
+        test_obj.netbox_replay(opts)
+
+    # Plans run without NetBox and are recorded as applied, unreadable plans fail the run
+    assert exit_info.value.code == 1
+    assert test_obj._execute_plan.call_args[0][0].cmds == [['add_machine', '--machine', 'netbox-5249']]
+    assert test_obj.plans.get_applied('device-5249') == 'abc'
+    assert capsys.readouterr().out.splitlines() == [
+        'OK     foo',
+        f'FAILED {tmp_path / "old.json"}',
+        '1 of 2 plans replayed successfully',
+    ]
+
+    # Replaying a plan that has already been applied does nothing
+    opts.replay = [filename]
+    with pytest.raises(SystemExit) as exit_info:
+        test_obj.netbox_replay(opts)
+    assert exit_info.value.code == 0
+    test_obj._execute_plan.assert_called_once()
+
+
+def test_journal_resume_and_rollback(mocker, tmp_path):
+    test_obj = Netbox2Aquilon()
+    test_obj.journal = Journal(str(tmp_path))
+    cmds = [
+        ['add_machine', '--machine', 'system6690'],
+        ['add_disk', '--machine', 'system6690', '--disk', 'sda'],
+        ['add_interface', '--machine', 'system6690', '--interface', 'eth0'],
+    ]
+    opts = SimpleNamespace(resume=False, rollback=False, dryrun=False)
+
+    # A failure leaves the completed commands in place, instead of undoing them
+    test_obj._call_aq = mocker.MagicMock(side_effect=[0, 0, 1])
+    assert not test_obj._apply_plan('virtualmachine-763', 'abc', CommandPlan.from_cmds(cmds))
+    assert test_obj._call_aq.call_count == 3
+    assert test_obj.journal.incomplete('virtualmachine-763')['done'] == [0, 1]
+
+    # Nothing else can be run for the device until it is resumed or rolled back
+    assert test_obj._continue_journal('virtualmachine-763', opts) is None
+    assert not test_obj._apply_plan('virtualmachine-763', 'abc', CommandPlan.from_cmds(cmds))
+    assert test_obj._call_aq.call_count == 3
+
+    # Resuming starts from the command that failed
+    opts.resume = True
+    test_obj._call_aq = mocker.MagicMock(return_value=0)
+    assert test_obj._continue_journal('virtualmachine-763', opts)
+    test_obj._call_aq.assert_called_once_with(cmds[2])
+    assert test_obj.journal.incomplete('virtualmachine-763') is None
+    assert test_obj.journal.load('virtualmachine-763')['done'] == [0, 1, 2]
+
+    # Finished plans can't be resumed, so the device is planned again
+    assert test_obj._continue_journal('virtualmachine-763', opts) is None
+
+    # Rolling back undoes the completed commands in reverse
+    test_obj._call_aq = mocker.MagicMock(side_effect=[0, 0, 1])
+    assert not test_obj._apply_plan('virtualmachine-763', 'abc', CommandPlan.from_cmds(cmds))
+    opts.resume = False
+    opts.rollback = True
+    test_obj._call_aq = mocker.MagicMock(return_value=0)
+    assert test_obj._continue_journal('virtualmachine-763', opts)
+    assert [c[0][0] for c in test_obj._call_aq.call_args_list] == [
+        ['del_disk', '--machine', 'system6690', '--disk', 'sda'],
+        ['del_machine', '--machine', 'system6690'],
+    ]
+    assert test_obj.journal.incomplete('virtualmachine-763') is None
+
+
+def test_journal_first_command_fails(mocker, tmp_path):
+    test_obj = Netbox2Aquilon()
+    test_obj.journal = Journal(str(tmp_path))
+    cmds = [
+        ['add_machine', '--machine', 'system6690'],
+        ['add_disk', '--machine', 'system6690', '--disk', 'sda'],
+    ]
+
+    # Nothing completed, so there is nothing to resume or roll back
+    test_obj._call_aq = mocker.MagicMock(return_value=1)
+    assert not test_obj._apply_plan('virtualmachine-763', 'abc', CommandPlan.from_cmds(cmds))
+    test_obj._call_aq.assert_called_once_with(cmds[0])
+    assert test_obj.journal.incomplete('virtualmachine-763') is None
+
+    # A plain run afterwards is allowed to run the plan again
+    test_obj._call_aq = mocker.MagicMock(return_value=0)
+    assert test_obj._apply_plan('virtualmachine-763', 'abc', CommandPlan.from_cmds(cmds))
+    assert test_obj._call_aq.call_count == 2
+
+    # A resumed plan whose next command fails is still left to be resumed, as earlier commands completed
+    test_obj._call_aq = mocker.MagicMock(side_effect=[0, 1])
+    assert not test_obj._apply_plan('virtualmachine-763', 'abc', CommandPlan.from_cmds(cmds))
+    test_obj._call_aq = mocker.MagicMock(return_value=1)
+    opts = SimpleNamespace(resume=True, rollback=False, dryrun=False)
+    assert not test_obj._continue_journal('virtualmachine-763', opts)
+    assert test_obj.journal.incomplete('virtualmachine-763')['done'] == [0]
+
+
+def test_validate_addresses(mocker):
+    test_obj = Netbox2Aquilon()
+    mocker.patch.object(NetboxDumpSubnetdata, 'get_subnet_fields_incremental', return_value=[
+        {'SubnetAddress': '192.168.180.0', 'SubnetMask': '24', 'SubnetName': 'foo'},
+    ])
+    test_obj.prefix_index = test_obj.get_prefix_index()
+    assert isinstance(test_obj.prefix_index, PrefixIndex)
+    test_obj._call_aq = mocker.MagicMock(return_value=0)
+
+    cmds = [
+        ['add_machine', '--machine', 'system6690'],
+        ['add_host', '--hostname', 'foo.example.org', '--machine', 'system6690', '--ip', '192.168.180.11'],
+        ['add_interface_address', '--machine', 'system6690', '--interface', 'eth1', '--ip', '192.168.181.13'],
+    ]
+    assert test_obj._find_unknown_addresses(cmds) == ['192.168.181.13']
+    # Only the Global VRF is indexed, addresses in other network environments can't be checked
+    assert not test_obj._find_unknown_addresses([
+        ['add_interface_address', '--machine', 'system6690', '--interface', 'eth1', '--ip', '10.10.0.1',
+         '--network_environment', 'cloud'],
+    ])
+
+    # Nothing is run for hosts with addresses aquilon doesn't know about
+    assert not test_obj._apply_plan('virtualmachine-763', 'abc', CommandPlan.from_cmds(cmds))
+    test_obj._call_aq.assert_not_called()
+
+    assert test_obj._apply_plan('virtualmachine-763', 'abc', CommandPlan.from_cmds(cmds[:2]))
+    assert test_obj._call_aq.call_count == 2
+
+
+def test__call_aq_plan(mocker):
+    test_obj = Netbox2Aquilon()
+    test_obj.config['aquilon']['workers'] = '4'
+
+    cmds = [
+        ['add_machine', '--machine', 'system6690'],
+        ['add_disk', '--machine', 'system6690', '--disk', 'sda'],
+        ['add_interface', '--machine', 'system6690', '--interface', 'eth0'],
+        ['add_interface', '--machine', 'system6690', '--interface', 'eth1'],
+        ['update_interface', '--machine', 'system6690', '--interface', 'eth0', '--boot'],
+        ['add_host', '--hostname', 'www.example.org', '--machine', 'system6690'],
+    ]
+    plan = CommandPlan.from_cmds(cmds)
+
+    # Every command should be run once, each after all of its dependencies
+    test_obj._call_aq = mocker.MagicMock(return_value=0)
+    cmds_executed = test_obj._call_aq_plan(plan)
+    assert sorted(cmds_executed) == sorted(cmds)
+    for index, cmd in enumerate(cmds):
+        for dep in plan.deps[index]:
+            assert cmds_executed.index(cmds[dep]) < cmds_executed.index(cmd)
+
+    # A failure should stop dependent commands from running and be undoable from what completed
+    test_obj._call_aq = mocker.MagicMock(side_effect=lambda cmd: 4 if 'eth1' in cmd else 0)
+    cmds_executed = test_obj._call_aq_plan(plan)
+    assert cmds[3] not in cmds_executed
+    assert cmds[5] not in cmds_executed
+    assert cmds_executed[0] == cmds[0]
+    assert test_obj._undo_cmds(cmds_executed)[-1] == ['del_machine', '--machine', 'system6690']
+
+    # Every plan shares the same pool
+    pool = test_obj.aq_pool
+    test_obj._call_aq = mocker.MagicMock(return_value=0)
+    test_obj._call_aq_plan(plan)
+    assert test_obj.aq_pool is pool
+
+    # Plans where nothing can run at the same time are run without the pool
+    test_obj._aq_pool = mocker.MagicMock()
+    test_obj._call_aq = mocker.MagicMock(return_value=0)
+    assert test_obj._call_aq_plan(CommandPlan.from_cmds([cmds[0], cmds[2], cmds[4]])) == [cmds[0], cmds[2], cmds[4]]
+    test_obj._aq_pool.submit.assert_not_called()
+
+
+def test__call_aq_stats(mocker):
+    test_obj = Netbox2Aquilon()
+    test_obj._aq_executor = SimpleNamespace(
+        name='fake',
+        run=mocker.MagicMock(side_effect=lambda cmd: AqResult(4 if 'eth1' in cmd else 0, 'done\n', '')),
+    )
+
+    # Every command run should be recorded by name, along with any failures
+    assert test_obj._call_aq(['add_interface', '--interface', 'eth0']) == 0
+    assert test_obj._call_aq(['add_interface', '--interface', 'eth1']) == 4
+    assert test_obj._query_aq(['search_personality', '--archetype', 'ral-tier1']) == 'done\n'
+
+    stats = test_obj.stats.to_dict()['aq']
+    assert stats['add_interface']['count'] == 2
+    assert stats['add_interface']['errors'] == 1
+    assert stats['add_interface']['bytes'] == 10
+    assert stats['search_personality']['count'] == 1
+
+
+def test__reconcile_cmds(mocker):
+    test_obj = Netbox2Aquilon()
+    cmds = [
+        ['add_machine', '--machine', 'netbox-5249', '--model', 'poweredge_r640', '--rack', 'r89-42'],
+        ['add_interface', '--machine', 'netbox-5249', '--interface', 'eth0', '--mac', 'A1:B2:C3:D4:E5:DA'],
+    ]
+
+    # Machines that don't exist yet are copied from scratch
+    test_obj._run_aq = mocker.MagicMock(return_value=AqResult(4, '', 'Not Found: Machine netbox-5249 not found.'))
+    assert test_obj._reconcile_cmds('netbox-5249', cmds) == cmds
+    test_obj._run_aq.assert_called_once_with(['show_machine', '--machine', 'netbox-5249', '--format', 'json'])
+
+    # Only missing parts are added to existing machines
+    test_obj._run_aq = mocker.MagicMock(return_value=AqResult(0, '{"name": "netbox-5249", "interfaces": []}', ''))
+    assert test_obj._reconcile_cmds('netbox-5249', cmds) == cmds[1:]
+
+    # Unreadable state fails only this machine, so the rest of a batch can carry on
+    test_obj._run_aq = mocker.MagicMock(return_value=AqResult(0, 'Machine netbox-5249 is a poweredge_r640', ''))
+    assert test_obj._reconcile_cmds('netbox-5249', cmds) is None
+
+    # As do other failures, which don't say whether the machine exists
+    for result in [
+        AqResult(4, '', 'Unauthorized: Anonymous access not allowed'),
+        AqResult(5, '', 'Internal Server Error'),
+        AqResult(5, '', 'Read timed out'),
+    ]:
+        test_obj._run_aq = mocker.MagicMock(return_value=result)
+        assert test_obj._reconcile_cmds('netbox-5249', cmds) is None
@@ -0,0 +1,204 @@
+"""
+Test cases for netbox2aquilon_daemon
+"""
+
+# pylint: disable=protected-access,missing-function-docstring
+
+import hashlib
+import hmac
+import json
+import os
+import signal
+import threading
+import urllib.error
+import urllib.request
+
+from argparse import Namespace
+from copy import deepcopy
+from types import SimpleNamespace
+
+import pytest
+
+from netbox2aquilon import Netbox2Aquilon
+from netbox2aquilon_daemon import Netbox2AquilonDaemon, SyncQueue, WebhookServer, get_device_key, verify_signature
+
+import testdata
+
+FAKE = testdata.load_data()
+
+
+def test_get_device_key():
+    assert get_device_key({'model': 'device', 'data': {'id': 5249}}) == ('device', 5249)
+    assert get_device_key({'model': 'virtualmachine', 'data': {'id': 763}}) == ('virtualmachine', 763)
+    assert get_device_key({'model': 'interface', 'data': {'id': 1, 'device': {'id': 5249}}}) == ('device', 5249)
+    assert get_device_key(
+        {'model': 'vminterface', 'data': {'id': 1, 'virtual_machine': {'id': 763}}}
+    ) == ('virtualmachine', 763)
+    assert get_device_key(
+        {'model': 'virtualdisk', 'data': {'id': 1, 'virtual_machine': {'id': 763}}}
+    ) == ('virtualmachine', 763)
+    assert get_device_key(
+        {'model': 'ipaddress', 'data': {'id': 1, 'assigned_object': {'id': 2, 'device': {'id': 5249}}}}
+    ) == ('device', 5249)
+    assert get_device_key(
+        {'model': 'ipaddress', 'data': {'id': 1, 'assigned_object': {'id': 2, 'virtual_machine': {'id': 763}}}}
+    ) == ('virtualmachine', 763)
+
+    # Unassigned addresses and other models don't affect any device
+    assert get_device_key({'model': 'ipaddress', 'data': {'id': 1, 'assigned_object': None}}) is None
+    assert get_device_key({'model': 'prefix', 'data': {'id': 1}}) is None
+
+
+def test_verify_signature():
+    body = b'{"model": "device"}'
+    signature = hmac.new(b'SECRET', body, hashlib.sha512).hexdigest()
+    assert verify_signature('SECRET', body, signature)
+    assert not verify_signature('OTHER', body, signature)
+    assert not verify_signature('SECRET', body + b' ', signature)
+    assert not verify_signature('SECRET', body, None)
+
+
+def test_sync_queue():
+    now = [0.0]
+    queue = SyncQueue(5, clock=lambda: now[0])
+
+    # A burst of changes to one device is coalesced into one sync, after the last change
+    queue.put(('device', 1))
+    queue.put(('virtualmachine', 2))
+    now[0] = 3
+    queue.put(('device', 1))
+    assert queue.get(block=False) is None
+    now[0] = 5
+    assert queue.get(block=False) == ('virtualmachine', 2)
+    assert queue.get(block=False) is None
+    now[0] = 8
+    assert queue.get(block=False) == ('device', 1)
+
+    # Changes while a device is being synced wait for it to finish
+    queue.put(('device', 1))
+    now[0] = 20
+    assert queue.get(block=False) is None
+    result = []
+    got = threading.Event()
+    thread = threading.Thread(target=lambda: result.append(queue.get()) or got.set())
+    thread.start()
+    queue.done(('device', 1))
+    assert got.wait(5)
+    assert result == [('device', 1)]
+
+    # Closing the queue releases waiting workers
+    got.clear()
+    thread = threading.Thread(target=lambda: result.append(queue.get()) or got.set())
+    thread.start()
+    queue.close()
+    assert got.wait(5)
+    assert result[-1] is None
+
+
+def test_sync_queue_drain():
+    now = [0.0]
+    queue = SyncQueue(5, clock=lambda: now[0])
+    queue.put(('device', 1))
+    queue.put(('virtualmachine', 2))
+    now[0] = 5
+    assert queue.get(block=False) == ('device', 1)
+    queue.put(('device', 1))
+
+    # Draining hands out everything queued without waiting for the debounce delay, including changes to devices that
+    # are still being synced once they finish
+    queue.close(drain=True)
+    assert queue.get() == ('virtualmachine', 2)
+    queue.done(('virtualmachine', 2))
+    assert queue.get(block=False) is None
+    queue.done(('device', 1))
+    assert queue.get() == ('device', 1)
+    queue.done(('device', 1))
+    assert queue.get() is None
+
+
+def test_serve_sigterm(mocker):
+    opts = Namespace(sandbox=None, domain='prod', reconcile=True, skip_unchanged=False, resume=False, rollback=False)
+    daemon = Netbox2AquilonDaemon(Netbox2Aquilon(), opts, workers=2, debounce=60)
+    daemon.sync = mocker.MagicMock(return_value=True)
+    serve_forever = WebhookServer.serve_forever
+
+    def terminate_while_serving(server):
+        daemon.queue.put(('device', 5249))
+        daemon.queue.put(('virtualmachine', 763))
+        os.kill(os.getpid(), signal.SIGTERM)
+        serve_forever(server)
+
+    mocker.patch.object(WebhookServer, 'serve_forever', terminate_while_serving)
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    daemon.serve(('127.0.0.1', 0))
+
+    # Devices queued before the signal are synced before returning, even though their debounce delay hasn't passed
+    assert sorted(call[0][0] for call in daemon.sync.call_args_list) == [('device', 5249), ('virtualmachine', 763)]
+    assert not any(worker.is_alive() for worker in daemon.workers)
+    assert signal.getsignal(signal.SIGTERM) is previous_handler
+
+
+@pytest.fixture(name='webhook_server')
+def fixture_webhook_server():
+    queue = SyncQueue(0)
+    queue.put = lambda key: queue.pending.setdefault(key, 0)
+    with testdata.serve_in_background(WebhookServer(('127.0.0.1', 0), queue, secret='SECRET')) as server:
+        yield server
+
+
+def post_webhook(server, payload, secret='SECRET'):
+    body = json.dumps(payload).encode('utf-8') if isinstance(payload, dict) else payload
+    request = urllib.request.Request(
+        f'http://127.0.0.1:{server.server_port}/',
+        data=body,
+        headers={'X-Hook-Signature': hmac.new(secret.encode('utf-8'), body, hashlib.sha512).hexdigest()},
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+def test_webhook_server(webhook_server):
+    change = {'event': 'updated', 'model': 'interface', 'data': {'id': 1, 'device': {'id': 5249}}}
+    assert post_webhook(webhook_server, change) == 202
+    assert list(webhook_server.queue.pending) == [('device', 5249)]
+
+    # Signatures must match the configured secret
+    assert post_webhook(webhook_server, change, secret='OTHER') == 403
+    assert post_webhook(webhook_server, b'not json') == 400
+
+    # Deleted devices and unrelated changes are not synced
+    assert post_webhook(webhook_server, {'event': 'deleted', 'model': 'device', 'data': {'id': 5250}}) == 204
+    assert post_webhook(webhook_server, {'event': 'created', 'model': 'prefix', 'data': {'id': 1}}) == 204
+    assert list(webhook_server.queue.pending) == [('device', 5249)]
+
+
+def test_sync(mocker):
+    test_obj = Netbox2Aquilon()
+    opts = Namespace(sandbox=None, domain='prod', reconcile=True, skip_unchanged=False, resume=False, rollback=False)
+    daemon = Netbox2AquilonDaemon(test_obj, opts, workers=1)
+
+    device = deepcopy(FAKE.DEVICE_PHYSICAL)
+    test_obj.netbox = SimpleNamespace(
+        dcim=SimpleNamespace(devices=mocker.MagicMock()),
+        virtualization=SimpleNamespace(virtual_machines=mocker.MagicMock()),
+    )
+    test_obj.netbox.dcim.devices.get.return_value = device
+    test_obj.copy_device = mocker.MagicMock(return_value=True)
+    assert daemon.sync(('device', 5249))
+    test_obj.netbox.dcim.devices.get.assert_called_once_with(5249)
+    test_obj.copy_device.assert_called_once_with(device, opts)
+
+    # Failures only fail the device being synced
+    test_obj.copy_device = mocker.MagicMock(side_effect=SystemExit(1))
+    assert not daemon.sync(('device', 5249))
+
+    test_obj.netbox.virtualization.virtual_machines.get.return_value = None
+    assert not daemon.sync(('virtualmachine', 763))
+
+    stats = test_obj.stats.to_dict()['sync']
+    assert stats['device']['count'] == 2
+    assert stats['device']['errors'] == 1
+    assert stats['virtualmachine']['errors'] == 1
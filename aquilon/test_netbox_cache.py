@@ -0,0 +1,90 @@
+"""
+Test cases for the persistent NetBox object cache
+"""
+
+# pylint: disable=protected-access,missing-function-docstring
+
+import os
+
+from netbox_cache import NetboxCache
+from scd_netbox import SCDNetbox
+
+FAKE_RACK = {
+    'id': 368,
+    'url': 'http://netbox.example.org/api/dcim/racks/368/',
+    'display': 'MagDB rack152 (152)',
+    'name': 'MagDB rack152',
+    'facility_id': '152',
+    'tags': [],
+    'last_updated': '2023-01-25T16:41:36.124123Z',
+}
+
+
+def test_store_and_load(tmp_path):
+    cache = NetboxCache(str(tmp_path), 60)
+
+    assert cache.load('dcim.racks', 368) is None
+
+    cache.store('dcim.racks', 368, FAKE_RACK)
+    assert cache.load('dcim.racks', 368) == (FAKE_RACK, False)
+
+    # Writes must not leave temporary files behind
+    assert sorted(os.listdir(tmp_path / 'dcim.racks')) == ['.lock', '368.json']
+
+    # Entries older than the TTL are returned, but flagged as expired
+    cache.ttl = -1
+    assert cache.load('dcim.racks', 368) == (FAKE_RACK, True)
+
+    # Corrupt entries are treated as missing
+    (tmp_path / 'dcim.racks' / '368.json').write_text('{"stored": ')
+    assert cache.load('dcim.racks', 368) is None
+
+
+def test_get_cached_object(mocker, tmp_path):
+    scd_netbox = SCDNetbox()
+    endpoint = scd_netbox.netbox.dcim.racks
+    endpoint.get = mocker.MagicMock(return_value=endpoint.return_obj(dict(FAKE_RACK), scd_netbox.netbox, endpoint))
+    endpoint.filter = mocker.MagicMock(return_value=[])
+    endpoint.count = mocker.MagicMock(return_value=1)
+
+    # Cache disabled, should always go to NetBox
+    assert scd_netbox.cache is None
+    scd_netbox.get_cached_object(endpoint, 368)
+    scd_netbox.get_cached_object(endpoint, 368)
+    assert endpoint.get.call_count == 2
+
+    # Cache enabled, should only go to NetBox on the first lookup
+    scd_netbox.cache = NetboxCache(str(tmp_path), 60)
+    endpoint.get.reset_mock()
+    for _ in range(3):
+        rack = scd_netbox.get_cached_object(endpoint, 368)
+        assert rack.facility_id == '152'
+    endpoint.get.assert_called_once_with(368)
+    endpoint.filter.assert_not_called()
+
+    # Expired and unchanged, should revalidate against last_updated and keep the cached copy
+    scd_netbox.cache.ttl = -1
+    assert scd_netbox.get_cached_object(endpoint, 368).facility_id == '152'
+    endpoint.filter.assert_called_once_with(id=368, last_updated__gt='2023-01-25T16:41:36.124123Z')
+    endpoint.count.assert_called_once_with(id=368)
+    endpoint.get.assert_called_once()
+
+    # Expired and changed, should replace the cached copy with the new version
+    changed_rack = dict(FAKE_RACK, facility_id='153', last_updated='2023-02-01T09:00:00.000000Z')
+    endpoint.filter = mocker.MagicMock(return_value=[endpoint.return_obj(changed_rack, scd_netbox.netbox, endpoint)])
+    assert scd_netbox.get_cached_object(endpoint, 368).facility_id == '153'
+    scd_netbox.cache.ttl = 60
+    assert scd_netbox.get_cached_object(endpoint, 368).facility_id == '153'
+
+    # Entries are stored by endpoint and id
+    assert os.path.exists(tmp_path / 'dcim.racks' / '368.json')
+
+    # Expired and deleted, should be removed from the cache instead of being kept
+    scd_netbox.cache.ttl = -1
+    endpoint.filter = mocker.MagicMock(return_value=[])
+    endpoint.count = mocker.MagicMock(return_value=0)
+    endpoint.get = mocker.MagicMock(return_value=None)
+    assert scd_netbox.get_cached_object(endpoint, 368) is None
+    assert not os.path.exists(tmp_path / 'dcim.racks' / '368.json')
+    assert scd_netbox.get_cached_object(endpoint, 368) is None
+    endpoint.get.assert_called_once_with(368)
@@ -5,12 +5,17 @@ Test cases for netbox2aquilon
 # pylint: disable=protected-access,missing-function-docstring
 
 import json
+import os
+import threading
 
 from copy import deepcopy
 from types import SimpleNamespace
-from unittest.mock import patch, mock_open
 
-from netbox_dump_subnetdata import NetboxDumpSubnetdata
+import pynetbox
+import pytest
+
+from netbox_dump_subnetdata import PREFIX_FIELDS, NetboxDumpSubnetdata, _prefix_network
+from netbox_records import PrefixRecord
 
 import testdata
 
@@ -20,11 +25,17 @@ FAKE = testdata.load_data()
 def test__get_subnet_fields(mocker):
     test_obj = NetboxDumpSubnetdata()
 
-    test_obj.netbox.ipam.prefixes = SimpleNamespace()
-    test_obj.netbox.ipam.prefixes.filter = mocker.MagicMock(return_value=deepcopy(FAKE.PREFIXES_IPV4))
+    test_obj.fetch_all = mocker.MagicMock(return_value=deepcopy(FAKE.PREFIXES_IPV4))
 
-    subnets = test_obj._get_subnet_fields()
+    subnets = list(test_obj._get_subnet_fields())
     assert len(subnets) == 5
+    # A query for each tenant, merged back into the network order NetBox returns
+    assert test_obj.fetch_all.call_args[1]['split_by'] == 'tenant'
+    assert test_obj.fetch_all.call_args[1]['tenant'] == ['tier1', 'cloud', 'secops']
+    merge_key = test_obj.fetch_all.call_args[1]['merge_key']
+    assert [p.prefix for p in sorted(FAKE.PREFIXES_IPV4, key=merge_key)] == [
+        '10.246.176.0/22', '172.16.254.0/26', '192.168.80.0/22', '192.168.176.0/22', '192.168.216.64/27',
+    ]
     print(subnets)
     assert {s['SubnetAddress'] for s in subnets} == {
         "10.246.176.0",
@@ -35,35 +46,212 @@ def test__get_subnet_fields(mocker):
     }
 
 
-def test_write_subnetdata_txt(mocker):
+def test_write_subnetdata_txt(mocker, tmp_path):
     test_obj = NetboxDumpSubnetdata()
 
-    test_obj.netbox.ipam.prefixes = SimpleNamespace()
-    test_obj.netbox.ipam.prefixes.filter = mocker.MagicMock(return_value=deepcopy(FAKE.PREFIXES_IPV4))
+    test_obj.fetch_all = mocker.MagicMock(return_value=deepcopy(FAKE.PREFIXES_IPV4))
 
-    with patch("builtins.open", mock_open(read_data="data")) as mock_file:
-        test_obj.write_subnetdata_txt('/tmp/fake_place')
-    mock_file.assert_called_with("/tmp/fake_place/subnetdata.txt", 'w', encoding='utf-8')
+    test_obj.write_subnetdata_txt(str(tmp_path))
+    assert os.listdir(tmp_path) == ['subnetdata.txt']
 
-    handle = mock_file()
     with open('testdata/subnetdata.txt', 'r', encoding='utf-8') as test_subnetdata:
-        handle.writelines.assert_called_once_with(test_subnetdata.readlines())
+        assert (tmp_path / 'subnetdata.txt').read_text(encoding='utf-8') == test_subnetdata.read()
 
 
-def test_write_subnetdata_json(mocker):
+def test_write_subnetdata_json(mocker, tmp_path):
     test_obj = NetboxDumpSubnetdata()
 
-    test_obj.netbox.ipam.prefixes = SimpleNamespace()
-    test_obj.netbox.ipam.prefixes.filter = mocker.MagicMock(return_value=deepcopy(FAKE.PREFIXES_IPV4))
+    test_obj.fetch_all = mocker.MagicMock(return_value=deepcopy(FAKE.PREFIXES_IPV4))
 
     with open('testdata/subnetdata.json', 'r', encoding='utf-8') as test_subnetdata_file:
         test_subnetdata = json.load(test_subnetdata_file)
 
-    mock_dump = mocker.patch.object(json, 'dump')
-    with patch("builtins.open", mock_open(read_data="data")) as mock_file:
-        test_obj.write_subnetdata_json('/tmp/fake_place')
+    test_obj.write_subnetdata_json(str(tmp_path))
+    assert os.listdir(tmp_path) == ['subnetdata.json']
+
+    # Output should be identical to encoding the whole list with json.dump
+    assert (tmp_path / 'subnetdata.json').read_text(encoding='utf-8') == json.dumps(test_subnetdata)
+
+    # An empty dump should still be valid JSON
+    test_obj.fetch_all = mocker.MagicMock(return_value=[])
+    test_obj.write_subnetdata_json(str(tmp_path))
+    assert not json.loads((tmp_path / 'subnetdata.json').read_text(encoding='utf-8'))
+
+
+
+def test_write_subnetdata(mocker, tmp_path):
+    test_obj = NetboxDumpSubnetdata()
+
+    test_obj.fetch_all = mocker.MagicMock(return_value=deepcopy(FAKE.PREFIXES_IPV4))
+
+    test_obj.write_subnetdata(str(tmp_path), ['txt', 'json'])
+    # Both formats are written from a single fetch
+    test_obj.fetch_all.assert_called_once()
+    assert sorted(os.listdir(tmp_path)) == ['subnetdata.json', 'subnetdata.txt']
+
+    with open('testdata/subnetdata.txt', 'r', encoding='utf-8') as test_subnetdata:
+        assert (tmp_path / 'subnetdata.txt').read_text(encoding='utf-8') == test_subnetdata.read()
+    with open('testdata/subnetdata.json', 'r', encoding='utf-8') as test_subnetdata:
+        assert json.loads((tmp_path / 'subnetdata.json').read_text(encoding='utf-8')) == json.load(test_subnetdata)
+
+def test_write_subnetdata_failure(mocker, tmp_path):
+    test_obj = NetboxDumpSubnetdata()
+
+    def broken_prefixes(*_, **__):
+        yield FAKE.PREFIXES_IPV4[0]
+        raise ConnectionError('NetBox went away')
+
+    test_obj.fetch_all = mocker.MagicMock(side_effect=broken_prefixes)
+
+    # The previous dump should be left in place if fetching prefixes fails part way through
+    (tmp_path / 'subnetdata.txt').write_text('previous dump\n', encoding='utf-8')
+    with pytest.raises(ConnectionError):
+        test_obj.write_subnetdata_txt(str(tmp_path))
+    assert os.listdir(tmp_path) == ['subnetdata.txt']
+    assert (tmp_path / 'subnetdata.txt').read_text(encoding='utf-8') == 'previous dump\n'
+
+
+def test__open_dumpfile_concurrent(tmp_path):
+    # Writers of the same file at the same time must not share a temporary file
+    with NetboxDumpSubnetdata._open_dumpfile(str(tmp_path), 'state.json') as first:
+        with NetboxDumpSubnetdata._open_dumpfile(str(tmp_path), 'state.json') as second:
+            first.write('first')
+            second.write('second')
+        assert (tmp_path / 'state.json').read_text(encoding='utf-8') == 'second'
+    assert (tmp_path / 'state.json').read_text(encoding='utf-8') == 'first'
+    assert os.listdir(tmp_path) == ['state.json']
+
+
+def test_get_subnet_fields_incremental_lock(mocker, tmp_path):
+    test_obj = NetboxDumpSubnetdata()
+    state_file = str(tmp_path / 'subnetdata_state.json')
+    test_obj.config['dump_subnetdata']['state_file'] = state_file
+    test_obj.fetch_all = mocker.MagicMock(return_value=[_make_prefix(1, '10.0.1.0/24', description='one')])
+
+    # Another process updating the state must finish before this one reads it
+    finished = threading.Event()
+    thread = threading.Thread(target=lambda: test_obj.get_subnet_fields_incremental() and finished.set())
+    with NetboxDumpSubnetdata._lock_state(state_file):
+        thread.start()
+        assert not finished.wait(0.2)
+        test_obj.fetch_all.assert_not_called()
+    assert finished.wait(5)
+    thread.join()
+    test_obj.fetch_all.assert_called_once()
+
+
+def _make_prefix(prefix_id, prefix, children=0, tenant='tier1', description=''):
+    values = {
+        'id': prefix_id,
+        'prefix': prefix,
+        'family': {'value': 4, 'label': 'IPv4'},
+        'vrf': None,
+        'tenant': {'id': 7, 'name': tenant, 'slug': tenant} if tenant else None,
+        'site': None,
+        'role': None,
+        'description': description,
+        'custom_fields': {},
+        'children': children,
+    }
+    return pynetbox.models.ipam.Prefixes(values=values, api=deepcopy(FAKE.API), endpoint=deepcopy(FAKE.ENDPOINT))
+
+
+def test_get_subnet_fields_incremental(mocker, tmp_path):
+    test_obj = NetboxDumpSubnetdata()
+    test_obj.config['dump_subnetdata']['state_file'] = str(tmp_path / 'state' / 'subnetdata_state.json')
+
+    test_obj.netbox.ipam.prefixes = SimpleNamespace()
+    test_obj.netbox.extras.object_changes = SimpleNamespace()
+
+    # Without any state, everything is fetched
+    test_obj.fetch_all = mocker.MagicMock(return_value=[
+        _make_prefix(1, '10.0.1.0/24', description='one'),
+        _make_prefix(2, '10.0.2.0/24', description='two'),
+        _make_prefix(3, '10.0.0.0/24', description='three'),
+    ])
+    subnets = test_obj.get_subnet_fields_incremental()
+    assert [s['SubnetName'] for s in subnets] == ['three', 'one', 'two']
+    test_obj.fetch_all.assert_called_once_with(
+        test_obj.netbox.ipam.prefixes, split_by='tenant', merge_key=_prefix_network,
+        fields=PREFIX_FIELDS, record_type=PrefixRecord, tenant=['tier1', 'cloud', 'secops'], family=4, children=0,
+        vrf_id=None,
+    )
+
+    # Prefix 1 is renamed, prefix 3 is deleted, and prefix 4 is added inside prefix 2, so prefix 2 is no longer a leaf
+    changed = {
+        '10.0.1.0/24': [_make_prefix(1, '10.0.1.0/24', description='renamed')],
+        '10.0.2.128/25': [
+            _make_prefix(2, '10.0.2.0/24', children=1, description='two'),
+            _make_prefix(4, '10.0.2.128/25', description='four'),
+        ],
+        '10.0.0.0/24': [],
+    }
+
+    def fake_filter(**kwargs):
+        if 'last_updated__gte' in kwargs:
+            return [_make_prefix(1, '10.0.1.0/24'), _make_prefix(4, '10.0.2.128/25')]
+        return changed[kwargs['contains']]
+
+    test_obj.netbox.ipam.prefixes.filter = mocker.MagicMock(side_effect=fake_filter)
+    test_obj.netbox.extras.object_changes.filter = mocker.MagicMock(return_value=[
+        SimpleNamespace(
+            changed_object_id=3, action=SimpleNamespace(value='delete'), prechange_data={'prefix': '10.0.0.0/24'},
+        ),
+    ])
+
+    subnets = test_obj.get_subnet_fields_incremental()
+    assert [s['SubnetName'] for s in subnets] == ['renamed', 'four']
+    assert test_obj.netbox.ipam.prefixes.filter.call_count == 4
+    assert test_obj.netbox.extras.object_changes.filter.call_args[1]['action'] == ['update', 'delete']
+
+    # Changing the configured tenants can't be done incrementally
+    test_obj.config['dump_subnetdata']['tenants'] = 'cloud'
+    test_obj.fetch_all = mocker.MagicMock(return_value=[])
+    assert not test_obj.get_subnet_fields_incremental()
+    assert test_obj.fetch_all.call_args[1]['tenant'] == ['cloud']
+
+
+def test_get_subnet_fields_incremental_move(mocker, tmp_path):
+    test_obj = NetboxDumpSubnetdata()
+    test_obj.config['dump_subnetdata']['state_file'] = str(tmp_path / 'subnetdata_state.json')
+    test_obj.netbox.ipam.prefixes = SimpleNamespace()
+    test_obj.netbox.extras.object_changes = SimpleNamespace()
+
+    # Prefix 2 contains prefix 5, and prefix 6 which has no tenant, so only prefix 5 is a subnet
+    test_obj.fetch_all = mocker.MagicMock(return_value=[_make_prefix(5, '10.0.2.128/25', description='five')])
+    assert [s['SubnetName'] for s in test_obj.get_subnet_fields_incremental()] == ['five']
+
+    def fake_filter(updated, contains):
+        return lambda **kwargs: [updated] if 'last_updated__gte' in kwargs else contains[kwargs['contains']]
+
+    # Prefix 5 moves out of prefix 2, the old network of a subnet is known from the state
+    test_obj.netbox.ipam.prefixes.filter = mocker.MagicMock(side_effect=fake_filter(_make_prefix(5, '10.0.3.0/24'), {
+        '10.0.3.0/24': [_make_prefix(5, '10.0.3.0/24', description='five')],
+        '10.0.2.128/25': [_make_prefix(2, '10.0.2.0/24', children=1, description='two')],
+    }))
+    test_obj.netbox.extras.object_changes.filter = mocker.MagicMock(return_value=[])
+    assert [s['SubnetName'] for s in test_obj.get_subnet_fields_incremental()] == ['five']
+    assert test_obj.netbox.ipam.prefixes.filter.call_count == 3
+
+    # Prefix 6 moves out of prefix 2, leaving it as a subnet, the old network is only known from the change log
+    test_obj.netbox.ipam.prefixes.filter = mocker.MagicMock(side_effect=fake_filter(
+        _make_prefix(6, '10.0.4.0/24', tenant=None), {
+            '10.0.4.0/24': [_make_prefix(6, '10.0.4.0/24', tenant=None)],
+            '10.0.2.0/25': [_make_prefix(2, '10.0.2.0/24', description='two')],
+        },
+    ))
+    test_obj.netbox.extras.object_changes.filter = mocker.MagicMock(return_value=[
+        SimpleNamespace(changed_object_id=6, action=SimpleNamespace(value='update'), prechange_data={
+            'prefix': '10.0.2.0/25',
+        }),
+    ])
+    assert [s['SubnetName'] for s in test_obj.get_subnet_fields_incremental()] == ['two', 'five']
+    assert 'update' in test_obj.netbox.extras.object_changes.filter.call_args[1]['action']
 
-    mock_file.assert_called_with("/tmp/fake_place/subnetdata.json", 'w', encoding='utf-8')
 
-    mock_file_handle = mock_file()
-    mock_dump.assert_called_with(test_subnetdata, mock_file_handle)
+def test__is_subnet():
+    tenants = ['tier1', 'cloud']
+    assert NetboxDumpSubnetdata._is_subnet(_make_prefix(1, '10.0.0.0/24'), tenants)
+    assert not NetboxDumpSubnetdata._is_subnet(_make_prefix(1, '10.0.0.0/24', children=2), tenants)
+    assert not NetboxDumpSubnetdata._is_subnet(_make_prefix(1, '10.0.0.0/24', tenant='secops'), tenants)
+    assert not NetboxDumpSubnetdata._is_subnet(_make_prefix(1, '10.0.0.0/24', tenant=None), tenants)
@@ -0,0 +1,109 @@
+"""
+Test cases for the compact NetBox records
+"""
+
+# pylint: disable=protected-access,missing-function-docstring,no-member
+
+import json
+
+from copy import deepcopy
+from types import SimpleNamespace
+
+import pytest
+
+from netbox2aquilon import Netbox2Aquilon
+from netbox_dump_subnetdata import PREFIX_FIELDS, NetboxDumpSubnetdata
+from netbox_records import AddressRecord, InterfaceRecord, NestedRecord, PrefixRecord
+from scd_netbox import ADDRESS_FIELDS, INTERFACE_FIELDS, RESOLVE_FIELDS, DeviceSnapshot, SCDNetbox
+
+import testdata
+
+FAKE = testdata.load_data()
+
+
+def load_json(name):
+    with open(f'testdata/{name}.json', encoding='utf-8') as json_file:
+        return json.load(json_file)
+
+
+def test_fields():
+    # Every field requested from NetBox must have somewhere to go
+    assert set(INTERFACE_FIELDS) <= set(InterfaceRecord.__slots__)
+    assert set(ADDRESS_FIELDS) <= set(AddressRecord.__slots__)
+    assert set(RESOLVE_FIELDS) <= set(AddressRecord.__slots__)
+    assert set(PREFIX_FIELDS) <= set(PrefixRecord.__slots__)
+
+
+def test_from_json():
+    values = load_json('interfaces_physical')[1]
+    interface = InterfaceRecord.from_json(values)
+
+    assert interface.id == values['id']
+    assert interface.name == 'eth0'
+    assert interface.type.value == values['type']['value']
+    assert interface.device.id == values['device']['id']
+    assert [tag.slug for tag in interface.tags] == [tag['slug'] for tag in values['tags']]
+    assert str(interface) == 'eth0'
+
+    # Fields NetBox didn't return are missing, as for a Record fetched with a list of fields
+    assert not hasattr(interface, 'virtual_machine')
+    with pytest.raises(AttributeError):
+        _ = interface.virtual_machine
+    # Anything else isn't kept at all
+    assert not hasattr(interface, 'description')
+    assert not hasattr(interface, '__dict__')
+
+    assert dict(interface)['device'] == {k: v for k, v in values['device'].items() if k in NestedRecord.__slots__}
+
+    address = AddressRecord.from_json(load_json('addresses_ipv4')[0])
+    assert str(address) == address.address
+    assert address.family.value == 4
+    # Planners strip the prefix length in place
+    address.address = address.address.split('/')[0]
+
+    prefix = PrefixRecord.from_json(load_json('prefixes_ipv4')[0])
+    assert isinstance(prefix.custom_fields, dict)
+    assert str(prefix) == prefix.prefix
+
+
+def test_planners():
+    # Compact records must plan exactly the same commands as pynetbox Records
+    test_obj = Netbox2Aquilon()
+    device = deepcopy(FAKE.DEVICE_PHYSICAL)
+    device.aq_machine_name = 'system7592'
+
+    for name in ('interfaces_physical', 'interfaces_physical_lags', 'interfaces_virtual'):
+        compact = DeviceSnapshot(device, interfaces=[InterfaceRecord.from_json(v) for v in load_json(name)])
+        records = DeviceSnapshot(device, interfaces=deepcopy(getattr(FAKE, name.upper())))
+        assert test_obj._netbox_copy_interfaces(compact) == test_obj._netbox_copy_interfaces(records)
+
+    compact = DeviceSnapshot(
+        device,
+        interfaces=[InterfaceRecord.from_json(load_json('interfaces_physical')[1])],
+        addresses=SCDNetbox._group_addresses(AddressRecord.from_json(v) for v in load_json('addresses_ipv4')),
+    )
+    records = DeviceSnapshot(
+        device,
+        interfaces=[deepcopy(FAKE.INTERFACES_PHYSICAL[1])],
+        addresses=SCDNetbox._group_addresses(deepcopy(FAKE.ADDRESSES_IPV4)),
+    )
+    assert test_obj._netbox_copy_addresses(compact) == test_obj._netbox_copy_addresses(records)
+    assert test_obj._netbox_copy_addresses(compact)
+
+
+def test_prefix_fields():
+    for values, record in zip(load_json('prefixes_ipv4'), FAKE.PREFIXES_IPV4):
+        assert NetboxDumpSubnetdata._get_prefix_fields(PrefixRecord.from_json(values)) == \
+            NetboxDumpSubnetdata._get_prefix_fields(record)
+
+
+def test_fetch_all(mocker):
+    test_obj = SCDNetbox()
+    values = load_json('addresses_ipv4')
+    test_obj._get_page = mocker.MagicMock(return_value={'count': len(values), 'results': values})
+    endpoint = SimpleNamespace(return_obj=mocker.MagicMock())
+
+    addresses = list(test_obj.fetch_all(endpoint, fields=ADDRESS_FIELDS, record_type=AddressRecord))
+    assert [a.address for a in addresses] == [v['address'] for v in values]
+    assert all(isinstance(a, AddressRecord) for a in addresses)
+    endpoint.return_obj.assert_not_called()
@@ -0,0 +1,61 @@
+"""
+Test cases for the prefix index
+"""
+
+# pylint: disable=missing-function-docstring
+
+import ipaddress
+import random
+
+from prefix_index import PrefixIndex
+
+
+def test_lookup():
+    index = PrefixIndex()
+    index.add('10.0.0.0/8', 'ten')
+    index.add('10.1.0.0/16', 'ten-one')
+    index.add('10.1.2.0/24', 'ten-one-two')
+    index.add('192.168.1.0/24', 'local')
+    assert len(index) == 4
+
+    # The most specific network wins
+    assert index.lookup('10.1.2.3') == 'ten-one-two'
+    assert index.lookup('10.1.3.3') == 'ten-one'
+    assert index.lookup('10.2.0.1') == 'ten'
+    assert index.lookup('192.168.1.255') == 'local'
+    assert index.lookup('192.168.2.1') is None
+    assert index.lookup('172.16.0.1') is None
+
+    # A default route matches everything, replacing a network doesn't add another
+    index.add('0.0.0.0/0', 'default')
+    index.add('10.0.0.0/8', 'ten again')
+    assert len(index) == 5
+    assert index.lookup('172.16.0.1') == 'default'
+    assert index.lookup('10.2.0.1') == 'ten again'
+
+
+def test_lookup_matches_ipaddress():
+    rng = random.Random(42)
+    networks = [
+        ipaddress.IPv4Network((rng.getrandbits(32), rng.randint(8, 30)), strict=False) for _ in range(200)
+    ]
+    index = PrefixIndex()
+    for network in networks:
+        index.add(network, network)
+
+    for _ in range(1000):
+        address = ipaddress.IPv4Address(rng.getrandbits(32))
+        containing = [n for n in networks if address in n]
+        expected = max(containing, key=lambda n: n.prefixlen) if containing else None
+        assert index.lookup(address) == expected
+
+
+def test_from_subnet_fields():
+    subnets = [
+        {'SubnetAddress': '130.246.176.0', 'SubnetMask': '22', 'SubnetName': 'Tier1-A'},
+        {'SubnetAddress': '130.246.180.0', 'SubnetMask': '23', 'SubnetName': 'Tier1-B'},
+    ]
+    index = PrefixIndex.from_subnet_fields(subnets)
+    assert index.lookup('130.246.177.10')['SubnetName'] == 'Tier1-A'
+    assert index.lookup('130.246.181.10')['SubnetName'] == 'Tier1-B'
+    assert index.lookup('130.246.182.10') is None
@@ -0,0 +1,77 @@
+"""
+Test cases for run_stats
+"""
+
+# pylint: disable=protected-access,missing-function-docstring
+
+import json
+
+from types import SimpleNamespace
+
+from run_stats import RunStats, report_stats
+
+
+def test_endpoint_name():
+    assert RunStats.endpoint_name('https://netbox.example.org/api/dcim/racks/368/') == '/api/dcim/racks/{id}/'
+    assert RunStats.endpoint_name(
+        'https://netbox.example.org/api/ipam/prefixes/?tenant=tier1&limit=1000'
+    ) == '/api/ipam/prefixes/'
+
+
+def test_record():
+    stats = RunStats()
+    stats.record('aq', 'add_host', 0.005, 100)
+    stats.record('aq', 'add_host', 0.3, 20, error=True)
+    stats.record('aq', 'add_host', 60)
+
+    stat = stats.to_dict()['aq']['add_host']
+    assert stat['count'] == 3
+    assert stat['errors'] == 1
+    assert stat['bytes'] == 120
+    assert stat['max_seconds'] == 60
+    assert stat['histogram']['0.01'] == 1
+    assert stat['histogram']['0.5'] == 1
+    assert stat['histogram']['+Inf'] == 1
+    assert sum(stat['histogram'].values()) == 3
+
+    # The percentile is the upper bound of its bucket
+    assert RunStats._percentile(stats.stats['aq']['add_host']['histogram'], 0.5) == 0.5
+
+
+def test_response_hook():
+    stats = RunStats()
+    response = SimpleNamespace(
+        request=SimpleNamespace(method='GET', url='https://netbox.example.org/api/dcim/racks/368/'),
+        elapsed=SimpleNamespace(total_seconds=lambda: 0.02),
+        headers={},
+        content=b'{"id": 368}',
+        ok=True,
+    )
+    stats.response_hook(response)
+    stats.response_hook(response)
+
+    stat = stats.to_dict()['netbox']['GET /api/dcim/racks/{id}/']
+    assert stat['count'] == 2
+    assert stat['bytes'] == 22
+    assert stat['histogram']['0.025'] == 2
+
+    # Compressed responses are counted by their transferred size
+    response.headers = {'Content-Length': '9'}
+    stats.response_hook(response)
+    assert stats.to_dict()['netbox']['GET /api/dcim/racks/{id}/']['bytes'] == 31
+
+
+def test_report_stats(tmp_path, capsys):
+    stats = RunStats()
+    stats.record('netbox', 'GET /api/dcim/interfaces/', 0.1)
+    stats.record('aq', 'add_host', 2)
+
+    report_stats(stats, SimpleNamespace(stats=True, stats_json=str(tmp_path / 'stats.json')))
+
+    summary = capsys.readouterr().err.splitlines()
+    assert summary[0].startswith('aq ')
+    assert summary[1].split()[:2] == ['add_host', '1']
+    assert summary[3].split()[0] == 'GET'
+
+    with open(tmp_path / 'stats.json', 'r', encoding='utf-8') as stats_file:
+        assert json.load(stats_file) == stats.to_dict()
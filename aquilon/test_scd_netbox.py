@@ -5,19 +5,174 @@ Test cases for core library
 # pylint: disable=protected-access
 
 import logging
+import threading
+import time
 
 from copy import deepcopy
+from http.server import BaseHTTPRequestHandler
 from types import SimpleNamespace
+from urllib.parse import parse_qs, urlencode, urlparse
 
+import pynetbox
 import pytest
 
-from scd_netbox import SCDNetbox
+from netbox_records import AddressRecord, InterfaceRecord
+from scd_netbox import ADDRESS_FIELDS, INTERFACE_FIELDS, DeviceSnapshot, SCDNetbox
 
 import testdata
 
 FAKE = testdata.load_data()
 
 
+class FakeListHandler(BaseHTTPRequestHandler):
+    """ Returns 250 numbered prefixes per tenant, in pages of up to 100 like a NetBox with MAX_PAGE_SIZE = 100 """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ Serve one page of the requested tenant """
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        self.server.requests.append((url.path, query))
+        offset = int(query['offset'][0])
+        limit = min(int(query['limit'][0]), 100)
+        tenant = query['tenant'][0]
+        results = [
+            {'id': i, 'prefix': f'10.{tenant}.{i}.0/24', 'tenant': {'slug': tenant}}
+            for i in range(offset, min(offset + limit, 250))
+        ]
+        testdata.send_json(self, {'count': 250, 'results': results})
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+def test__create_session():
+    """ Test that the transport settings are applied to the NetBox session """
+    scd_netbox = SCDNetbox()
+    session = scd_netbox.netbox.http_session
+    adapter = session.get_adapter('https://netbox.example.org/api/')
+
+    assert adapter.timeout == 60
+    assert adapter._pool_maxsize == 10
+    assert adapter.max_retries.total == 3
+    assert adapter.max_retries.is_retry('GET', 502)
+    assert not adapter.max_retries.is_retry('POST', 502)
+    assert not adapter.max_retries.is_retry('GET', 404)
+    assert session.headers['Accept-Encoding'] == 'gzip, deflate'
+    assert session.headers['Connection'] == 'keep-alive'
+
+    scd_netbox.config['netbox']['cert_path'] = 'false'
+    scd_netbox.config['netbox']['pool_size'] = '32'
+    scd_netbox.config['netbox']['keepalive'] = 'false'
+    scd_netbox.config['netbox']['compression'] = 'false'
+    scd_netbox.config['netbox']['retries'] = '0'
+    session = scd_netbox._create_session()
+    adapter = session.get_adapter('http://netbox.example.org/api/')
+
+    assert session.verify is False
+    assert adapter._pool_maxsize == 32
+    assert adapter.max_retries.total == 0
+    assert session.headers['Accept-Encoding'] == 'identity'
+    assert session.headers['Connection'] == 'close'
+
+
+def test_fetch_all():
+    """ Test that all pages are fetched for each value of the split_by filter, and returned in order """
+    test_obj = SCDNetbox()
+    with testdata.fake_server(FakeListHandler) as server:
+        test_obj.netbox = pynetbox.api(f'http://127.0.0.1:{server.server_port}/', token='TOKEN')
+        test_obj.netbox.http_session = test_obj._create_session()
+        prefixes = list(test_obj.fetch_all(
+            test_obj.netbox.ipam.prefixes, page_size=1000, split_by='tenant', fields=['id', 'prefix'],
+            tenant=['1', '2'], family=4, vrf_id=None,
+        ))
+
+    assert [p.prefix for p in prefixes] == [f'10.{t}.{i}.0/24' for t in (1, 2) for i in range(250)]
+    assert isinstance(prefixes[0], pynetbox.models.ipam.Prefixes)
+    # Fields that weren't requested should not be fetched later
+    assert prefixes[0].has_details
+
+    # One request for the first page of each tenant, then the rest using the page size actually returned
+    assert len(server.requests) == 6
+    assert test_obj.stats.to_dict()['netbox']['GET /api/ipam/prefixes/']['count'] == 6
+    for path, query in server.requests:
+        assert path == '/api/ipam/prefixes/'
+        assert query['family'] == ['4']
+        assert query['vrf_id'] == ['null']
+        assert query['fields'] == ['id,prefix']
+    assert sorted((q['tenant'][0], q['offset'][0], q['limit'][0]) for _, q in server.requests) == [
+        ('1', '0', '1000'), ('1', '100', '100'), ('1', '200', '100'),
+        ('2', '0', '1000'), ('2', '100', '100'), ('2', '200', '100'),
+    ]
+
+
+def test_fetch_all_window(mocker):
+    """ Test that only a window of pages is requested ahead of the objects that have been read """
+    test_obj = SCDNetbox()
+    test_obj.config['netbox']['lookup_workers'] = '2'
+    test_obj._get_page = mocker.MagicMock(side_effect=lambda endpoint, query, offset, limit: {
+        'count': 20, 'results': [{'id': offset}],
+    })
+    endpoint = SimpleNamespace(return_obj=lambda values, api, endpoint: values['id'])
+
+    objects = test_obj.fetch_all(endpoint)
+    for read in range(1, 21):
+        assert next(objects) == read - 1
+        assert test_obj._get_page.call_count <= read + 2
+    assert not list(objects)
+    assert test_obj._get_page.call_count == 20
+
+
+def test_fetch_all_merge(mocker):
+    """ Test that the queries of split_by are merged into the order of merge_key """
+    test_obj = SCDNetbox()
+    ids = {'a': [1, 4, 5, 8], 'b': [2, 3, 6, 7, 9]}
+    test_obj._get_page = mocker.MagicMock(side_effect=lambda endpoint, query, offset, limit: {
+        'count': len(ids[query['tenant']]),
+        'results': [{'id': i} for i in ids[query['tenant']][offset:offset + 2]],
+    })
+    endpoint = SimpleNamespace(return_obj=lambda values, api, endpoint: values['id'])
+
+    assert list(test_obj.fetch_all(endpoint, split_by='tenant', tenant=['a', 'b'])) == [1, 4, 5, 8, 2, 3, 6, 7, 9]
+    assert list(test_obj.fetch_all(endpoint, split_by='tenant', merge_key=lambda i: i, tenant=['a', 'b'])) == list(
+        range(1, 10)
+    )
+    # Both queries are paged
+    assert test_obj._get_page.call_count == 10
+
+
+def test_fetch_all_nested(mocker):
+    """ Test that fetches made from lookup workers share the pool instead of each starting their own """
+    test_obj = SCDNetbox()
+    test_obj.config['netbox']['lookup_workers'] = '2'
+    lock = threading.Lock()
+    active = []
+    most_active = []
+
+    def get_page(_, query, offset, __):
+        with lock:
+            active.append(offset)
+            most_active.append(len(active))
+        time.sleep(0.01)
+        with lock:
+            active.remove(offset)
+        return {'count': 3, 'results': [{'id': f'{query["name"]}-{offset}'}]}
+
+    test_obj._get_page = mocker.MagicMock(side_effect=get_page)
+    endpoint = SimpleNamespace(
+        url='http://127.0.0.1/api/dcim/devices/', return_obj=lambda values, api, endpoint: values['id'],
+    )
+    test_obj.config['netbox']['max_url_length'] = '80'
+
+    names = [f'device{i:02}' for i in range(8)]
+    objects = test_obj._fetch_by_values(endpoint, 'name', names)
+    chunks = test_obj._chunk_values(endpoint, 'name', names)
+    assert len(chunks) > 2
+    # Every page of every chunk, in order, with no more requests at once than there are workers
+    assert objects == [f'{chunk}-{offset}' for chunk in chunks for offset in range(3)]
+    assert max(most_active) <= 2
+    assert test_obj._get_page.call_count == len(chunks) * 3
+
+
 def test_get_device_by_name_or_magdb_id(mocker):
     """
     Test that get_device_by_name and get_device_by_magdb_id return unmodified objects.
@@ -128,6 +283,64 @@ def test_get_device_by_hostname(mocker):
     mocked_error.assert_called()
 
 
+def test__chunk_values():
+    """ Test that chunks of values keep their order, and the URLs of their queries stay under the limit """
+    test_obj = SCDNetbox()
+    test_obj.config['netbox']['max_url_length'] = '200'
+    endpoint = test_obj.netbox.ipam.ip_addresses
+    hostnames = [f'host{i}.example.org' for i in range(50)]
+
+    chunks = test_obj._chunk_values(endpoint, 'dns_name', hostnames, family=4)
+    assert len(chunks) > 1
+    assert [hostname for chunk in chunks for hostname in chunk] == hostnames
+    for chunk in chunks:
+        query = urlencode({'dns_name': chunk, 'family': 4, 'offset': 0, 'limit': 1000}, doseq=True)
+        assert len(f'{endpoint.url}/?{query}') <= 200
+
+    # A value that is too long on its own still gets a chunk
+    assert test_obj._chunk_values(endpoint, 'dns_name', ['x' * 500]) == [['x' * 500]]
+    assert not test_obj._chunk_values(endpoint, 'dns_name', [])
+
+
+def test_resolve_hostnames(mocker):
+    """ Test that hostnames are resolved with one query per endpoint, and unknown or ambiguous names reported """
+    test_obj = SCDNetbox()
+    addresses = [
+        SimpleNamespace(dns_name='foo.example.org', assigned_object_type='dcim.interface',
+                        assigned_object=SimpleNamespace(device=SimpleNamespace(id=277636))),
+        SimpleNamespace(dns_name='bar.example.org', assigned_object_type='virtualization.vminterface',
+                        assigned_object=SimpleNamespace(virtual_machine=SimpleNamespace(id=6465))),
+        SimpleNamespace(dns_name='dup.example.org', assigned_object_type='dcim.interface',
+                        assigned_object=SimpleNamespace(device=SimpleNamespace(id=1))),
+        SimpleNamespace(dns_name='dup.example.org', assigned_object_type='dcim.interface',
+                        assigned_object=SimpleNamespace(device=SimpleNamespace(id=2))),
+    ]
+    results = {
+        'ip-addresses': addresses,
+        'devices': [SimpleNamespace(id=277636, name='foo')],
+        'virtual-machines': [SimpleNamespace(id=6465, name='bar')],
+    }
+    test_obj.fetch_all = mocker.MagicMock(side_effect=lambda endpoint, **_: iter(results[endpoint.name]))
+
+    devices, unresolved, ambiguous = test_obj.resolve_hostnames([
+        'FOO.example.org', 'bar.example.org', 'dup.example.org', 'missing.example.org', 'bar.example.org',
+    ])
+    assert {hostname: device.name for hostname, device in devices.items()} == {
+        'FOO.example.org': 'foo', 'bar.example.org': 'bar',
+    }
+    assert unresolved == ['missing.example.org']
+    assert ambiguous == ['dup.example.org']
+
+    assert test_obj.fetch_all.call_count == 3
+    calls = {call[0][0].name: call[1] for call in test_obj.fetch_all.call_args_list}
+    assert calls['ip-addresses']['dns_name'] == [
+        'FOO.example.org', 'bar.example.org', 'dup.example.org', 'missing.example.org',
+    ]
+    assert calls['ip-addresses']['family'] == 4
+    assert calls['devices']['id'] == [277636]
+    assert calls['virtual-machines']['id'] == [6465]
+
+
 def test_get_rack_from_device(mocker):
     """
     Test that get_rack_from_device returns a rack or exits with an error
@@ -156,17 +369,45 @@ def test_get_interfaces_from_device(mocker):
     test_obj = SCDNetbox()
 
     # Test physical interfaces
-    # The last one has no MAC address and should not be returned, but a warning should be issued
-    test_obj.netbox.dcim.interfaces = SimpleNamespace()
-    test_obj.netbox.dcim.interfaces.filter = mocker.MagicMock(return_value=deepcopy(FAKE.INTERFACES_PHYSICAL))
+    # LAGs and interfaces with a MAC address are fetched separately, along with a count of all interfaces
+    # One interface has no MAC address and should not be returned, but a warning should be issued
+    interfaces = deepcopy(FAKE.INTERFACES_PHYSICAL)
+    lags = [i for i in interfaces if i.type.value == 'lag']
+
+    def fake_fetch_all(_, **filters):
+        if filters.get('type') == 'lag':
+            return lags
+        return [i for i in interfaces if i.mac_address]
+
+    test_obj.fetch_all = mocker.MagicMock(side_effect=fake_fetch_all)
+    test_obj.netbox.dcim.interfaces = SimpleNamespace(count=mocker.MagicMock(return_value=len(interfaces)))
     mocked_warning = mocker.patch.object(logging, 'warning')
-    assert FAKE.INTERFACES_PHYSICAL[:-1] == test_obj.get_interfaces_from_device(deepcopy(FAKE.DEVICE_PHYSICAL))
-    mocked_warning.assert_called()
+    assert lags + [i for i in FAKE.INTERFACES_PHYSICAL[:-1] if i not in lags] == test_obj.get_interfaces_from_device(
+        deepcopy(FAKE.DEVICE_PHYSICAL)
+    )
+    mocked_warning.assert_called_once()
+    assert mocked_warning.call_args[0][1] == 1
+    test_obj.netbox.dcim.interfaces.count.assert_called_once_with(device=FAKE.DEVICE_PHYSICAL.name)
+    assert test_obj.fetch_all.call_args[1]['fields'] == INTERFACE_FIELDS
+    assert test_obj.fetch_all.call_args[1]['record_type'] is InterfaceRecord
 
     # Test virtual interfaces
-    test_obj.netbox.virtualization.interfaces = SimpleNamespace()
-    test_obj.netbox.virtualization.interfaces.filter = mocker.MagicMock(return_value=deepcopy(FAKE.INTERFACES_VIRTUAL))
+    test_obj.fetch_all = mocker.MagicMock(return_value=deepcopy(FAKE.INTERFACES_VIRTUAL))
+    test_obj.netbox.virtualization.interfaces = SimpleNamespace(
+        count=mocker.MagicMock(return_value=len(FAKE.INTERFACES_VIRTUAL)),
+    )
     assert FAKE.INTERFACES_VIRTUAL == test_obj.get_interfaces_from_device(deepcopy(FAKE.DEVICE_VIRTUAL))
+    assert test_obj.fetch_all.call_args[1] == {
+        'virtual_machine': 'system6690', 'mac_address__empty': 'false', 'fields': INTERFACE_FIELDS,
+        'record_type': InterfaceRecord,
+    }
+
+    # Should log an error and exit if the device has no interfaces at all
+    test_obj.netbox.virtualization.interfaces.count = mocker.MagicMock(return_value=0)
+    mocked_error = mocker.patch.object(logging, 'error')
+    with pytest.raises(SystemExit):
+        test_obj.get_interfaces_from_device(deepcopy(FAKE.DEVICE_VIRTUAL))
+    mocked_error.assert_called()
 
     # Should log an error and exit if an unknown type is passed
     mocked_error = mocker.patch.object(logging, 'error')
@@ -175,31 +416,119 @@ def test_get_interfaces_from_device(mocker):
     mocked_error.assert_called()
 
 
+def test_get_addresses_from_device(mocker):
+    """ Test get_addresses_from_device """
+    scd_netbox = SCDNetbox()
+
+    # Should make a single query by device_id and group addresses by interface
+    scd_netbox.netbox.ipam.ip_addresses = SimpleNamespace(count=mocker.MagicMock())
+    scd_netbox.fetch_all = mocker.MagicMock(return_value=deepcopy(FAKE.ADDRESSES_IPV4))
+    assert scd_netbox.get_addresses_from_device(deepcopy(FAKE.DEVICE_PHYSICAL)) == {34624: FAKE.ADDRESSES_IPV4}
+    scd_netbox.fetch_all.assert_called_once_with(
+        scd_netbox.netbox.ipam.ip_addresses, fields=ADDRESS_FIELDS, record_type=AddressRecord, device_id=5249,
+    )
+
+    # Should query by virtual_machine_id if virtual
+    scd_netbox.fetch_all = mocker.MagicMock(return_value=[])
+    assert not scd_netbox.get_addresses_from_device(deepcopy(FAKE.DEVICE_VIRTUAL))
+    assert scd_netbox.fetch_all.call_args[1]['virtual_machine_id'] == 763
+
+    # Should raise a warning and ignore IPv6 addresses, without another query to count them
+    scd_netbox.fetch_all = mocker.MagicMock(return_value=deepcopy(FAKE.ADDRESSES_IPV4 + FAKE.ADDRESSES_IPV6))
+    mocked_warning = mocker.patch.object(logging, 'warning')
+    assert scd_netbox.get_addresses_from_device(deepcopy(FAKE.DEVICE_PHYSICAL)) == {34624: FAKE.ADDRESSES_IPV4}
+    mocked_warning.assert_called()
+    scd_netbox.fetch_all.assert_called_once()
+    scd_netbox.netbox.ipam.ip_addresses.count.assert_not_called()
+
+    # Should log an error and exit if an unknown type is passed
+    mocked_error = mocker.patch.object(logging, 'error')
+    with pytest.raises(SystemExit):
+        scd_netbox.get_addresses_from_device(SimpleNamespace())
+    mocked_error.assert_called()
+
+
 def test_get_addresses_from_interface(mocker):
     """ Test get_addresses_from_interface """
     scd_netbox = SCDNetbox()
 
-    # Should filter by interface_id if physical
-    scd_netbox.netbox.ipam.ip_addresses = SimpleNamespace()
-    scd_netbox.netbox.ipam.ip_addresses.filter = mocker.MagicMock(return_value=deepcopy(FAKE.ADDRESSES_IPV4))
-    assert FAKE.ADDRESSES_IPV4 == scd_netbox.get_addresses_from_interface(FAKE.INTERFACES_PHYSICAL[0])
-    scd_netbox.netbox.ipam.ip_addresses.filter.assert_called_with(interface_id=34623)
-
-    # Should filter by vminterface_id if virtual
-    scd_netbox.netbox.ipam.ip_addresses = SimpleNamespace()
-    scd_netbox.netbox.ipam.ip_addresses.filter = mocker.MagicMock(return_value=[])
+    # Without the addresses of the device, they are loaded for the device of the interface in a single query
+    scd_netbox.netbox.ipam.ip_addresses = SimpleNamespace(count=mocker.MagicMock())
+    scd_netbox.fetch_all = mocker.MagicMock(side_effect=lambda *_, **__: deepcopy(FAKE.ADDRESSES_IPV4))
+    assert FAKE.ADDRESSES_IPV4 == scd_netbox.get_addresses_from_interface(FAKE.INTERFACES_PHYSICAL[1])
+    assert scd_netbox.fetch_all.call_args[1]['device_id'] == 5249
+    scd_netbox.netbox.ipam.ip_addresses.count.assert_not_called()
+    # Nothing is kept between calls, so changes to the addresses are always seen
+    assert FAKE.ADDRESSES_IPV4 == scd_netbox.get_addresses_from_interface(FAKE.INTERFACES_PHYSICAL[1])
+    assert scd_netbox.fetch_all.call_count == 2
+
+    # Addresses of the whole device can be passed in to avoid any queries
+    scd_netbox.fetch_all = mocker.MagicMock()
+    addresses = {34624: deepcopy(FAKE.ADDRESSES_IPV4)}
+    assert FAKE.ADDRESSES_IPV4 == scd_netbox.get_addresses_from_interface(FAKE.INTERFACES_PHYSICAL[1], addresses)
+    assert len(scd_netbox.get_addresses_from_interface(FAKE.INTERFACES_PHYSICAL[0], addresses)) == 0
+    scd_netbox.fetch_all.assert_not_called()
+
+    # Interfaces without addresses should not cause a query
+    scd_netbox.fetch_all = mocker.MagicMock()
+    assert len(scd_netbox.get_addresses_from_interface(FAKE.INTERFACES_PHYSICAL[2])) == 0
+    scd_netbox.fetch_all.assert_not_called()
+
+    # Should filter by virtual_machine_id if virtual
+    scd_netbox.fetch_all = mocker.MagicMock(return_value=[])
     assert len(scd_netbox.get_addresses_from_interface(FAKE.INTERFACES_VIRTUAL[0])) == 0
-    scd_netbox.netbox.ipam.ip_addresses.filter.assert_called_with(vminterface_id=3768)
+    assert scd_netbox.fetch_all.call_args[1]['virtual_machine_id'] == 763
 
     # Should raise a warning and return an empty list if an unknown type is passed
-    scd_netbox.netbox.ipam.ip_addresses = SimpleNamespace()
     mocked_warning = mocker.patch.object(logging, 'warning')
     assert len(scd_netbox.get_addresses_from_interface(SimpleNamespace(count_ipaddresses=42))) == 0
     mocked_warning.assert_called()
 
     # Should raise a warning and return an empty list if only an IPv6 address is found
-    scd_netbox.netbox.ipam.ip_addresses = SimpleNamespace()
-    scd_netbox.netbox.ipam.ip_addresses.filter = mocker.MagicMock(return_value=deepcopy(FAKE.ADDRESSES_IPV6))
+    scd_netbox.fetch_all = mocker.MagicMock(return_value=deepcopy(FAKE.ADDRESSES_IPV6))
     mocked_warning = mocker.patch.object(logging, 'warning')
-    assert len(scd_netbox.get_addresses_from_interface(SimpleNamespace(count_ipaddresses=2112))) == 0
+    assert len(scd_netbox.get_addresses_from_interface(SimpleNamespace(
+        id=38917,
+        count_ipaddresses=2112,
+        device=SimpleNamespace(id=8100),
+    ))) == 0
     mocked_warning.assert_called()
+
+
+def test_get_device_snapshot(mocker):
+    """ Test that get_device_snapshot fetches everything for a device exactly once """
+    scd_netbox = SCDNetbox()
+
+    fake_rack = SimpleNamespace(facility_id='152')
+    fake_cluster = SimpleNamespace(custom_fields={})
+    fake_addresses = {34624: deepcopy(FAKE.ADDRESSES_IPV4)}
+
+    scd_netbox.get_rack_from_device = mocker.MagicMock(return_value=fake_rack)
+    scd_netbox.get_cluster_from_device = mocker.MagicMock(return_value=fake_cluster)
+    scd_netbox.get_interfaces_from_device = mocker.MagicMock(return_value=deepcopy(FAKE.INTERFACES_PHYSICAL))
+    scd_netbox.get_addresses_from_device = mocker.MagicMock(return_value=fake_addresses)
+    scd_netbox.get_disks_from_device = mocker.MagicMock(return_value=iter(deepcopy(FAKE.DISKS_VIRTUAL)))
+
+    # Physical devices have a rack, but no cluster or disks
+    snapshot = scd_netbox.get_device_snapshot(FAKE.DEVICE_PHYSICAL)
+    assert isinstance(snapshot, DeviceSnapshot)
+    assert snapshot.device == FAKE.DEVICE_PHYSICAL
+    assert snapshot.rack == fake_rack
+    assert snapshot.cluster is None
+    assert snapshot.interfaces == FAKE.INTERFACES_PHYSICAL
+    assert snapshot.addresses == fake_addresses
+    assert not snapshot.disks
+    scd_netbox.get_interfaces_from_device.assert_called_once()
+    scd_netbox.get_disks_from_device.assert_not_called()
+
+    # Virtual machines have a cluster and disks, but no rack
+    snapshot = scd_netbox.get_device_snapshot(FAKE.DEVICE_VIRTUAL)
+    assert snapshot.rack is None
+    assert snapshot.cluster == fake_cluster
+    assert snapshot.disks == FAKE.DISKS_VIRTUAL
+
+    # Should log an error and exit if an unknown type is passed
+    mocked_error = mocker.patch.object(logging, 'error')
+    with pytest.raises(SystemExit):
+        scd_netbox.get_device_snapshot(SimpleNamespace())
+    mocked_error.assert_called()
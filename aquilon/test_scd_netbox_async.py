@@ -0,0 +1,73 @@
+"""
+Test cases for the asyncio variant of the core library
+"""
+
+# pylint: disable=missing-function-docstring
+
+import sys
+import time
+
+from copy import deepcopy
+from types import SimpleNamespace
+
+from scd_netbox import SCDNetbox
+from scd_netbox_async import AsyncSCDNetbox, run_sync
+
+import testdata
+
+FAKE = testdata.load_data()
+
+DELAY = 0.2
+
+
+def slow(result):
+    """ Returns a fake lookup that takes DELAY seconds to return result """
+    def lookup(*_):
+        time.sleep(DELAY)
+        return deepcopy(result)
+    return lookup
+
+
+def test_get_device_snapshot():
+    scd_netbox = SCDNetbox()
+    scd_netbox.get_rack_from_device = slow(SimpleNamespace(facility_id='152'))
+    scd_netbox.get_cluster_from_device = slow(SimpleNamespace(custom_fields={}))
+    scd_netbox.get_interfaces_from_device = slow(FAKE.INTERFACES_VIRTUAL)
+    scd_netbox.get_addresses_from_device = slow({})
+    scd_netbox.get_disks_from_device = slow(FAKE.DISKS_VIRTUAL)
+
+    async_netbox = AsyncSCDNetbox(scd_netbox)
+
+    # The four lookups for a virtual machine should take about as long as one of them
+    start = time.monotonic()
+    snapshot = run_sync(async_netbox.get_device_snapshot(FAKE.DEVICE_VIRTUAL))
+    assert time.monotonic() - start < DELAY * 2
+    assert snapshot.cluster.custom_fields == {}
+    assert snapshot.interfaces == FAKE.INTERFACES_VIRTUAL
+    assert snapshot.disks == FAKE.DISKS_VIRTUAL
+
+    # Many devices should also be fetched at the same time
+    start = time.monotonic()
+    snapshots = run_sync(async_netbox.get_device_snapshots([FAKE.DEVICE_PHYSICAL, FAKE.DEVICE_VIRTUAL]))
+    assert time.monotonic() - start < DELAY * 2
+    assert snapshots[0].rack.facility_id == '152'
+    assert snapshots[1].cluster is not None
+
+
+def test_get_device_snapshots_failure():
+    scd_netbox = SCDNetbox()
+    scd_netbox.get_rack_from_device = lambda device: sys.exit(1)
+    scd_netbox.get_cluster_from_device = slow(SimpleNamespace(custom_fields={}))
+    scd_netbox.get_interfaces_from_device = slow([])
+    scd_netbox.get_addresses_from_device = slow({})
+    scd_netbox.get_disks_from_device = slow([])
+
+    async_netbox = AsyncSCDNetbox(scd_netbox)
+
+    # A lookup that exits should only fail the snapshot of that device
+    snapshots = run_sync(async_netbox.get_device_snapshots([
+        FAKE.DEVICE_PHYSICAL, FAKE.DEVICE_VIRTUAL, SimpleNamespace(),
+    ]))
+    assert snapshots[0] is None
+    assert snapshots[1].cluster is not None
+    assert snapshots[2] is None
@@ -0,0 +1,156 @@
+"""
+Test cases for the GraphQL snapshot backend
+"""
+
+# pylint: disable=protected-access,missing-function-docstring
+
+import json
+
+from copy import deepcopy
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from netbox2aquilon import Netbox2Aquilon
+from scd_netbox import DeviceSnapshot
+from scd_netbox_graphql import NetboxGraphQL
+
+import testdata
+
+FAKE = testdata.load_data()
+
+
+def load_json(name):
+    with open(f'testdata/{name}.json', encoding='utf-8') as json_file:
+        return json.load(json_file)
+
+
+def graphql_interface(interface, addresses):
+    """ Convert a REST interface from the test data into the shape returned by GraphQL """
+    result = {
+        'id': interface['id'],
+        'name': interface['name'],
+        'mac_address': interface['mac_address'],
+        'tags': [{'slug': t['slug']} for t in interface['tags']],
+        'ip_addresses': [
+            {
+                'id': a['id'],
+                'address': a['address'],
+                'dns_name': a['dns_name'],
+                'family': a['family'],
+                'vrf': a['vrf'],
+            }
+            for a in addresses if a['assigned_object_id'] == interface['id']
+        ],
+    }
+    if 'device' in interface:
+        result['type'] = interface['type']['value'].upper()
+        result['mgmt_only'] = interface['mgmt_only']
+        result['lag'] = interface['lag']
+    return result
+
+
+GRAPHQL_DATA = {
+    'd0': {
+        'rack': {'id': 368, 'name': 'MagDB rack152', 'facility_id': '152', 'tags': [{'slug': 'magdb2netbox'}]},
+        'interfaces': [
+            graphql_interface(i, load_json('addresses_ipv4')) for i in load_json('interfaces_physical')
+        ],
+    },
+    'd1': {
+        'cluster': {'id': 10, 'name': 'Tier1 Cluster', 'type': {'slug': 'vmware'}, 'custom_fields': {}},
+        'interfaces': [graphql_interface(i, []) for i in load_json('interfaces_virtual')],
+        'virtualdisks': [
+            {'id': d['id'], 'name': d['name'], 'size': d['size'], 'description': d['description']}
+            for d in load_json('disks_virtual')
+        ],
+    },
+    'd2': {
+        'rack': {'id': 368, 'name': 'MagDB rack152', 'facility_id': '152', 'tags': [{'slug': 'magdb2netbox'}]},
+        # GraphQL returns interfaces by id, which puts the LAGs after their members
+        'interfaces': [
+            graphql_interface(i, [])
+            for i in sorted(load_json('interfaces_physical_lags'), key=lambda i: i['id'])
+        ],
+    },
+}
+
+
+class FakeGraphQLHandler(BaseHTTPRequestHandler):
+    """ Returns GRAPHQL_DATA for any query """
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append((self.path, self.headers['Authorization'], body['query']))
+        testdata.send_json(self, {'data': GRAPHQL_DATA})
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+@pytest.fixture(name='fake_netbox')
+def fixture_fake_netbox():
+    with testdata.fake_server(FakeGraphQLHandler) as server:
+        yield server
+
+
+def test_build_query():
+    test_obj = Netbox2Aquilon()
+    query = NetboxGraphQL(test_obj).build_query([FAKE.DEVICE_PHYSICAL, FAKE.DEVICE_VIRTUAL])
+
+    assert 'd0: device(id: 5249) { ...DeviceFields }' in query
+    assert 'd1: virtual_machine(id: 763) { ...VirtualMachineFields }' in query
+    assert 'fragment DeviceFields on DeviceType' in query
+    assert 'fragment VirtualMachineFields on VirtualMachineType' in query
+
+    # Unused fragments are not allowed by GraphQL
+    assert 'VirtualMachineFields' not in NetboxGraphQL(test_obj).build_query([FAKE.DEVICE_PHYSICAL])
+
+
+def test_get_device_snapshots(fake_netbox):
+    test_obj = Netbox2Aquilon()
+    test_obj.config['netbox']['backend'] = 'graphql'
+    test_obj.netbox.base_url = f'http://127.0.0.1:{fake_netbox.server_port}/api'
+
+    device = deepcopy(FAKE.DEVICE_PHYSICAL)
+    device.aq_machine_name = 'system7592'
+    virtual_machine = deepcopy(FAKE.DEVICE_VIRTUAL)
+    virtual_machine.aq_machine_name = 'system6690'
+    lag_device = deepcopy(FAKE.DEVICE_PHYSICAL)
+    lag_device.aq_machine_name = 'system8211'
+
+    snapshots = test_obj.get_device_snapshots([device, virtual_machine, lag_device])
+
+    # Both devices should have been fetched with a single query
+    assert len(fake_netbox.requests) == 1
+    assert fake_netbox.requests[0][0] == '/graphql/'
+    assert fake_netbox.requests[0][1] == 'Token TOKEN'
+
+    # The planners should produce the same commands from GraphQL as from the REST API
+    rest_snapshot = DeviceSnapshot(
+        device,
+        interfaces=deepcopy(FAKE.INTERFACES_PHYSICAL[:-1]),
+        addresses={34624: deepcopy(FAKE.ADDRESSES_IPV4)},
+    )
+    assert snapshots[0].device is device
+    assert snapshots[0].rack.facility_id == '152'
+    assert test_obj._netbox_copy_interfaces(snapshots[0]) == test_obj._netbox_copy_interfaces(rest_snapshot)
+    assert test_obj._netbox_copy_addresses(snapshots[0]) == test_obj._netbox_copy_addresses(rest_snapshot)
+
+    rest_snapshot = DeviceSnapshot(
+        virtual_machine,
+        interfaces=deepcopy(FAKE.INTERFACES_VIRTUAL),
+        disks=deepcopy(FAKE.DISKS_VIRTUAL),
+    )
+    assert snapshots[1].cluster.type.slug == 'vmware'
+    assert test_obj._netbox_copy_interfaces(snapshots[1]) == test_obj._netbox_copy_interfaces(rest_snapshot)
+    assert test_obj._netbox_copy_vm_disks(snapshots[1]) == test_obj._netbox_copy_vm_disks(rest_snapshot)
+
+    # LAGs have to be added before the interfaces that refer to them, the REST API fetches them first
+    lags = [i for i in FAKE.INTERFACES_PHYSICAL_LAGS if i.type.value == 'lag']
+    others = [i for i in FAKE.INTERFACES_PHYSICAL_LAGS if i.type.value != 'lag']
+    rest_snapshot = DeviceSnapshot(
+        lag_device,
+        interfaces=deepcopy(lags + others),
+    )
+    assert test_obj._netbox_copy_interfaces(snapshots[2]) == test_obj._netbox_copy_interfaces(rest_snapshot)
@@ -1,7 +1,11 @@
 """ Module to provide test data for mocking pynetbox while unit testing """
 
+import threading
+
+from contextlib import contextmanager
 from copy import deepcopy
-from json import load
+from http.server import HTTPServer
+from json import dumps, load
 from types import SimpleNamespace
 
 import pynetbox
@@ -43,3 +47,34 @@ def load_data():
             setattr(result, name.upper(), obj)
 
     return result
+
+
+@contextmanager
+def fake_server(handler):
+    """ Run a local HTTP server in a background thread, requests received can be recorded in server.requests """
+    server = HTTPServer(('127.0.0.1', 0), handler)
+    server.requests = []
+    with serve_in_background(server):
+        yield server
+
+
+@contextmanager
+def serve_in_background(server):
+    """ Run any socketserver in a background thread, shutting it down afterwards """
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def send_json(handler, data):
+    """ Send a JSON response from a BaseHTTPRequestHandler used with fake_server """
+    reply = dumps(data).encode('utf-8')
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'application/json')
+    handler.send_header('Content-Length', str(len(reply)))
+    handler.end_headers()
+    handler.wfile.write(reply)